@@ -2,11 +2,12 @@ import os
 import base64
 import bcrypt
 from flask import Blueprint, request, jsonify, send_file
-from services.core_img_db_connector import get_db_connection
-from utils.ImagePreprocess import preprocess_image, store_tiles
-from mysql.connector import Error
+from services.core_img_db_connector import get_db_connection, Error
+from services.ProjectJobRunner import create_job, get_job, spool_upload, store_original, OriginalTooLargeError
+from services.TileRenderer import get_tile_renderer
+from utils.ImagePreprocess import check_decode_size, ImageTooLargeError
 from datetime import date
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import io
 import numpy as np
 
@@ -71,6 +72,7 @@ def register_user():
 def create_project():
     conn = None
     cursor = None
+    upload_path = None
     try:
         print(request.form)
         client_id = request.form.get('client-id')
@@ -94,38 +96,59 @@ def create_project():
         cursor.execute(project_query, (client_id, project_name, project_description, end_date, analysis_goal))
         project_id = cursor.lastrowid
 
-        image_data = image.read()
-        image_query = """
-            INSERT INTO OriginalImages (projectId, image) 
-            VALUES (%s, %s)
-        """
-        cursor.execute(image_query, (project_id, image_data))
-        original_image_id = cursor.lastrowid
-
+        # the upload is copied to disk in chunks, the tiling job decodes it from there
+        upload_path, sha256, size = spool_upload(image.stream)
+        print(f"spooled {size} bytes to {upload_path}")
+        # the tiling job decodes the whole image at once, too many pixels are refused before anything is stored
+        check_decode_size(upload_path)
 
-        img = Image.open(io.BytesIO(image_data))
-        image_np = np.array(img)
+        # one INSERT, bounded by the server's max_allowed_packet
+        original_image_id = store_original(cursor, project_id, upload_path)
 
-        # Partition the image into tiles
-        tiles = preprocess_image(image_np)
+        # tiling runs in the job runner process, the client polls /api/project_jobs/<job_id>
+        job_id = create_job(cursor, project_id, original_image_id, upload_path, sha256)
+        conn.commit()
+        upload_path = None # owned by the job from here
 
-        # Store the tiles in the database
-        store_tiles(tiles, project_id, original_image_id, cursor)
+        return jsonify({'message': 'Project created, tiling in progress', 'project_id': project_id, 'job_id': job_id,
+                        'sha256': sha256}), 202
 
-        conn.commit()
+    except (OriginalTooLargeError, ImageTooLargeError) as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 413
 
-        return jsonify({'message': 'Project created successfully', 'project_id': project_id}), 200
+    except UnidentifiedImageError as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 400
 
     except Error as e:
         print(str(e))
         return jsonify({"error": str(e)}), 500
 
     finally:
+        if upload_path and os.path.exists(upload_path):
+            os.remove(upload_path)
         if cursor:
             cursor.close()
         if conn:
             conn.close()
 
+@user_project_blueprint.route('/api/project_jobs/<job_id>', methods=['GET'])
+def get_project_job(job_id):
+    try:
+        job = get_job(job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job), 200
+
+    except Exception as e:
+        print(str(e))
+        return jsonify({"error": str(e)}), 500
+
+@user_project_blueprint.route('/api/tile_cache_stats', methods=['GET'])
+def get_tile_cache_stats():
+    return jsonify(get_tile_renderer().stats()), 200
+
 @user_project_blueprint.route('/api/login', methods=['POST'])
 def login_user():
     conn = None
@@ -229,20 +252,10 @@ def get_projects():
                 p.projectId AS id, 
                 p.name AS title, 
                 p.description, 
-                CEIL(IFNULL(labeled_count, 0) / IFNULL(total_images, 1) * 100) AS progress
+                CEIL(IFNULL(ls.labeled_tiles, 0) / IFNULL(NULLIF(ps.num_tiles, 0), 1) * 100) AS progress
             FROM Projects p
-            LEFT JOIN (
-                SELECT i.project_id, COUNT(DISTINCT l.ImageID) AS labeled_count
-                FROM Labels l
-                JOIN Images i ON l.ImageID = i.id
-                WHERE l.LabellerID = %s
-                GROUP BY i.project_id
-            ) labeled ON p.projectId = labeled.project_id
-            LEFT JOIN (
-                SELECT project_id, COUNT(*) AS total_images
-                FROM Images
-                GROUP BY project_id
-            ) img_count ON p.projectId = img_count.project_id
+            LEFT JOIN LabellerProjectStats ls ON ls.project_id = p.projectId AND ls.LabellerID = %s
+            LEFT JOIN ProjectStats ps ON ps.project_id = p.projectId
             WHERE p.endDate >= %s
             """
             cursor.execute(query, (user_id, today))
@@ -281,16 +294,9 @@ def get_client_projects():
                 p.projectId AS id, 
                 p.name AS title, 
                 p.description, 
-                IFNULL(ROUND((high_conf_count / NULLIF(total_count, 0)) * 100), 0) AS progress
+                IFNULL(ROUND((ps.high_conf_tiles / NULLIF(ps.num_tiles, 0)) * 100), 0) AS progress
             FROM Projects p
-            LEFT JOIN (
-                SELECT 
-                    i.project_id, 
-                    COUNT(CASE WHEN i.confidence > 0.8 THEN 1 END) AS high_conf_count,
-                    COUNT(*) AS total_count
-                FROM Images i
-                GROUP BY i.project_id
-            ) img_stats ON p.projectId = img_stats.project_id
+            LEFT JOIN ProjectStats ps ON ps.project_id = p.projectId
             WHERE p.endDate >= %s AND p.clientId = %s
             """
         cursor.execute(query, (today, client_id))
@@ -351,6 +357,9 @@ def get_images():
         images = cursor.fetchall()
 
         for image in images:
+            if image['image'] is None:
+                # virtual tile, cut from the original (and cached) on request
+                image['image'] = get_tile_renderer().render(image)
             image['image'] = base64.b64encode(image['image']).decode('utf-8')
 
         return jsonify({"images": images}), 200
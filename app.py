@@ -6,6 +6,7 @@ from flask_cors import CORS
 # modules
 from api.image_routes import image_blueprint
 from api.account_routes import user_project_blueprint
+from services.core_img_db_connector import server_threads
 
 
 def create_app():
@@ -23,6 +24,7 @@ def create_app():
 app = create_app()
 
 if __name__ == '__main__':
-    serve(app, host='0.0.0.0', port=5050)
+    # the database pool is sized from the same setting, see services/core_img_db_connector.py
+    serve(app, host='0.0.0.0', port=5050, threads=server_threads())
 
 
@@ -0,0 +1,298 @@
+from abc import ABC, abstractmethod
+import os
+import math
+import sys
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from services.DataTypes import ImageClassMeasure
+from services.LabelRasterizer import rasterize_labels, disjoint_windows
+import numpy as np
+
+
+def log_beta_factors(alpha: float, beta: float) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Log of the multiplicative updates applied to (P(w_i | L = 0), P(w_i | L = 1)) for a pixel the labeller
+    marked as 0 (index 0) or 1 (index 1). Same clamped lgamma form as the update_likelihoods kernel.
+    '''
+    log_gamma_3 = math.lgamma(max(1 + alpha + beta, 1e-9))
+    log_factor_1 = np.empty(2, dtype=np.float64)
+    log_factor_2 = np.empty(2, dtype=np.float64)
+    for prediction in (0, 1):
+        log_factor_1[prediction] = (math.lgamma(max(1 - prediction + alpha, 1e-9))
+                                    + math.lgamma(max(prediction + beta, 1e-9)) - log_gamma_3)
+        log_factor_2[prediction] = (math.lgamma(max(prediction + alpha, 1e-9))
+                                    + math.lgamma(max(1 - prediction + beta, 1e-9)) - log_gamma_3)
+    return log_factor_1, log_factor_2
+
+
+def beta_factors(alpha: float, beta: float) -> tuple[np.ndarray, np.ndarray]:
+    log_factor_1, log_factor_2 = log_beta_factors(alpha, beta)
+    return np.exp(log_factor_1), np.exp(log_factor_2)
+
+
+def log_odds_steps(alpha: float, beta: float) -> np.ndarray:
+    # change in log(P(w_i | L = 1) / P(w_i | L = 0)) for a pixel marked 0 (index 0) or 1 (index 1)
+    log_factor_1, log_factor_2 = log_beta_factors(alpha, beta)
+    return log_factor_2 - log_factor_1
+
+
+def step_windows(icm: ImageClassMeasure, windows: np.ndarray, alpha: float, beta: float):
+    # turns the pixels of disjoint windows from marked 0 to marked 1 by the ratio of the two updates
+    log_factor_1, log_factor_2 = log_beta_factors(alpha, beta)
+    if icm.mode == 'log_odds':
+        step = (log_factor_2[1] - log_factor_1[1]) - (log_factor_2[0] - log_factor_1[0])
+        for x_start, y_start, x_end, y_end in windows.tolist():
+            icm.log_odds[y_start:y_end, x_start:x_end] += step
+    else:
+        factor_1 = math.exp(log_factor_1[1] - log_factor_1[0])
+        factor_2 = math.exp(log_factor_2[1] - log_factor_2[0])
+        helper_value_1 = icm.helper_value_1
+        helper_value_2 = icm.helper_value_2
+        for x_start, y_start, x_end, y_end in windows.tolist():
+            helper_value_1[y_start:y_end, x_start:x_end] *= factor_1
+            helper_value_2[y_start:y_end, x_start:x_end] *= factor_2
+
+
+class ConsensusBackend(ABC):
+    # array compute used by ObjectExtractionService to combine labels into per pixel likelihoods
+
+    def mark_predictions(self, boxes: np.ndarray, im_height: int, im_width: int) -> np.ndarray:
+        # label rasterization is O(labels + pixels) on the host, every backend shares it
+        return rasterize_labels(boxes, im_height, im_width)
+
+    def update_likelihoods_in_boxes(self, icm: ImageClassMeasure, boxes: np.ndarray, alpha: float, beta: float, applied_boxes: np.ndarray=None):
+        # applies one labeller's boxes, backends without a sparse path rasterize and update the full plane.
+        # applied_boxes are given when the labeller is already in the ICM, see extend_likelihoods_in_boxes
+        if applied_boxes is not None:
+            return self.extend_likelihoods_in_boxes(icm, boxes, applied_boxes, alpha, beta)
+        predictions = self.mark_predictions(boxes, icm.im_height, icm.im_width)
+        self.update_likelihoods(icm, predictions, alpha, beta)
+
+    def extend_likelihoods_in_boxes(self, icm: ImageClassMeasure, boxes: np.ndarray, applied_boxes: np.ndarray, alpha: float, beta: float):
+        '''
+        Adds boxes of a labeller whose earlier applied_boxes, and the unmarked update of every pixel outside
+        them, are already in the ICM. Only the pixels the new boxes newly cover change from unmarked to
+        marked, so only they are updated, giving the planes one update over all the labeller's boxes would.
+        The planes live on the host for every backend and the area is small, so this runs on the host
+        '''
+        windows = disjoint_windows(boxes, icm.im_height, icm.im_width, exclude=applied_boxes)
+        step_windows(icm, windows, alpha, beta)
+        icm.invalidate_likelihoods()
+
+    @abstractmethod
+    def update_likelihoods(self, icm: ImageClassMeasure, predictions: np.ndarray, alpha: float, beta: float):
+        pass
+
+    @abstractmethod
+    def update_confidence(self, icm: ImageClassMeasure, threshold: float):
+        pass
+
+    @abstractmethod
+    def predict(self, icm: ImageClassMeasure, threshold: float) -> np.ndarray:
+        pass
+
+
+class NumpyConsensusBackend(ConsensusBackend):
+
+    name = 'numpy'
+
+    def update_likelihoods(self, icm: ImageClassMeasure, predictions: np.ndarray, alpha: float, beta: float):
+        index = predictions.astype(np.intp)
+        if icm.mode == 'log_odds':
+            icm.add_log_odds(log_odds_steps(alpha, beta)[index])
+            return
+
+        factor_1, factor_2 = beta_factors(alpha, beta)
+
+        helper_value_1 = icm.helper_value_1
+        helper_value_2 = icm.helper_value_2
+        helper_value_1 *= factor_1[index]
+        helper_value_2 *= factor_2[index]
+        icm.invalidate_likelihoods()
+
+    def update_likelihoods_in_boxes(self, icm: ImageClassMeasure, boxes: np.ndarray, alpha: float, beta: float, applied_boxes: np.ndarray=None):
+        '''
+        Every pixel outside the labeller's boxes gets the same update, so it is booked once on the ICM as a
+        pending factor. Only the union of the boxes is touched, with the difference between the marked and
+        unmarked update, making the cost proportional to the labelled area rather than the image
+        '''
+        if applied_boxes is not None:
+            return self.extend_likelihoods_in_boxes(icm, boxes, applied_boxes, alpha, beta)
+        log_factor_1, log_factor_2 = log_beta_factors(alpha, beta)
+        icm.add_pending(log_factor_1[0], log_factor_2[0])
+        step_windows(icm, disjoint_windows(boxes, icm.im_height, icm.im_width), alpha, beta)
+        icm.invalidate_likelihoods()
+
+    def update_confidence(self, icm: ImageClassMeasure, threshold: float):
+        np.subtract(icm.likelihoods, 1, out=icm.confidence)
+        icm.confidence += icm.likelihoods > threshold
+        np.abs(icm.confidence, out=icm.confidence)
+
+    def predict(self, icm: ImageClassMeasure, threshold: float) -> np.ndarray:
+        return icm.likelihoods > threshold
+
+
+class CudaConsensusBackend(ConsensusBackend):
+
+    name = 'cuda'
+
+    def __init__(self):
+        # pycuda creates a context on import so only pull it in when the GPU backend is asked for
+        import pycuda.autoinit
+        import pycuda.driver as cuda
+        from pycuda.compiler import SourceModule
+
+        self.cuda = cuda
+        mod = SourceModule("""
+            __global__ void update_likelihoods(double* likelihoods, double* helper_value_1,
+                                   double* helper_value_2, bool* predictions,
+                                   double alpha, double beta, int im_x, int im_y)
+                {
+                    int index = blockIdx.x * blockDim.x + threadIdx.x;
+                    if (index >= im_x * im_y) return;  // Ensure valid index
+
+                    float prediction = predictions[index] ? 1.0f : 0.0f;
+
+                    double log_gamma_3 = lgamma(fmax(1 + alpha + beta, 1e-9));
+
+                    helper_value_1[index] *= exp(lgamma(fmax(1 - prediction + alpha, 1e-9)) + lgamma(fmax(prediction + beta, 1e-9)) - log_gamma_3);
+                    helper_value_2[index] *= exp(lgamma(fmax(prediction + alpha, 1e-9)) + lgamma(fmax(1 - prediction + beta, 1e-9)) - log_gamma_3);
+
+                    double denominator = helper_value_1[index] + helper_value_2[index] + 1e-9;
+                    likelihoods[index] = helper_value_2[index] / denominator;
+                }
+
+            __global__ void update_log_odds(double* log_odds, bool* predictions,
+                                            double step_0, double step_1, int im_x, int im_y)
+            {
+                int index = blockIdx.x * blockDim.x + threadIdx.x;
+                if (index < im_x * im_y) {
+                    log_odds[index] += predictions[index] ? step_1 : step_0;
+                }
+            }
+
+            __global__ void update_confidence(double* likelihoods, double* confidence,
+                                                double threshold, int im_x, int im_y)
+            {
+                int index = blockIdx.x * blockDim.x + threadIdx.x;
+                if (index < im_x * im_y) {
+                    confidence[index] = fabs(likelihoods[index] - 1 + (likelihoods[index] > threshold));
+                }
+            }
+        """)
+        self.__update_likelihoods = mod.get_function("update_likelihoods")
+        self.__update_confidence = mod.get_function("update_confidence")
+        self.__update_log_odds = mod.get_function("update_log_odds")
+        self.block_size = 256
+
+    def update_likelihoods(self, icm: ImageClassMeasure, predictions: np.ndarray, alpha: float, beta: float):
+        # the kernels work on whole planes, so any factors booked by another backend are folded in first
+        icm.apply_pending()
+        if icm.mode == 'log_odds':
+            return self.__update_log_odds_plane(icm, predictions, alpha, beta)
+
+        cuda = self.cuda
+        size = icm.im_width * icm.im_height
+        helper_value_1 = np.ascontiguousarray(icm.helper_value_1).ravel()
+        helper_value_2 = np.ascontiguousarray(icm.helper_value_2).ravel()
+        likelihoods = np.empty(size, dtype=np.float64)
+        predictions = np.ascontiguousarray(predictions, dtype=np.bool_).ravel()
+
+        d_predictions = cuda.mem_alloc(predictions.nbytes)
+        d_likelihoods = cuda.mem_alloc(likelihoods.nbytes)
+        d_helper_value_1 = cuda.mem_alloc(helper_value_1.nbytes)
+        d_helper_value_2 = cuda.mem_alloc(helper_value_2.nbytes)
+        cuda.memcpy_htod(d_predictions, predictions)
+        cuda.memcpy_htod(d_helper_value_1, helper_value_1)
+        cuda.memcpy_htod(d_helper_value_2, helper_value_2)
+
+        num_blocks = (size + self.block_size - 1) // self.block_size
+        self.__update_likelihoods(d_likelihoods, d_helper_value_1, d_helper_value_2, d_predictions,
+                                  np.float64(alpha), np.float64(beta), np.int32(icm.im_width), np.int32(icm.im_height),
+                                  block=(self.block_size, 1, 1), grid=(num_blocks, 1))
+        cuda.Context.synchronize()
+
+        cuda.memcpy_dtoh(likelihoods, d_likelihoods)
+        cuda.memcpy_dtoh(helper_value_1, d_helper_value_1)
+        cuda.memcpy_dtoh(helper_value_2, d_helper_value_2)
+
+        d_predictions.free()
+        d_likelihoods.free()
+        d_helper_value_1.free()
+        d_helper_value_2.free()
+
+        icm.helper_value_1[...] = helper_value_1.reshape(icm.im_height, icm.im_width)
+        icm.helper_value_2[...] = helper_value_2.reshape(icm.im_height, icm.im_width)
+        icm.likelihoods = likelihoods.reshape(icm.im_height, icm.im_width)
+
+    def __update_log_odds_plane(self, icm: ImageClassMeasure, predictions: np.ndarray, alpha: float, beta: float):
+        cuda = self.cuda
+        size = icm.im_width * icm.im_height
+        log_odds = icm.log_odds.reshape(size)
+        predictions = np.ascontiguousarray(predictions, dtype=np.bool_).ravel()
+        step_0, step_1 = log_odds_steps(alpha, beta)
+
+        d_predictions = cuda.mem_alloc(predictions.nbytes)
+        d_log_odds = cuda.mem_alloc(log_odds.nbytes)
+        cuda.memcpy_htod(d_predictions, predictions)
+        cuda.memcpy_htod(d_log_odds, log_odds)
+
+        num_blocks = (size + self.block_size - 1) // self.block_size
+        self.__update_log_odds(d_log_odds, d_predictions, np.float64(step_0), np.float64(step_1),
+                               np.int32(icm.im_width), np.int32(icm.im_height),
+                               block=(self.block_size, 1, 1), grid=(num_blocks, 1))
+        cuda.Context.synchronize()
+        cuda.memcpy_dtoh(log_odds, d_log_odds)
+
+        d_predictions.free()
+        d_log_odds.free()
+        icm.invalidate_likelihoods()
+
+    def update_confidence(self, icm: ImageClassMeasure, threshold: float):
+        cuda = self.cuda
+        size = icm.im_width * icm.im_height
+        likelihoods = icm.likelihoods.reshape(size)
+        confidence = icm.confidence.reshape(size)
+
+        d_likelihoods = cuda.mem_alloc(likelihoods.nbytes)
+        d_confidence = cuda.mem_alloc(confidence.nbytes)
+        cuda.memcpy_htod(d_likelihoods, likelihoods)
+
+        num_blocks = (size + self.block_size - 1) // self.block_size
+        self.__update_confidence(d_likelihoods, d_confidence, np.float64(threshold),
+                                 np.int32(icm.im_width), np.int32(icm.im_height),
+                                 block=(self.block_size, 1, 1), grid=(num_blocks, 1))
+        cuda.Context.synchronize()
+        cuda.memcpy_dtoh(confidence, d_confidence)
+
+        d_likelihoods.free()
+        d_confidence.free()
+
+    def predict(self, icm: ImageClassMeasure, threshold: float) -> np.ndarray:
+        # a single compare is cheaper on the host than a round trip to the device
+        return icm.likelihoods > threshold
+
+
+def get_consensus_backend(name: str = None) -> ConsensusBackend:
+    '''
+    Picks the compute backend at runtime. name (or _CONSENSUS_BACKEND) can be 'numpy', 'cuda' or 'auto';
+    'auto' uses the GPU when pycuda can create a context and falls back to NumPy otherwise
+    '''
+    if not name:
+        name = os.getenv('_CONSENSUS_BACKEND', 'auto')
+    name = name.lower()
+
+    if name == 'numpy':
+        return NumpyConsensusBackend()
+    if name == 'cuda':
+        return CudaConsensusBackend()
+    if name != 'auto':
+        raise ValueError(f"unknown consensus backend '{name}'")
+
+    try:
+        return CudaConsensusBackend()
+    except Exception as e:
+        print(f"CUDA backend unavailable ({e}), using NumPy")
+        return NumpyConsensusBackend()
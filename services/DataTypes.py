@@ -1,4 +1,7 @@
 import uuid
+import json
+import hashlib
+import numpy as np
 from PIL import Image as pilImage
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -149,12 +152,38 @@ class Image():
     # height: int
     image_data: pilImage
 
-    def __init__(self, ImageID: str, ProjectID: str, image_data: pilImage):
+    def __init__(self, ImageID: str, ProjectID: str, image_data: pilImage=None, loader=None):
+        '''
+        Handle on an original image. Either image_data is given up front or loader() fetches it the first
+        time image_data is read, release() drops fetched pixels again
+        '''
         self.ImageID = ImageID
         self.ProjectID = ProjectID
         # self.width = width
         # self.height = height
-        self.image_data = image_data
+        self._image_data = image_data
+        self.loader = loader
+
+    @property
+    def image_data(self) -> pilImage:
+        if self._image_data is None and self.loader is not None:
+            self._image_data = self.loader()
+        return self._image_data
+
+    @image_data.setter
+    def image_data(self, image_data: pilImage):
+        self._image_data = image_data
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._image_data is not None
+
+    def release(self):
+        # frees the pixels of a lazy handle, the next access fetches them again. Eager images keep theirs
+        if self.loader is None or self._image_data is None:
+            return
+        self._image_data.close()
+        self._image_data = None
 
 
 class Project():
@@ -170,30 +199,204 @@ class Project():
 
 
 
+def box_digest(label: Label) -> str:
+    # short digest of a label's box, an upsert that moves the box keeps the LabelID but changes this
+    box = (label.top_left_x, label.top_left_y, label.bot_right_x, label.bot_right_y, label.offset_x, label.offset_y)
+    return hashlib.sha1(','.join(str(int(v)) for v in box).encode()).hexdigest()[:16]
+
+
+class LabelWatermark():
+    # the labels already folded into an ImageClassMeasure, kept per labeller as the box_digest of every
+    # applied LabelID. A label is new until its LabelID is in the marks with the same box, a stored box that
+    # moved or went away means the ICM no longer matches its labels (is_current). A mark also keeps the
+    # accuracy increment last pushed for the labeller from this ICM, so a re-run only pushes the difference.
+    # Marks from before boxes were tracked only hold a creation_time and never count as current
+    marks: dict[str, dict]
+
+    def __init__(self, marks: dict = None):
+        self.marks = marks if marks else {}
+
+    def is_applied(self, label: Label) -> bool:
+        mark = self.marks.get(str(label.LabellerID))
+        return bool(mark) and mark.get('boxes', {}).get(str(label.LabelID)) == box_digest(label)
+
+    def new_labels(self, labels: list[Label]) -> list[Label]:
+        return [label for label in labels if not self.is_applied(label)]
+
+    def is_current(self, labels: list[Label]) -> bool:
+        # False when a label applied to the ICM was moved or removed since, its old box cannot be taken out again
+        digests = {str(label.LabelID): box_digest(label) for label in labels}
+        for mark in self.marks.values():
+            if 'boxes' not in mark:
+                return False
+            if any(digests.get(label_id) != digest for label_id, digest in mark['boxes'].items()):
+                return False
+        return True
+
+    def applied_labellers(self) -> set[str]:
+        return {labeller_id for labeller_id, mark in self.marks.items() if mark.get('boxes')}
+
+    def advance(self, labels: list[Label]):
+        for label in labels:
+            mark = self.marks.setdefault(str(label.LabellerID), {})
+            mark.setdefault('boxes', {})[str(label.LabelID)] = box_digest(label)
+
+    def reset(self) -> 'LabelWatermark':
+        # an empty watermark for an ICM rebuilt from scratch, the accuracy last pushed is kept so the
+        # rebuild only pushes the difference
+        return LabelWatermark({labeller_id: {'boxes': {}, 'accuracy': mark['accuracy']}
+                               for labeller_id, mark in self.marks.items() if 'accuracy' in mark})
+
+    def accuracy(self, labeller_id) -> tuple[float, float]:
+        # (alpha, beta) increment last pushed for the labeller, zero before the first
+        mark = self.marks.get(str(labeller_id))
+        return tuple(mark['accuracy']) if mark and 'accuracy' in mark else (0.0, 0.0)
+
+    def set_accuracy(self, labeller_id, alpha: float, beta: float):
+        mark = self.marks.setdefault(str(labeller_id), {'boxes': {}})
+        mark['accuracy'] = [alpha, beta]
+
+    def to_json(self) -> str:
+        return json.dumps(self.marks)
+
+    @classmethod
+    def from_json(cls, data: str):
+        return cls(json.loads(data) if data else None)
+
+
 class ImageClassMeasure:
     # contains the values necessary to calculate the probability for each pixel to be a given label
+    # every plane is a contiguous float64 array indexed [row, col]
+    # two accumulator modes:
+    #   'helper'   - helper_values holds the running P(w_i | L = 0) & P(w_i | L = 1) products
+    #   'log_odds' - log_odds holds log(P(w_i | L = 1) / P(w_i | L = 0)), likelihoods are its sigmoid
+    # in both modes likelihoods are computed on demand, and an update that hits every pixel the same way is
+    # kept as a pending log factor instead of touching the planes, see apply_pending
+    __slots__ = ('imageID', '_likelihoods', 'confidence', 'helper_values', 'log_odds', 'pending_log_factors', 'label', 'im_height', 'im_width', 'watermark')
+
     imageID: str
-    likelihoods: list[list[float]]
-    confidence: list[list[float]]
-    helper_values: list[list[list[float]]]
+    confidence: np.ndarray # (im_height, im_width)
+    helper_values: np.ndarray # (im_height, im_width, 2), None in log_odds mode
+    log_odds: np.ndarray # (im_height, im_width), None in helper mode
+    pending_log_factors: np.ndarray # (2,) log factors for P(w_i | L = 0) & P(w_i | L = 1) not yet applied to any pixel
     label: str
     im_height: int
     im_width: int
+    watermark: LabelWatermark # labels already applied, re-runs only apply new ones
     
-    def __init__(self, imageID, likelihoods, confidence, helper_values, label, im_width, im_height):
-        if not likelihoods:
-            self.likelihoods = [[0.5] * im_width for _ in range(im_height)]
-        else:
-            self.likelihoods = likelihoods
-        if not confidence:
-            self.confidence = [[0.0] * im_width for _ in range(im_height)]
-        else:
-            self.confidence = confidence
-        if not helper_values:
-            self.helper_values = [[[0.5,0.5] for _ in range(im_width)] for _ in range(im_height)] # running total for P(w_i | L = 0) & P(w_i | L = 1)
-        else:
-            self.helper_values = helper_values
+    def __init__(self, imageID, likelihoods, confidence, helper_values, label, im_width, im_height, log_odds=None, mode: str=None, watermark: LabelWatermark=None):
         self.imageID = imageID
         self.label = label
         self.im_width = im_width
-        self.im_height = im_height
\ No newline at end of file
+        self.im_height = im_height
+        self.watermark = watermark if watermark else LabelWatermark()
+        self.pending_log_factors = np.zeros(2, dtype=np.float64)
+        if not mode:
+            mode = 'log_odds' if log_odds is not None else 'helper'
+        if mode not in ('helper', 'log_odds'):
+            raise ValueError(f"unknown ImageClassMeasure mode '{mode}'")
+
+        # contiguous float64 arrays are wrapped as is, anything else (lists, float16 buffers) is converted once
+        if confidence is None:
+            self.confidence = np.zeros((im_height, im_width), dtype=np.float64)
+        else:
+            self.confidence = np.ascontiguousarray(confidence, dtype=np.float64).reshape(im_height, im_width)
+
+        if mode == 'log_odds':
+            self.helper_values = None
+            if log_odds is None:
+                self.log_odds = np.zeros((im_height, im_width), dtype=np.float64) # even odds, same prior as helper values of 0.5/0.5
+            else:
+                self.log_odds = np.ascontiguousarray(log_odds, dtype=np.float64).reshape(im_height, im_width)
+            self._likelihoods = None
+            return
+
+        self.log_odds = None
+        if likelihoods is None:
+            self._likelihoods = np.full((im_height, im_width), 0.5, dtype=np.float64)
+        else:
+            self._likelihoods = np.ascontiguousarray(likelihoods, dtype=np.float64).reshape(im_height, im_width)
+        if helper_values is None:
+            self.helper_values = np.full((im_height, im_width, 2), 0.5, dtype=np.float64) # running total for P(w_i | L = 0) & P(w_i | L = 1)
+        else:
+            self.helper_values = np.ascontiguousarray(helper_values, dtype=np.float64).reshape(im_height, im_width, 2)
+
+    @property
+    def mode(self) -> str:
+        return 'helper' if self.log_odds is None else 'log_odds'
+
+    @property
+    def likelihoods(self) -> np.ndarray:
+        if self._likelihoods is None:
+            self.apply_pending()
+            if self.log_odds is not None:
+                # sigmoid written with tanh so large |log odds| cannot overflow
+                self._likelihoods = np.tanh(self.log_odds * 0.5)
+                self._likelihoods += 1
+                self._likelihoods *= 0.5
+            else:
+                self._likelihoods = self.helper_value_1 + self.helper_value_2
+                self._likelihoods += 1e-9
+                np.divide(self.helper_value_2, self._likelihoods, out=self._likelihoods)
+        return self._likelihoods
+
+    @likelihoods.setter
+    def likelihoods(self, likelihoods: np.ndarray):
+        self._likelihoods = np.ascontiguousarray(likelihoods, dtype=np.float64).reshape(self.im_height, self.im_width)
+
+    @property
+    def helper_value_1(self) -> np.ndarray:
+        # view of P(w_i | L = 0), writes go through to helper_values
+        return self.helper_values[..., 0]
+
+    @property
+    def helper_value_2(self) -> np.ndarray:
+        # view of P(w_i | L = 1), writes go through to helper_values
+        return self.helper_values[..., 1]
+
+    def add_log_odds(self, delta):
+        # single fused add per update, likelihoods are recomputed the next time they are read
+        self.log_odds += delta
+        self._likelihoods = None
+
+    def invalidate_likelihoods(self):
+        # call after writing to log_odds or helper_values directly
+        self._likelihoods = None
+
+    def add_pending(self, log_factor_1: float, log_factor_2: float):
+        # O(1) update of every pixel, folded into the planes by apply_pending
+        self.pending_log_factors += (log_factor_1, log_factor_2)
+        self._likelihoods = None
+
+    def apply_pending(self):
+        '''
+        Folds the pending whole image factors into log_odds or helper_values. Runs once before the planes
+        are read in full (likelihoods, persistence, full plane backends) rather than once per labeller
+        '''
+        if not self.pending_log_factors.any():
+            return
+        log_factor_1, log_factor_2 = self.pending_log_factors
+        if self.log_odds is not None:
+            self.log_odds += log_factor_2 - log_factor_1
+        else:
+            self.helper_values *= np.exp(self.pending_log_factors)
+        self.pending_log_factors[:] = 0
+        self._likelihoods = None
+
+    def to_log_odds(self):
+        '''
+        Switches a helper mode ICM to log_odds mode in place. Pixels whose helper values
+        underflowed to zero (common after float16 storage) fall back to the logit of the stored likelihood
+        '''
+        if self.log_odds is not None:
+            return
+        self.apply_pending()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_odds = np.log(self.helper_value_2) - np.log(self.helper_value_1)
+        likelihoods = np.clip(self.likelihoods, 1e-6, 1 - 1e-6)
+        fallback = ~np.isfinite(log_odds)
+        log_odds[fallback] = np.log(likelihoods[fallback]) - np.log1p(-likelihoods[fallback])
+
+        self.log_odds = log_odds
+        self.helper_values = None
+        self._likelihoods = None
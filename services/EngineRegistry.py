@@ -0,0 +1,151 @@
+import os
+import time
+import threading
+import urllib.parse
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# Config
+# ------------------------------------------------------------
+# every value can be overridden from the environment (.env is loaded on first use)
+POOL_SIZE = 5 # _DB_POOL_SIZE - connections kept open per DSN
+MAX_OVERFLOW = 10 # _DB_MAX_OVERFLOW - extra connections opened under load, closed on checkin
+POOL_TIMEOUT = 30 # _DB_POOL_TIMEOUT - seconds a checkout waits before raising
+POOL_RECYCLE = 3600 # _DB_POOL_RECYCLE - seconds before a connection is replaced, below MySQL's wait_timeout
+POOL_PRE_PING = True # _DB_POOL_PRE_PING - test connections on checkout so dropped ones are replaced
+# ------------------------------------------------------------
+
+_engines: dict[tuple, Engine] = {} # (url, pool_options) -> engine
+_lock = threading.Lock()
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    QueuePool that records how many checkouts it served and how long callers waited for them
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._depth = threading.local()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        # QueuePool._do_get calls itself when it loses a race for an overflow slot, only time the outer call
+        depth = getattr(self._depth, 'value', 0)
+        if depth:
+            return super()._do_get()
+
+        self._depth.value = 1
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            self._depth.value = 0
+        wait = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return conn
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'overflow': self.overflow(),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'avg_wait_ms': 1000 * self.total_wait / self.checkouts if self.checkouts else 0.0,
+                'max_wait_ms': 1000 * self.max_wait,
+            }
+
+
+def _env(name: str, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes')
+    return type(default)(value)
+
+
+def database_url(prefix: str = '_LABELDATABASE_MYSQL', user: str = 'USER', password: str = 'PASSWORD',
+                 host: str = 'HOST', port: str = 'PORT', database: str = 'DATABASE') -> str:
+    # DSN built from the {prefix}USER/PASSWORD/HOST/DATABASE (and optional PORT) variables
+    load_dotenv()
+    MYSQLUSER = os.getenv(f'{prefix}{user}')
+    MYSQLPASSWORD = os.getenv(f'{prefix}{password}')
+    MYSQLHOST = os.getenv(f'{prefix}{host}')
+    MYSQLPORT = os.getenv(f'{prefix}{port}')
+    MYSQLDATABASE = os.getenv(f'{prefix}{database}')
+    netloc = urllib.parse.quote_plus(str(MYSQLHOST)) + (f":{MYSQLPORT}" if MYSQLPORT else '')
+    return (f"mysql+pymysql://{urllib.parse.quote_plus(str(MYSQLUSER))}:{urllib.parse.quote_plus(str(MYSQLPASSWORD))}"
+            f"@{netloc}/{MYSQLDATABASE}")
+
+
+def get_engine(url: str = None, **pool_options) -> Engine:
+    '''
+    Returns the process wide engine for url (the label database by default), creating it on first use.
+    Creating an engine does not connect, connections are opened by the pool as they are checked out.
+    pool_options (pool_size, max_overflow, pool_timeout, ...) override the environment. Callers asking
+    for the same url and pool_options share one engine, different pool_options get a pool of their own
+    so no caller silently gets another caller's sizing
+    '''
+    if url is None:
+        url = database_url()
+    key = (url, tuple(sorted(pool_options.items())))
+    engine = _engines.get(key)
+    if engine is not None:
+        return engine
+
+    with _lock:
+        engine = _engines.get(key)
+        if engine is None:
+            load_dotenv()
+            options = {
+                'pool_size': _env('_DB_POOL_SIZE', POOL_SIZE),
+                'max_overflow': _env('_DB_MAX_OVERFLOW', MAX_OVERFLOW),
+                'pool_timeout': _env('_DB_POOL_TIMEOUT', POOL_TIMEOUT),
+                'pool_recycle': _env('_DB_POOL_RECYCLE', POOL_RECYCLE),
+                'pool_pre_ping': _env('_DB_POOL_PRE_PING', POOL_PRE_PING),
+            }
+            options.update(pool_options)
+            engine = create_engine(url, poolclass=TimedQueuePool, **options)
+            _engines[key] = engine
+    return engine
+
+
+def pool_stats() -> dict:
+    # checkout and wait statistics for every engine in the process, keyed by DSN without the password and
+    # the pool_options the engine was asked for
+    stats = {}
+    for (_, pool_options), engine in list(_engines.items()):
+        name = engine.url.render_as_string(hide_password=True)
+        if pool_options:
+            name += ' (' + ', '.join(f'{option}={value}' for option, value in pool_options) + ')'
+        stats[name] = engine.pool.stats()
+    return stats
+
+
+def _reset_after_fork():
+    # a forked worker must not reuse the parent's sockets, it opens its own on first checkout
+    global _lock
+    _lock = threading.Lock()
+    for engine in list(_engines.values()):
+        engine.dispose(close=False)
+    _engines.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
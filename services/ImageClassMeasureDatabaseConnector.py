@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import uuid
 import time
 import datetime
@@ -11,11 +11,11 @@ from pathlib import Path
 
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
-from services.DataTypes import ImageClassMeasure, Label
+from services.EngineRegistry import get_engine
+from services.DataTypes import ImageClassMeasure, Label, LabelWatermark
 import urllib.parse
 import pymysql
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 class ImageClassMeasureDatabaseConnector(ABC):
@@ -32,6 +32,10 @@ class ImageClassMeasureDatabaseConnector(ABC):
     def get_imageclassmeasures(self, query:str) -> list[ImageClassMeasure]:
         pass
 
+    @abstractmethod
+    def get_watermark(self, imageID:str, label:str) -> LabelWatermark:
+        pass
+
 class NoneDB(ImageClassMeasureDatabaseConnector):
 
 
@@ -46,37 +50,21 @@ class NoneDB(ImageClassMeasureDatabaseConnector):
     def get_imageclassmeasures(self, query:str) -> list[ImageClassMeasure]:
         pass
 
+
+    def get_watermark(self, imageID:str, label:str) -> LabelWatermark:
+        pass
+
 class MYSQLImageClassMeasureDatabaseConnector(ImageClassMeasureDatabaseConnector):
 
     def __init__(self, table:str='ImageClassMeasure'):
+        # the shared engine is looked up on first use, building a connector never touches the database
         self.cnx = None
-        self.make_db_connection()
         self.table=table
 
     def make_db_connection(self):
-        load_dotenv()
-        MYSQLUSER=os.getenv('_LABELDATABASE_MYSQLUSER')
-        MYSQLPASSWORD=os.getenv('_LABELDATABASE_MYSQLPASSWORD')
-        MYSQLHOST=os.getenv('_LABELDATABASE_MYSQLHOST')
-        MYSQLDATABASE=os.getenv('_LABELDATABASE_MYSQLDATABASE')
-
-        try:
-            self.cnx = create_engine(
-    url=f"mysql+pymysql://{str(MYSQLUSER)}:{urllib.parse.quote_plus(str(MYSQLPASSWORD))}"
-        f"@{urllib.parse.quote_plus(str(MYSQLHOST))}/{MYSQLDATABASE}"
-)
-                                            
-        except Exception as e:
-            print("Error {e}")
-            raise ConnectionError(e)
-        
-        if self.cnx:
-            try:
-                self.cnx.connect()
-                print('connection successful')
-            except Exception as e:
-                print("Error {e}")
-                raise ConnectionError(e)
+        # one engine per DSN is shared by every connector in the process, see services/EngineRegistry.py
+        if self.cnx is None:
+            self.cnx = get_engine()
 
 
     def push_imageclassmeasure(self, imageclassmeasure:ImageClassMeasure):
@@ -90,28 +78,33 @@ class MYSQLImageClassMeasureDatabaseConnector(ImageClassMeasureDatabaseConnector
             helpervalue_1 = VALUES(helpervalue_1),
             helpervalue_2 = VALUES(helpervalue_2);
         """)
+        imageclassmeasure.apply_pending()
 
 
 
+        self.make_db_connection()
         with self.cnx.connect() as connection:
             try:
                 # Collect all rows before executing the query
-                batch_data = []
-
-                for y in range(imageclassmeasure.im_height):
-                    for x in range(imageclassmeasure.im_width):
-                        batch_data.append({
+                ys, xs = np.indices((imageclassmeasure.im_height, imageclassmeasure.im_width))
+                batch_data = [{
                             "ImageID": imageclassmeasure.imageID,
                             "x": x,
                             "y": y,
                             "label": imageclassmeasure.label,
-                            "likelihood": imageclassmeasure.likelihoods[x][y],
-                            "confidence": imageclassmeasure.confidence[x][y],
-                            "helpervalue_1": imageclassmeasure.helper_values[x][y][0],
-                            "helpervalue_2": imageclassmeasure.helper_values[x][y][1],
+                            "likelihood": likelihood,
+                            "confidence": confidence,
+                            "helpervalue_1": helpervalue_1,
+                            "helpervalue_2": helpervalue_2,
                             "im_height": imageclassmeasure.im_height,
                             "im_width": imageclassmeasure.im_width
-                        })
+                        } for x, y, likelihood, confidence, helpervalue_1, helpervalue_2 in zip(
+                            xs.ravel().tolist(),
+                            ys.ravel().tolist(),
+                            imageclassmeasure.likelihoods.ravel().tolist(),
+                            imageclassmeasure.confidence.ravel().tolist(),
+                            imageclassmeasure.helper_value_1.ravel().tolist(),
+                            imageclassmeasure.helper_value_2.ravel().tolist())]
 
                 # Execute all at once using `executemany()`
                 connection.execute(query_imageclassmeasure_db, batch_data)
@@ -125,37 +118,51 @@ class MYSQLImageClassMeasureDatabaseConnector(ImageClassMeasureDatabaseConnector
     def push_imageclassmeasure_images(self, imageclassmeasure:ImageClassMeasure):
 
         query_imageclassmeasure_db = text("""
-            INSERT INTO ImageClassMeasure_images (ImageID, label, likelihood, confidence, helpervalue_1, helpervalue_2, im_height, im_width) 
-            VALUES (:ImageID, :label, :likelihood, :confidence, :helpervalue_1, :helpervalue_2, :im_height, :im_width)
+            INSERT INTO ImageClassMeasure_images (ImageID, label, likelihood, confidence, helpervalue_1, helpervalue_2, im_height, im_width, watermark) 
+            VALUES (:ImageID, :label, :likelihood, :confidence, :helpervalue_1, :helpervalue_2, :im_height, :im_width, :watermark)
             ON DUPLICATE KEY UPDATE 
             likelihood = VALUES(likelihood),
             confidence = VALUES(confidence),
             helpervalue_1 = VALUES(helpervalue_1),
-            helpervalue_2 = VALUES(helpervalue_2);
+            helpervalue_2 = VALUES(helpervalue_2),
+            watermark = VALUES(watermark);
         """)
 
+        # log odds ICMs keep a single accumulator plane, the helper columns are cleared (see sql/icm_log_odds.sql)
+        query_imageclassmeasure_log_odds_db = text("""
+            INSERT INTO ImageClassMeasure_images (ImageID, label, likelihood, confidence, helpervalue_1, helpervalue_2, im_height, im_width, log_odds, watermark) 
+            VALUES (:ImageID, :label, :likelihood, :confidence, NULL, NULL, :im_height, :im_width, :log_odds, :watermark)
+            ON DUPLICATE KEY UPDATE 
+            likelihood = VALUES(likelihood),
+            confidence = VALUES(confidence),
+            helpervalue_1 = NULL,
+            helpervalue_2 = NULL,
+            log_odds = VALUES(log_odds),
+            watermark = VALUES(watermark);
+        """)
 
-
+        # the stored planes must include any whole image factors still pending on the ICM
+        imageclassmeasure.apply_pending()
+        self.make_db_connection()
         with self.cnx.connect() as connection:
-            helper_values_1 = [[pixel[0] for pixel in row] for row in imageclassmeasure.helper_values]
-            helper_values_2 = [[pixel[1] for pixel in row] for row in imageclassmeasure.helper_values]
-
             try:
-                # plt.imshow(np.array(imageclassmeasure.confidence, dtype=np.float16))
-                # plt.savefig("temp.jpeg")
                 data = {
                             "ImageID": imageclassmeasure.imageID,
                             "label": imageclassmeasure.label,
-                            "likelihood": np.array(imageclassmeasure.likelihoods, dtype=np.float16).tobytes(),
-                            "confidence": np.array(imageclassmeasure.confidence, dtype=np.float16).tobytes(),
-                            "helpervalue_1":np.array(helper_values_1, dtype=np.float16).tobytes(),
-                            "helpervalue_2":np.array(helper_values_2, dtype=np.float16).tobytes(),
+                            "likelihood": imageclassmeasure.likelihoods.astype(np.float16).tobytes(),
+                            "confidence": imageclassmeasure.confidence.astype(np.float16).tobytes(),
                             "im_height": imageclassmeasure.im_height,
-                            "im_width": imageclassmeasure.im_width
+                            "im_width": imageclassmeasure.im_width,
+                            "watermark": imageclassmeasure.watermark.to_json()
                         }
 
-
-                connection.execute(query_imageclassmeasure_db, data)
+                if imageclassmeasure.mode == 'log_odds':
+                    data["log_odds"] = imageclassmeasure.log_odds.astype(np.float16).tobytes()
+                    connection.execute(query_imageclassmeasure_log_odds_db, data)
+                else:
+                    data["helpervalue_1"] = imageclassmeasure.helper_value_1.astype(np.float16).tobytes()
+                    data["helpervalue_2"] = imageclassmeasure.helper_value_2.astype(np.float16).tobytes()
+                    connection.execute(query_imageclassmeasure_db, data)
                 
                 connection.commit()
                 print("Query successful")
@@ -163,6 +170,34 @@ class MYSQLImageClassMeasureDatabaseConnector(ImageClassMeasureDatabaseConnector
                 print(f"Error: {e}")
                 raise Exception(e)
             
+    def migrate_imageclassmeasures_images_to_log_odds(self) -> int:
+        '''
+        Converts every helper value ImageClassMeasure_images row to a single log odds plane.
+        Rows are loaded and rewritten one at a time so memory stays at one ICM. Returns the number of rows converted
+        '''
+        self.make_db_connection()
+        query_keys = text("""
+            SELECT ImageID, label FROM ImageClassMeasure_images WHERE log_odds IS NULL;
+        """)
+
+        with self.cnx.connect() as connection:
+            try:
+                keys = [(res[0], res[1]) for res in connection.execute(query_keys)]
+            except Exception as e:
+                print(f"Error: {e}")
+                raise Exception(e)
+
+        converted = 0
+        for imageID, label in keys:
+            icm = self.get_imageclassmeasures_images(
+                f"SELECT * FROM ImageClassMeasure_images Where ImageID = '{imageID}' and Label = '{label}';")
+            if not icm:
+                continue
+            icm.to_log_odds()
+            self.push_imageclassmeasure_images(icm)
+            converted += 1
+        print(f"converted {converted} ICMs to log odds")
+        return converted
 
     def get_imageclassmeasures(self, query:str) -> ImageClassMeasure:
         # --only request one object at a time please 😭🙏--
@@ -202,17 +237,11 @@ class MYSQLImageClassMeasureDatabaseConnector(ImageClassMeasureDatabaseConnector
             
             print(imageID)
 
-            likelihoods_ordered = [[0.5] * im_width for _ in range(im_height)]
-            confidence_ordered = [[0.0] * im_width for _ in range(im_height)]
-            helper_values_ordered = [[[0.5,0.5] for _ in range(im_width)] for _ in range(im_height)]
-
-            for i in range(im_height*im_width):
-                likelihoods_ordered[y[i]][x[i]] =  likelihoods[i]
-                confidence_ordered[y[i]][x[i]] = confidences[i]
-                helper_values_ordered[y[i]][x[i]][0] = helpervalue_1[i]
-                helper_values_ordered[y[i]][x[i]][1] = helpervalue_2[i]
-            
-        icm = ImageClassMeasure(imageID, likelihoods_ordered, confidence_ordered, helper_values_ordered, label, im_width, im_height)
+        icm = ImageClassMeasure(imageID, None, None, None, label, im_width, im_height)
+        icm.likelihoods[y, x] = likelihoods
+        icm.confidence[y, x] = confidences
+        icm.helper_value_1[y, x] = helpervalue_1
+        icm.helper_value_2[y, x] = helpervalue_2
         return icm
     
     def get_imageclassmeasures_images(self, query:str) -> ImageClassMeasure:
@@ -225,6 +254,8 @@ class MYSQLImageClassMeasureDatabaseConnector(ImageClassMeasureDatabaseConnector
         confidence = None
         helper_value_1 = None
         helper_value_2 = None
+        log_odds = None
+        watermark = None
         im_height = 0
         im_width = 0
         with self.cnx.connect() as connection:
@@ -238,11 +269,16 @@ class MYSQLImageClassMeasureDatabaseConnector(ImageClassMeasureDatabaseConnector
                     label = res[1]
                     im_height = res[6]
                     im_width = res[7]
-                    likelihoods = np.frombuffer(res[2], dtype=np.float16).reshape((im_height, im_width, 1)).tolist()
-                    confidence= np.frombuffer(res[3], dtype=np.float16).reshape((im_height, im_width, 1)).tolist()
-                    helper_value_1 = np.frombuffer(res[4], dtype=np.float16).reshape((im_height, im_width, 1))
-                    helper_value_2 = np.frombuffer(res[5], dtype=np.float16).reshape((im_height, im_width, 1))
-                    
+                    likelihoods = np.frombuffer(res[2], dtype=np.float16).reshape((im_height, im_width))
+                    confidence = np.frombuffer(res[3], dtype=np.float16).reshape((im_height, im_width))
+                    # columns added by later migrations are looked up by name, SELECT * order depends on which ran
+                    watermark = LabelWatermark.from_json(res._mapping.get('watermark'))
+                    if res._mapping.get('log_odds') is not None:
+                        log_odds = np.frombuffer(res._mapping['log_odds'], dtype=np.float16).reshape((im_height, im_width))
+                    else:
+                        helper_value_1 = np.frombuffer(res[4], dtype=np.float16).reshape((im_height, im_width))
+                        helper_value_2 = np.frombuffer(res[5], dtype=np.float16).reshape((im_height, im_width))
+
 
             except Exception as e:
                 print("Error {e}")
@@ -250,12 +286,28 @@ class MYSQLImageClassMeasureDatabaseConnector(ImageClassMeasureDatabaseConnector
             
             print(imageID)
 
-            helper_values = np.stack((helper_value_1.reshape(im_width, im_height), helper_value_2.reshape(im_width, im_height)), axis=-1).tolist()
+        if log_odds is not None:
+            return ImageClassMeasure(imageID, None, confidence, None, label, im_width, im_height, log_odds=log_odds, watermark=watermark)
 
-            
-            
-        icm = ImageClassMeasure(imageID, likelihoods, confidence, helper_values, label, im_width, im_height)
+        # float16 blobs are widened straight into the ICM planes, no python lists in between
+        helper_values = np.stack((helper_value_1, helper_value_2), axis=-1, dtype=np.float64)
+        icm = ImageClassMeasure(imageID, likelihoods, confidence, helper_values, label, im_width, im_height, watermark=watermark)
         return icm
+
+    def get_watermark(self, imageID:str, label:str) -> LabelWatermark:
+        # reads only the watermark so callers can skip an image without loading its planes
+        self.make_db_connection()
+        query = text("""
+            SELECT watermark FROM ImageClassMeasure_images WHERE ImageID = :ImageID and label = :label;
+        """)
+
+        with self.cnx.connect() as connection:
+            try:
+                res = connection.execute(query, {"ImageID": imageID, "label": label}).first()
+            except Exception as e:
+                print(f"Error: {e}")
+                raise Exception(e)
+        return LabelWatermark.from_json(res[0] if res else None)
             
             
     
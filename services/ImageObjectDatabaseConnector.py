@@ -1,7 +1,9 @@
 from abc import ABC, abstractmethod
+from typing import Iterator
+import argparse
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import uuid
 import time
 import datetime
@@ -11,10 +13,18 @@ from pathlib import Path
 
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
+from services.EngineRegistry import get_engine
 from services.DataTypes import ImageObject, Label
+from services.RegionEncoding import encode_pixels, decode_pixels, mask_header
 import urllib.parse
 import pymysql
 
+# Config
+# ------------------------------------------------------------
+PAGE_SIZE = 1000 # objects read per page, their labels and pixels are fetched together
+IN_CHUNK_SIZE = 1000 # ids per IN (...) lookup
+MIGRATION_BATCH = 500 # objects converted per transaction by migrate_pixel_rows
+# ------------------------------------------------------------
 
 class ImageObjectDatabaseConnector(ABC):
 
@@ -27,7 +37,11 @@ class ImageObjectDatabaseConnector(ABC):
         pass
 
     @abstractmethod
-    def get_imageobjects(self, query:str) -> list[ImageObject]:
+    def get_imageobjects(self, query:str, data:dict=None) -> list[ImageObject]:
+        pass
+
+    @abstractmethod
+    def iter_imageobjects(self, query:str, data:dict=None, page_size:int=PAGE_SIZE) -> Iterator[ImageObject]:
         pass
 
 class NoneDB(ImageObjectDatabaseConnector):
@@ -41,40 +55,24 @@ class NoneDB(ImageObjectDatabaseConnector):
         pass
 
 
-    def get_imageobjects(self, query:str) -> list[ImageObject]:
+    def get_imageobjects(self, query:str, data:dict=None) -> list[ImageObject]:
         pass
 
+
+    def iter_imageobjects(self, query:str, data:dict=None, page_size:int=PAGE_SIZE) -> Iterator[ImageObject]:
+        return iter([])
+
 class MYSQLImageObjectDatabaseConnector(ImageObjectDatabaseConnector):
 
     def __init__(self, table:str='ImageObjects'):
+        # the shared engine is looked up on first use, building a connector never touches the database
         self.cnx = None
-        self.make_db_connection()
         self.table=table
 
     def make_db_connection(self):
-        load_dotenv()
-        MYSQLUSER=os.getenv('_LABELDATABASE_MYSQLUSER')
-        MYSQLPASSWORD=os.getenv('_LABELDATABASE_MYSQLPASSWORD')
-        MYSQLHOST=os.getenv('_LABELDATABASE_MYSQLHOST')
-        MYSQLDATABASE=os.getenv('_LABELDATABASE_MYSQLDATABASE')
-
-        try:
-            self.cnx = create_engine(
-    url=f"mysql+pymysql://{str(MYSQLUSER)}:{urllib.parse.quote_plus(str(MYSQLPASSWORD))}"
-        f"@{urllib.parse.quote_plus(str(MYSQLHOST))}/{MYSQLDATABASE}"
-)
-                                            
-        except Exception as e:
-            print("Error {e}")
-            raise ConnectionError(e)
-        
-        if self.cnx:
-            try:
-                self.cnx.connect()
-                print('connection successful')
-            except Exception as e:
-                print("Error {e}")
-                raise ConnectionError(e)
+        # one engine per DSN is shared by every connector in the process, see services/EngineRegistry.py
+        if self.cnx is None:
+            self.cnx = get_engine()
 
 
     def push_imageobject(self, imageobject:ImageObject):
@@ -86,9 +84,13 @@ class MYSQLImageObjectDatabaseConnector(ImageObjectDatabaseConnector):
             Confidence = VALUES(Confidence);
         """)
 
+        # the pixels are stored as one packed mask, see services/RegionEncoding.py and sql/imageobject_masks.sql
         query_related_pixels = text("""
-            INSERT IGNORE INTO Pixels_in_ImageObject (ImageObjectID, x, y) 
-            VALUES (:ImageObjectID, :x, :y);
+            INSERT INTO ImageObject_masks (ImageObjectID, x_min, y_min, width, height, num_pixels, mask)
+            VALUES (:ImageObjectID, :x_min, :y_min, :width, :height, :num_pixels, :mask)
+            ON DUPLICATE KEY UPDATE
+            x_min = VALUES(x_min), y_min = VALUES(y_min), width = VALUES(width), height = VALUES(height),
+            num_pixels = VALUES(num_pixels), mask = VALUES(mask);
         """)
 
         query_related_labels = text("""
@@ -97,6 +99,7 @@ class MYSQLImageObjectDatabaseConnector(ImageObjectDatabaseConnector):
         """)
 
 
+        self.make_db_connection()
         with self.cnx.connect() as connection:
             try:
                 data_imageobject_db = {
@@ -108,19 +111,14 @@ class MYSQLImageObjectDatabaseConnector(ImageObjectDatabaseConnector):
 
                 connection.execute(query_imageobject_db, data_imageobject_db)
 
-                for pixel in imageobject.related_pixels:
-                    data_related_pixels = {
-                        "ImageObjectID": imageobject.ImageObjectID,
-                        "x": pixel[0],
-                        "y": pixel[1],
-                    }   
-                    connection.execute(query_related_pixels, data_related_pixels)
+                if len(imageobject.related_pixels):
+                    connection.execute(query_related_pixels, mask_row(imageobject.ImageObjectID, imageobject.related_pixels))
 
-                for label in imageobject.related_labels:
-                    data_related_labels = {
+                if imageobject.related_labels:
+                    data_related_labels = [{
                         "ImageObjectID": imageobject.ImageObjectID,
                         "LabelID": label.LabelID
-                    }   
+                    } for label in imageobject.related_labels]
                     connection.execute(query_related_labels, data_related_labels)
 
                 connection.commit()
@@ -129,81 +127,156 @@ class MYSQLImageObjectDatabaseConnector(ImageObjectDatabaseConnector):
                 print("Error {e}")
                 raise Exception(e)
 
-    def get_imageobjects(self, query:str) -> list[ImageObject]:
-        self.make_db_connection()
+    def get_imageobjects(self, query:str, data:dict=None) -> list[ImageObject]:
+        return list(self.iter_imageobjects(query, data))
 
-        ImageObjects = []
-        ImageObjectIDs = []
-        ImageIDs= []
-        Classes = []
-        Confidences = []
-        with self.cnx.connect() as connection:
+    def iter_imageobjects(self, query:str, data:dict=None, page_size:int=PAGE_SIZE) -> Iterator[ImageObject]:
+        '''
+        Streams the objects selected by query (ImageObjectID, ImageID, Class, Confidence first). Object rows
+        are read over a server side cursor in pages of page_size, the labels and pixels of a page are
+        fetched with one IN (...) query each and attached in memory
+        '''
+        self.make_db_connection()
+        with self.cnx.connect() as stream, self.cnx.connect() as connection:
             try:
-                result = connection.execute(text(query))
-                print(f"Query returned {result.rowcount} results") 
-                for res in result:
-                    ImageObjectIDs.append(res[0])
-                    ImageIDs.append(res[1])
-                    Classes.append(res[2])
-                    Confidences.append(res[3])
+                result = stream.execution_options(stream_results=True).execute(text(query), data if data else {})
+                while True:
+                    rows = result.fetchmany(page_size)
+                    if not rows:
+                        break
+                    ids = [res[0] for res in rows]
+                    labels = self.get_labels_for_imageobjects(ids, connection)
+                    pixels = self.get_pixels_for_imageobjects(ids, connection)
+                    for res in rows:
+                        yield ImageObject(res[0], res[1], res[2], res[3], pixels.get(res[0], []), labels.get(res[0], []))
             except Exception as e:
                 print("Error {e}")
                 raise Exception(e)
-            
-            print(ImageObjectIDs)
-
-            # --- get label ids and ---
 
-            query_label_ids = text("""
-                                SELECT * FROM Labels WHERE LabelID in 
-                                (SELECT LabelID FROM my_image_db.Labels_ImageObjects WHERE ImageObjectID = :imageobjectid);
-                                   """)
-            query_pixels = text("""SELECT x,y FROM Pixels_in_ImageObject WHERE ImageObjectID = :imageobjectid;
-                                """)
+    def get_labels_for_imageobjects(self, ids:list, connection) -> dict[str, list[Label]]:
+        # related labels of every object in ids, keyed by ImageObjectID
+        query = text("""
+            SELECT lio.ImageObjectID, l.* FROM Labels_ImageObjects lio
+            JOIN Labels l ON l.LabelID = lio.LabelID
+            WHERE lio.ImageObjectID IN :ids;
+        """)
+        labels = {}
+        for start in range(0, len(ids), IN_CHUNK_SIZE):
+            result = connection.execute(query, {'ids': tuple(ids[start:start + IN_CHUNK_SIZE])})
+            for res in result:
+                labels.setdefault(res[0], []).append(label_from_row(res[1:]))
+        return labels
+
+    def get_pixels_for_imageobjects(self, ids:list, connection) -> dict[str, list[list[int]]]:
+        # related pixels of every object in ids, keyed by ImageObjectID. Objects stored before the packed
+        # masks are read from their Pixels_in_ImageObject rows until migrate_pixel_rows converts them
+        query_masks = text("""
+            SELECT ImageObjectID, mask FROM ImageObject_masks WHERE ImageObjectID IN :ids;
+        """)
+        query_legacy = text("""
+            SELECT ImageObjectID, x, y FROM Pixels_in_ImageObject WHERE ImageObjectID IN :ids;
+        """)
+        pixels = {}
+        for start in range(0, len(ids), IN_CHUNK_SIZE):
+            result = connection.execute(query_masks, {'ids': tuple(ids[start:start + IN_CHUNK_SIZE])})
+            for res in result:
+                pixels[res[0]] = decode_pixels(res[1]).tolist()
+
+        legacy = [id for id in ids if id not in pixels]
+        for start in range(0, len(legacy), IN_CHUNK_SIZE):
+            result = connection.execute(query_legacy, {'ids': tuple(legacy[start:start + IN_CHUNK_SIZE])})
+            for res in result:
+                pixels.setdefault(res[0], []).append([res[1], res[2]])
+        return pixels
+
+    def migrate_pixel_rows(self, batch_size:int=MIGRATION_BATCH) -> int:
+        '''
+        Converts the per pixel Pixels_in_ImageObject rows into ImageObject_masks blobs, batch_size objects
+        per transaction, deleting the rows of each converted object. Safe to interrupt and run again.
+        Returns the number of objects converted
+        '''
+        query_ids = text("""
+            SELECT DISTINCT ImageObjectID FROM Pixels_in_ImageObject LIMIT :batch_size;
+        """)
+        query_pixels = text("""
+            SELECT ImageObjectID, x, y FROM Pixels_in_ImageObject WHERE ImageObjectID IN :ids;
+        """)
+        query_insert = text("""
+            INSERT IGNORE INTO ImageObject_masks (ImageObjectID, x_min, y_min, width, height, num_pixels, mask)
+            VALUES (:ImageObjectID, :x_min, :y_min, :width, :height, :num_pixels, :mask);
+        """)
+        query_delete = text("""
+            DELETE FROM Pixels_in_ImageObject WHERE ImageObjectID IN :ids;
+        """)
 
+        self.make_db_connection()
+        converted = 0
+        with self.cnx.connect() as connection:
             try:
-                for i , id in enumerate(ImageObjectIDs):
-                    data = {"imageobjectid": id}
-                    labels = self.get_labels(query_label_ids, data)
-                    pixels = []
-                    result = connection.execute(query_pixels, data)
-                    for res in result:
-                        pixels.append([res[0], res[1]])
-                    ImageObjects.append(ImageObject(id, ImageIDs[i], Classes[i], Confidences[i], pixels.copy(), labels.copy()))
+                while True:
+                    with connection.begin():
+                        ids = tuple(res[0] for res in connection.execute(query_ids, {'batch_size': batch_size}))
+                        if not ids:
+                            break
+                        pixels = {}
+                        for res in connection.execute(query_pixels, {'ids': ids}):
+                            pixels.setdefault(res[0], []).append((res[1], res[2]))
+                        # an object that already has a mask keeps it, its legacy rows are only dropped
+                        connection.execute(query_insert, [mask_row(id, pixels[id]) for id in ids])
+                        connection.execute(query_delete, {'ids': ids})
+                    converted += len(ids)
+                    print(f"converted {converted} objects")
             except Exception as e:
                 print("Error {e}")
                 raise Exception(e)
-            
-        return ImageObjects
-            
-            
-    
+        return converted
+
     def get_labels(self, query:str, data) -> list[Label]:
         self.make_db_connection()
-        results = []
         with self.cnx.connect() as connection:
             try:
                 result = connection.execute(query, data)
                 print(f"Query returned {result.rowcount} results")
-                for res in result:
-                    l = Label(
-                        LabelID=res[0],
-                        LabellerID=res[1],
-                        ImageID=res[2],
-                        Class=res[4],
-                        top_left_x=res[5],
-                        top_left_y=res[6],
-                        bot_right_x=res[7],
-                        bot_right_y=res[8],
-                        offset_x=res[9],
-                        offset_y=res[10]
-                    )
-                    results.append(l)
-                return results
+                return [label_from_row(res) for res in result]
             except Exception as e:
                 print("Error {e}")
                 raise Exception(e)        
 
+
+def mask_row(imageobjectID:str, pixels) -> dict:
+    # ImageObject_masks row for a list or (N, 2) array of [x, y] pixels
+    mask = encode_pixels(pixels)
+    return {"ImageObjectID": imageobjectID, "mask": mask, **mask_header(mask)}
+
+
+def label_from_row(res) -> Label:
+    # Label from a SELECT * FROM Labels row
+    return Label(
+        LabelID=res[0],
+        LabellerID=res[1],
+        ImageID=res[2],
+        Class=res[4],
+        top_left_x=res[5],
+        top_left_y=res[6],
+        bot_right_x=res[7],
+        bot_right_y=res[8],
+        offset_x=res[9],
+        offset_y=res[10]
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='maintenance of the image object tables')
+    parser.add_argument('--migrate-pixels', action='store_true', help='convert Pixels_in_ImageObject rows into ImageObject_masks')
+    parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH)
+    args = parser.parse_args()
+
+    if args.migrate_pixels:
+        MYSQLImageObjectDatabaseConnector().migrate_pixel_rows(args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
+
     
 # LD = MYSQLImageObjectDatabaseConnector()       
 
@@ -1,12 +1,20 @@
 from abc import ABC, abstractmethod
+from typing import Iterator
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import uuid
 import time
 import datetime
 import json
-from DataTypes import ImageObject_bb, Label
+import sys
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from services.EngineRegistry import get_engine
+from services.DataTypes import ImageObject_bb, Label
+from services.ImageObjectDatabaseConnector import label_from_row, PAGE_SIZE
 import urllib.parse
 import pymysql
 
@@ -22,7 +30,15 @@ class ImageObjectDatabaseConnector_bb(ABC):
         pass
 
     @abstractmethod
-    def get_imageobjects(self, query:str) -> list[ImageObject_bb]:
+    def replace_imageobjects(self, imageID:str, Class:str, imageobjects:list[ImageObject_bb]):
+        pass
+
+    @abstractmethod
+    def get_imageobjects(self, query:str, data:dict=None) -> list[ImageObject_bb]:
+        pass
+
+    @abstractmethod
+    def iter_imageobjects(self, query:str, data:dict=None, page_size:int=PAGE_SIZE) -> Iterator[ImageObject_bb]:
         pass
 
 class NoneDB(ImageObjectDatabaseConnector_bb):
@@ -36,37 +52,28 @@ class NoneDB(ImageObjectDatabaseConnector_bb):
         pass
 
 
-    def get_imageobjects(self, query:str) -> list[ImageObject_bb]:
+    def replace_imageobjects(self, imageID:str, Class:str, imageobjects:list[ImageObject_bb]):
+        pass
+
+
+    def get_imageobjects(self, query:str, data:dict=None) -> list[ImageObject_bb]:
         pass
 
+
+    def iter_imageobjects(self, query:str, data:dict=None, page_size:int=PAGE_SIZE) -> Iterator[ImageObject_bb]:
+        return iter([])
+
 class MYSQLImageObjectDatabaseConnector_bb(ImageObjectDatabaseConnector_bb):
 
     def __init__(self, table:str='ImageObjects'):
+        # the shared engine is looked up on first use, building a connector never touches the database
         self.cnx = None
-        self.make_db_connection()
         self.table=table
 
     def make_db_connection(self):
-        load_dotenv()
-        MYSQLUSER=os.getenv('_LABELDATABASE_MYSQLUSER')
-        MYSQLPASSWORD=os.getenv('_LABELDATABASE_MYSQLPASSWORD')
-        MYSQLHOST=os.getenv('_LABELDATABASE_MYSQLHOST')
-        MYSQLDATABASE=os.getenv('_LABELDATABASE_MYSQLDATABASE')
-
-        try:
-            self.cnx = create_engine(url=f"mysql+pymysql://{MYSQLUSER}:{urllib.parse.quote_plus(MYSQLPASSWORD)}@{urllib.parse.quote_plus(MYSQLHOST)}/{MYSQLDATABASE}")
-                                            
-        except Exception as e:
-            print("Error {e}")
-            raise ConnectionError(e)
-        
-        if self.cnx:
-            try:
-                self.cnx.connect()
-                print('connection successful')
-            except Exception as e:
-                print("Error {e}")
-                raise ConnectionError(e)
+        # one engine per DSN is shared by every connector in the process, see services/EngineRegistry.py
+        if self.cnx is None:
+            self.cnx = get_engine()
 
 
     def push_imageobject(self, imageobject:ImageObject_bb):
@@ -84,6 +91,7 @@ class MYSQLImageObjectDatabaseConnector_bb(ImageObjectDatabaseConnector_bb):
         """)
 
 
+        self.make_db_connection()
         with self.cnx.connect() as connection:
             try:
                 data_imageobject_db = {
@@ -106,74 +114,75 @@ class MYSQLImageObjectDatabaseConnector_bb(ImageObjectDatabaseConnector_bb):
                 print("Error {e}")
                 raise Exception(e)
 
-    def get_imageobjects(self, query:str) -> list[ImageObject_bb]:
-        self.make_db_connection()
+    def replace_imageobjects(self, imageID:str, Class:str, imageobjects:list[ImageObject_bb]):
+        '''
+        Replaces every object of an (image, class) with imageobjects in one transaction: the objects of the
+        previous run are deleted and the new ones written with one executemany, so readers see either the
+        old or the new result set
+        '''
+        query_delete = text("""
+            DELETE FROM ImageObjects_bb WHERE ImageID = :ImageID AND Class = :Class;
+        """)
+
+        query_imageobject_db = text("""
+            INSERT INTO ImageObjects_bb (ImageObjectID, ImageID, Class, Confidence, top_left_x, top_left_y, bot_right_x, bot_right_y) 
+            VALUES (:ImageObjectID, :ImageID, :Class, :Confidence, :top_left_x, :top_left_y, :bot_right_x, :bot_right_y)
+            ON DUPLICATE KEY UPDATE 
+            Confidence = VALUES(Confidence);
+        """)
+
+        data_imageobject_db = [{
+            "ImageObjectID": imageobject.ImageObjectID,
+            "ImageID": imageID,
+            "Class": Class,
+            "Confidence": imageobject.Confidence,
+            "top_left_x": imageobject.top_left_x,
+            "top_left_y": imageobject.top_left_y,
+            "bot_right_x": imageobject.bot_right_x,
+            "bot_right_y": imageobject.bot_right_y,
+        } for imageobject in imageobjects]
 
-        ImageObjects = []
-        ImageObjectIDs = []
-        ImageIDs= []
-        Classes = []
-        Confidences = []
-        coords = []
+        self.make_db_connection()
         with self.cnx.connect() as connection:
             try:
-                result = connection.execute(text(query))
-                print(f"Query returned {result.rowcount} results") 
-                for res in result:
-                    ImageObjectIDs.append(res[0])
-                    ImageIDs.append(res[1])
-                    Classes.append(res[2])
-                    Confidences.append(res[3])
-                    coords.append([res[4],res[5],res[6],res[7]])
+                with connection.begin():
+                    connection.execute(query_delete, {"ImageID": imageID, "Class": Class})
+                    if data_imageobject_db:
+                        connection.execute(query_imageobject_db, data_imageobject_db)
+                print(f"replaced objects of {imageID} {Class} with {len(data_imageobject_db)} objects")
             except Exception as e:
                 print("Error {e}")
                 raise Exception(e)
-            
-            print(ImageObjectIDs)
-
-            # --- get label ids and ---
 
-            query_label_ids = text("""
-                                SELECT * FROM Labels WHERE LabelID in 
-                                (SELECT LabelID FROM my_image_db.Labels_ImageObjects WHERE ImageObjectID = :imageobjectid);
-                                   """)
-            
+    def get_imageobjects(self, query:str, data:dict=None) -> list[ImageObject_bb]:
+        return list(self.iter_imageobjects(query, data))
 
+    def iter_imageobjects(self, query:str, data:dict=None, page_size:int=PAGE_SIZE) -> Iterator[ImageObject_bb]:
+        '''
+        Streams the objects selected by query (ImageObjectID, ImageID, Class, Confidence and the four box
+        coordinates first) over a server side cursor, page_size rows at a time
+        '''
+        self.make_db_connection()
+        with self.cnx.connect() as connection:
             try:
-                for i , id in enumerate(ImageObjectIDs):
-                    data = {"imageobjectid": id}
-                    labels = self.get_labels(query_label_ids, data)
-                    ImageObjects.append(ImageObject_bb(id, ImageIDs[i], Classes[i], Confidences[i], coords[i][0],coords[i][1],coords[i][2],coords[i][3], ))
+                result = connection.execution_options(stream_results=True).execute(text(query), data if data else {})
+                while True:
+                    rows = result.fetchmany(page_size)
+                    if not rows:
+                        break
+                    for res in rows:
+                        yield ImageObject_bb(res[0], res[1], res[2], res[3], res[4], res[5], res[6], res[7])
             except Exception as e:
                 print("Error {e}")
                 raise Exception(e)
-            
-        return ImageObjects
-            
-            
-    
+
     def get_labels(self, query:str, data) -> list[Label]:
         self.make_db_connection()
-        results = []
         with self.cnx.connect() as connection:
             try:
                 result = connection.execute(query, data)
                 print(f"Query returned {result.rowcount} results")
-                for res in result:
-                    l = Label(
-                        LabelID=res[0],
-                        LabellerID=res[1],
-                        ImageID=res[2],
-                        Class=res[4],
-                        top_left_x=res[5],
-                        top_left_y=res[6],
-                        bot_right_x=res[7],
-                        bot_right_y=res[8],
-                        offset_x=res[9],
-                        offset_y=res[10]
-                    )
-                    results.append(l)
-                return results
+                return [label_from_row(res) for res in result]
             except Exception as e:
                 print("Error {e}")
                 raise Exception(e)        
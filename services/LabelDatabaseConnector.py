@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import uuid
 import time
 import datetime
@@ -11,8 +11,10 @@ from pathlib import Path
 
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
+from services.EngineRegistry import get_engine
 
 from services.DataTypes import Label
+from services.ProjectStatsDatabaseConnector import ProjectStatsDatabaseConnector, MYSQLProjectStatsDatabaseConnector
 import urllib.parse
 import pymysql
 
@@ -27,10 +29,18 @@ class LabelDatabaseConnector(ABC):
     def push_label(self, label:Label):
         pass
 
+    @abstractmethod
+    def push_labels_batch(self, labels_batch: list[Label], chunk_size: int=1000):
+        pass
+
     @abstractmethod
     def get_labels(self, query:str) -> list[Label]:
         pass
 
+    @abstractmethod
+    def get_labels_with_data(self, query:str, data) -> list[Label]:
+        pass
+
 class NoneDB(LabelDatabaseConnector):
 
 
@@ -42,66 +52,41 @@ class NoneDB(LabelDatabaseConnector):
         pass
 
 
+    def push_labels_batch(self, labels_batch: list[Label], chunk_size: int=1000):
+        pass
+
+
     def get_labels(self, query:str) -> list[Label]:
         pass
 
+
+    def get_labels_with_data(self, query:str, data) -> list[Label]:
+        pass
+
 class MYSQLLabelDatabaseConnector(LabelDatabaseConnector):
 
-    def __init__(self, table:str='Labels'):
+    def __init__(self, table:str='Labels', stats_db: ProjectStatsDatabaseConnector=None):
+        # the shared engine is looked up on first use, building a connector never touches the database
+        # stats_db counters are updated in the same transaction as every label write, pass a NoneDB to skip them
         self.cnx = None
-        self.make_db_connection()
         self.table=table
+        self.stats_db = stats_db if stats_db else MYSQLProjectStatsDatabaseConnector()
 
     def make_db_connection(self):
-        load_dotenv()
-        MYSQLUSER=os.getenv('_LABELDATABASE_MYSQLUSER')
-        MYSQLPASSWORD=os.getenv('_LABELDATABASE_MYSQLPASSWORD')
-        MYSQLHOST=os.getenv('_LABELDATABASE_MYSQLHOST')
-        MYSQLDATABASE=os.getenv('_LABELDATABASE_MYSQLDATABASE')
-
-        try:
-            self.cnx = create_engine(
-    url=f"mysql+pymysql://{str(MYSQLUSER)}:{urllib.parse.quote_plus(str(MYSQLPASSWORD))}"
-        f"@{urllib.parse.quote_plus(str(MYSQLHOST))}/{MYSQLDATABASE}"
-)
-                                            
-        except Exception as e:
-            print("Error {e}")
-            raise ConnectionError(e)
-        
-        if self.cnx:
-            try:
-                self.cnx.connect()
-                print('connection successful')
-            except Exception as e:
-                print("Error {e}")
-                raise ConnectionError(e)
+        # one engine per DSN is shared by every connector in the process, see services/EngineRegistry.py
+        if self.cnx is None:
+            self.cnx = get_engine()
 
 
     def push_label(self, label:Label):
-        self.make_db_connection()
-        with self.cnx.connect() as connection:
-            try:
-                result = connection.execute(
-                    text(f"""INSERT INTO {self.table} VALUES { label.LabelID,
-                                                               label.LabellerID, 
-                                                               label.ImageID,
-                                                               label.Class,
-                                                               label.top_left_x if label.top_left_x else 'NULL',
-                                                               label.top_left_y if label.top_left_y else 'NULL',
-                                                               label.bot_right_x if label.bot_right_x else 'NULL',
-                                                               label.bot_right_y if label.bot_right_y else 'NULL',
-                                                               label.offset_x if label.offset_x else 'NULL',
-                                                               label.offset_y if label.offset_y else 'NULL',
-                                                               label.creation_time,
-                                                               label.origImageID}""")
-                )
-                connection.commit()
-                print(f"Query sucessful")
-            except Exception as e:
-                print("Error {e}")
-                raise Exception(e)
-    def push_labels_batch(self, labels_batch: list):
+        # single labels take the batch path so they are parameterized and counted in the project stats
+        self.push_labels_batch([label])
+
+    def push_labels_batch(self, labels_batch: list[Label], chunk_size: int=1000):
+        '''
+        Upserts every label in one transaction. Each chunk is a single executemany, which pymysql sends
+        as one multi-row INSERT, so a request costs one round trip per chunk and a single commit
+        '''
         query = text("""
             INSERT INTO Labels 
             (LabelID, LabellerID, ImageID, Class, top_left_x, top_left_y, bot_right_x, bot_right_y, offset_x, offset_y, creation_time, origImageID)
@@ -112,16 +97,32 @@ class MYSQLLabelDatabaseConnector(LabelDatabaseConnector):
                 bot_right_x = VALUES(bot_right_x),
                 bot_right_y = VALUES(bot_right_y)
         """)
+        labels = [label if isinstance(label, Label) else Label(**label) for label in labels_batch]
+        rows = [label.__dict__ for label in labels]
+        if not rows:
+            return
+        self.make_db_connection()
         with self.cnx.connect() as connection:
-            connection.execute(query, labels_batch)
-            connection.commit()
+            try:
+                with connection.begin():
+                    # counts only labels that are not stored yet, so it runs before the upsert
+                    self.stats_db.record_labels(labels, connection)
+                    for start in range(0, len(rows), chunk_size):
+                        connection.execute(query, rows[start:start + chunk_size])
+                print(f"Query sucessful, {len(rows)} labels saved")
+            except Exception as e:
+                print(f"Error {e}")
+                raise Exception(e)
 
     def get_labels(self, query:str) -> list[Label]:
+        return self.get_labels_with_data(query, None)
+
+    def get_labels_with_data(self, query:str, data) -> list[Label]:
         self.make_db_connection()
         results = []
         with self.cnx.connect() as connection:
             try:
-                result = connection.execute(text(query))
+                result = connection.execute(text(query), data)
                 print(f"Query returned {result.rowcount} results")
                 for res in result:
                     l = Label(
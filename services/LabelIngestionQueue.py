@@ -0,0 +1,432 @@
+from abc import ABC, abstractmethod
+import os
+import time
+import json
+import sqlite3
+import threading
+from collections import deque
+import sys
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from sqlalchemy import exc
+from services.DataTypes import Label
+from services.LabelDatabaseConnector import LabelDatabaseConnector
+
+# Config
+# ------------------------------------------------------------
+MAX_BATCH = 1000 # labels per group commit
+MAX_DELAY = 0.05 # seconds the first queued label waits for others to join its commit
+MAX_DEPTH = 50000 # queued labels before submissions are refused
+CLAIM_LEASE = 60 # seconds before a batch claimed by a flusher that died is handed out again
+RETRY_DELAY = 1 # seconds between attempts when the database rejects a flush
+MAX_ATTEMPTS = 5 # failed writes of a single label before it is moved to the dead letters
+DEAD_LETTER_PATH = os.path.join(project_root, 'label_dead_letters.jsonl') # dead letters of the memory journal
+# ------------------------------------------------------------
+
+# errors of the connection rather than of the labels, a batch failing with one is retried whole
+TRANSIENT_ERRORS = (exc.OperationalError, exc.InterfaceError, exc.TimeoutError, ConnectionError, TimeoutError)
+
+
+class QueueFullError(Exception):
+    # raised by submit when the queue is too deep, callers should ask the client to retry later
+    pass
+
+
+def is_transient(error: BaseException) -> bool:
+    # the connectors re-raise database errors as Exception(e), so the wrapped errors are checked too
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, TRANSIENT_ERRORS):
+            return True
+        seen.add(id(error))
+        if error.args and isinstance(error.args[0], BaseException):
+            error = error.args[0]
+        else:
+            error = error.__cause__ or error.__context__
+    return False
+
+
+class LabelJournal(ABC):
+    '''
+    Storage for labels that were acknowledged but not yet written to the label database. A token has one
+    entry per claimed label, a slice of it stands for the same slice of the labels
+    '''
+
+    @abstractmethod
+    def append(self, labels: list[Label], max_depth: int=None) -> int:
+        # returns the depth after the append, raises QueueFullError instead when it would exceed max_depth
+        pass
+
+    @abstractmethod
+    def claim(self, max_items: int) -> tuple[list, list[Label]]:
+        # returns (token, labels) for up to max_items of the oldest unclaimed labels
+        pass
+
+    @abstractmethod
+    def ack(self, token: list):
+        # the claimed labels were committed, forget them
+        pass
+
+    @abstractmethod
+    def release(self, token: list):
+        # the flush failed, hand the labels out again
+        pass
+
+    @abstractmethod
+    def fail(self, token: list, error: str, max_attempts: int) -> int:
+        '''
+        The database rejected these labels, counts an attempt for each. Labels with max_attempts attempts
+        are moved to the dead letters, the others are handed out again. Returns the number moved
+        '''
+        pass
+
+    @abstractmethod
+    def depth(self) -> int:
+        pass
+
+    @abstractmethod
+    def dead_letters(self) -> int:
+        pass
+
+
+class MemoryJournal(LabelJournal):
+    '''
+    Journal kept in process memory. Fast, but labels queued when the process dies are lost. Dead letters
+    are appended to the JSON lines file at dead_letter_path
+    '''
+
+    def __init__(self, dead_letter_path: str=DEAD_LETTER_PATH):
+        self.dead_letter_path = dead_letter_path
+        self.lock = threading.Lock()
+        self.pending = deque() # [label, attempts] entries, the entries are the tokens
+        self.claimed = 0
+        self.dead = 0
+
+    def append(self, labels: list[Label], max_depth: int=None) -> int:
+        with self.lock:
+            depth = len(self.pending) + self.claimed
+            if max_depth is not None and depth + len(labels) > max_depth:
+                raise QueueFullError(f'{depth} labels waiting to be written')
+            self.pending.extend([label, 0] for label in labels)
+            return depth + len(labels)
+
+    def claim(self, max_items: int) -> tuple[list, list[Label]]:
+        with self.lock:
+            entries = [self.pending.popleft() for _ in range(min(max_items, len(self.pending)))]
+            self.claimed += len(entries)
+        return entries, [entry[0] for entry in entries]
+
+    def ack(self, token: list):
+        with self.lock:
+            self.claimed -= len(token)
+
+    def release(self, token: list):
+        with self.lock:
+            self.claimed -= len(token)
+            self.pending.extendleft(reversed(token))
+
+    def fail(self, token: list, error: str, max_attempts: int) -> int:
+        with self.lock:
+            for entry in token:
+                entry[1] += 1
+            dead = [entry for entry in token if entry[1] >= max_attempts]
+            if dead:
+                with open(self.dead_letter_path, 'a') as f:
+                    for label, attempts in dead:
+                        f.write(json.dumps({'label': label.__dict__, 'attempts': attempts, 'error': error,
+                                            'failed_at': time.time()}) + '\n')
+                self.dead += len(dead)
+            self.claimed -= len(token)
+            self.pending.extendleft(reversed([entry for entry in token if entry[1] < max_attempts]))
+            return len(dead)
+
+    def depth(self) -> int:
+        with self.lock:
+            return len(self.pending) + self.claimed
+
+    def dead_letters(self) -> int:
+        with self.lock:
+            return self.dead
+
+
+class SQLiteJournal(LabelJournal):
+    '''
+    Journal in a SQLite file. An append returns once the labels are synced to disk, so an acknowledged
+    label survives a crash. Several processes can share the file: each claims batches under a lease, and
+    a batch whose flusher died is claimed again once the lease runs out. Dead letters are kept in the
+    label_dead_letter table of the same file
+    '''
+
+    def __init__(self, path: str, lease: float=CLAIM_LEASE):
+        self.path = path
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.cnx = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.cnx.execute("PRAGMA journal_mode=WAL")
+        self.cnx.execute("PRAGMA synchronous=FULL")
+        self.cnx.execute("""
+            CREATE TABLE IF NOT EXISTS label_journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                claimed_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        columns = [row[1] for row in self.cnx.execute("PRAGMA table_info(label_journal)")]
+        if 'attempts' not in columns:
+            # journal written before attempts were counted
+            self.cnx.execute("ALTER TABLE label_journal ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        self.cnx.execute("""
+            CREATE TABLE IF NOT EXISTS label_dead_letter (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                error TEXT,
+                failed_at REAL NOT NULL
+            )
+        """)
+
+    def append(self, labels: list[Label], max_depth: int=None) -> int:
+        rows = [(json.dumps(label.__dict__),) for label in labels]
+        with self.lock:
+            # the write lock is held from the depth check to the commit, also against other processes
+            self.cnx.execute("BEGIN IMMEDIATE")
+            try:
+                depth = self.cnx.execute("SELECT COUNT(*) FROM label_journal").fetchone()[0]
+                if max_depth is not None and depth + len(rows) > max_depth:
+                    raise QueueFullError(f'{depth} labels waiting to be written')
+                self.cnx.executemany("INSERT INTO label_journal (payload) VALUES (?)", rows)
+                self.cnx.execute("COMMIT")
+            except Exception:
+                self.cnx.execute("ROLLBACK")
+                raise
+        return depth + len(rows)
+
+    def claim(self, max_items: int) -> tuple[list, list[Label]]:
+        now = time.time()
+        with self.lock:
+            self.cnx.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.cnx.execute("""
+                    SELECT id, payload FROM label_journal
+                    WHERE claimed_at IS NULL OR claimed_at < ?
+                    ORDER BY id LIMIT ?
+                """, (now - self.lease, max_items)).fetchall()
+                self.cnx.executemany("UPDATE label_journal SET claimed_at = ? WHERE id = ?", [(now, row[0]) for row in rows])
+                self.cnx.execute("COMMIT")
+            except Exception:
+                self.cnx.execute("ROLLBACK")
+                raise
+        return [row[0] for row in rows], [Label(**json.loads(row[1])) for row in rows]
+
+    def ack(self, token: list):
+        # one transaction, so the batch is synced once instead of once per row
+        with self.lock:
+            self.cnx.execute("BEGIN IMMEDIATE")
+            try:
+                self.cnx.executemany("DELETE FROM label_journal WHERE id = ?", [(id,) for id in token])
+                self.cnx.execute("COMMIT")
+            except Exception:
+                self.cnx.execute("ROLLBACK")
+                raise
+
+    def release(self, token: list):
+        with self.lock:
+            self.cnx.execute("BEGIN IMMEDIATE")
+            try:
+                self.cnx.executemany("UPDATE label_journal SET claimed_at = NULL WHERE id = ?", [(id,) for id in token])
+                self.cnx.execute("COMMIT")
+            except Exception:
+                self.cnx.execute("ROLLBACK")
+                raise
+
+    def fail(self, token: list, error: str, max_attempts: int) -> int:
+        ids = [(id,) for id in token]
+        with self.lock:
+            self.cnx.execute("BEGIN IMMEDIATE")
+            try:
+                self.cnx.executemany("UPDATE label_journal SET claimed_at = NULL, attempts = attempts + 1 WHERE id = ?", ids)
+                dead = self.cnx.executemany("""
+                    INSERT INTO label_dead_letter (id, payload, attempts, error, failed_at)
+                    SELECT id, payload, attempts, ?, ? FROM label_journal WHERE id = ? AND attempts >= ?
+                """, [(error, time.time(), id, max_attempts) for id in token]).rowcount
+                self.cnx.executemany("DELETE FROM label_journal WHERE id = ? AND attempts >= ?", [(id, max_attempts) for id in token])
+                self.cnx.execute("COMMIT")
+            except Exception:
+                self.cnx.execute("ROLLBACK")
+                raise
+        return dead
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.cnx.execute("SELECT COUNT(*) FROM label_journal").fetchone()[0]
+
+    def dead_letters(self) -> int:
+        with self.lock:
+            return self.cnx.execute("SELECT COUNT(*) FROM label_dead_letter").fetchone()[0]
+
+
+class LabelIngestionQueue():
+    '''
+    Write behind queue in front of a LabelDatabaseConnector. submit returns as soon as the labels are in
+    the journal, a flusher thread writes them with push_labels_batch in group commits of up to max_batch
+    labels, waiting at most max_delay seconds for a batch to fill. Once max_depth labels are waiting,
+    submit raises QueueFullError.
+    A batch the database rejects is split in halves until the labels it rejects are found, the rest is
+    written. A rejected label is retried with later flushes and moved to the journal's dead letters after
+    max_attempts rejections. A batch failing on the connection (TRANSIENT_ERRORS) is retried whole
+    '''
+
+    def __init__(self, db: LabelDatabaseConnector, journal: LabelJournal=None, max_batch: int=MAX_BATCH,
+                 max_delay: float=MAX_DELAY, max_depth: int=MAX_DEPTH, max_attempts: int=MAX_ATTEMPTS):
+        self.db = db
+        self.journal = journal if journal else MemoryJournal()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_depth = max_depth
+        self.max_attempts = max_attempts
+
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.stats_lock = threading.Lock()
+        self.submitted = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.last_flush_time = 0.0
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.__run, name='label-ingestion-flusher', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self, drain: bool=True):
+        # stops the flusher, by default after writing everything still queued
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if drain:
+            while self.flush():
+                pass
+
+    def submit(self, labels: list[Label]) -> int:
+        # returns the queue depth after the labels were journaled, the journal checks the depth as it appends
+        depth = self.journal.append(labels, self.max_depth)
+        with self.stats_lock:
+            self.submitted += len(labels)
+        if depth >= self.max_batch:
+            self.wakeup.set()
+        return depth
+
+    def flush(self) -> int:
+        # writes one group commit, returns the number of labels it took, written or rejected
+        token, labels = self.journal.claim(self.max_batch)
+        if not labels:
+            return 0
+
+        start = time.perf_counter()
+        try:
+            written = self.__write(token, labels)
+        except Exception:
+            with self.stats_lock:
+                self.failures += 1
+            raise
+
+        elapsed = time.perf_counter() - start
+        with self.stats_lock:
+            self.flushed += written
+            self.flushes += 1
+            self.total_flush_time += elapsed
+            self.max_flush_time = max(self.max_flush_time, elapsed)
+            self.last_flush_time = elapsed
+        return len(labels)
+
+    def stats(self) -> dict:
+        depth = self.journal.depth()
+        with self.stats_lock:
+            return {
+                'depth': depth,
+                'max_depth': self.max_depth,
+                'submitted': self.submitted,
+                'flushed': self.flushed,
+                'flushes': self.flushes,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'dead_letters': self.journal.dead_letters(),
+                'avg_batch': self.flushed / self.flushes if self.flushes else 0.0,
+                'avg_flush_ms': 1000 * self.total_flush_time / self.flushes if self.flushes else 0.0,
+                'max_flush_ms': 1000 * self.max_flush_time,
+                'last_flush_ms': 1000 * self.last_flush_time,
+            }
+
+    def __write(self, token: list, labels: list[Label]) -> int:
+        # writes the labels the database accepts, returns how many. Raises when the connection failed
+        try:
+            self.db.push_labels_batch(labels)
+        except Exception as e:
+            if is_transient(e):
+                print(f"Error flushing {len(labels)} labels: {e}")
+                self.journal.release(token)
+                raise
+            if len(labels) == 1:
+                dead = self.journal.fail(token, str(e), self.max_attempts)
+                print(f"label {labels[0].LabelID} rejected{', moved to the dead letters' if dead else ''}: {e}")
+                with self.stats_lock:
+                    self.rejected += 1
+                return 0
+
+            half = len(labels) // 2
+            try:
+                written = self.__write(token[:half], labels[:half])
+            except Exception:
+                self.journal.release(token[half:])
+                raise
+            return written + self.__write(token[half:], labels[half:])
+
+        self.journal.ack(token)
+        return len(labels)
+
+    def __run(self):
+        while not self.stopping.is_set():
+            # the first label of a batch waits up to max_delay for others, a full batch goes at once
+            self.wakeup.wait(self.max_delay)
+            self.wakeup.clear()
+            try:
+                while self.flush() == self.max_batch and not self.stopping.is_set():
+                    pass
+            except Exception:
+                self.stopping.wait(RETRY_DELAY)
+
+
+def build_ingestion_queue(db: LabelDatabaseConnector, mode: str=None) -> LabelIngestionQueue:
+    '''
+    Queue configured from the environment. _LABEL_INGESTION is 'sync' (no queue, returns None), 'memory'
+    or 'sqlite', the sqlite journal lives at _LABEL_JOURNAL_PATH
+    '''
+    if not mode:
+        mode = os.getenv('_LABEL_INGESTION', 'sync')
+    mode = mode.lower()
+    if mode == 'sync':
+        return None
+    if mode == 'memory':
+        journal = MemoryJournal(os.getenv('_LABEL_DEAD_LETTER_PATH', DEAD_LETTER_PATH))
+    elif mode == 'sqlite':
+        journal = SQLiteJournal(os.getenv('_LABEL_JOURNAL_PATH', os.path.join(project_root, 'label_journal.sqlite')))
+    else:
+        raise ValueError(f"unknown label ingestion mode '{mode}'")
+
+    return LabelIngestionQueue(db, journal,
+                               max_batch=int(os.getenv('_LABEL_INGESTION_MAX_BATCH', MAX_BATCH)),
+                               max_delay=float(os.getenv('_LABEL_INGESTION_MAX_DELAY', MAX_DELAY)),
+                               max_depth=int(os.getenv('_LABEL_INGESTION_MAX_DEPTH', MAX_DEPTH)),
+                               max_attempts=int(os.getenv('_LABEL_INGESTION_MAX_ATTEMPTS', MAX_ATTEMPTS))).start()
@@ -0,0 +1,92 @@
+import sys
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+import numpy as np
+
+
+def label_boxes(labels) -> np.ndarray:
+    '''
+    Converts a DataFrame of labels into an (N, 4) int array of offset corrected
+    boxes laid out as (top_left_x, top_left_y, bot_right_x, bot_right_y), corners inclusive
+    '''
+    if len(labels) == 0:
+        return np.empty((0, 4), dtype=np.int32)
+    offset_x = labels['offset_x'].to_numpy(dtype=np.int64)
+    offset_y = labels['offset_y'].to_numpy(dtype=np.int64)
+    return np.stack((labels['top_left_x'].to_numpy(dtype=np.int64) + offset_x,
+                     labels['top_left_y'].to_numpy(dtype=np.int64) + offset_y,
+                     labels['bot_right_x'].to_numpy(dtype=np.int64) + offset_x,
+                     labels['bot_right_y'].to_numpy(dtype=np.int64) + offset_y), axis=-1).astype(np.int32)
+
+
+def clip_boxes(boxes: np.ndarray, im_height: int, im_width: int) -> np.ndarray:
+    '''
+    Clips inclusive boxes to the image and turns them into half open
+    (x_start, y_start, x_end, y_end) windows, dropping boxes that fall outside
+    '''
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    x_start = np.clip(boxes[:, 0], 0, im_width)
+    y_start = np.clip(boxes[:, 1], 0, im_height)
+    x_end = np.clip(boxes[:, 2] + 1, 0, im_width)
+    y_end = np.clip(boxes[:, 3] + 1, 0, im_height)
+    windows = np.stack((x_start, y_start, x_end, y_end), axis=-1)
+    return windows[(x_end > x_start) & (y_end > y_start)]
+
+
+def label_coverage(boxes: np.ndarray, im_height: int, im_width: int) -> np.ndarray:
+    '''
+    Number of boxes covering each pixel. Each box adds +1/-1 at its four corners of a
+    (H+1, W+1) difference array and a 2D cumulative sum spreads them, so the cost is
+    O(labels + pixels) however large or overlapping the boxes are
+    '''
+    windows = clip_boxes(boxes, im_height, im_width)
+    diff = np.zeros((im_height + 1, im_width + 1), dtype=np.int32)
+    x_start, y_start, x_end, y_end = windows.T
+    np.add.at(diff, (y_start, x_start), 1)
+    np.add.at(diff, (y_start, x_end), -1)
+    np.add.at(diff, (y_end, x_start), -1)
+    np.add.at(diff, (y_end, x_end), 1)
+    np.cumsum(diff, axis=0, out=diff)
+    np.cumsum(diff, axis=1, out=diff)
+    return diff[:im_height, :im_width]
+
+
+def rasterize_labels(boxes: np.ndarray, im_height: int, im_width: int) -> np.ndarray:
+    # boolean mask of the pixels inside at least one of a labeller's boxes
+    return label_coverage(boxes, im_height, im_width) > 0
+
+
+def disjoint_windows(boxes: np.ndarray, im_height: int, im_width: int, exclude: np.ndarray=None) -> np.ndarray:
+    '''
+    Splits the union of possibly overlapping boxes into non overlapping half open windows, leaving out the
+    union of the exclude boxes when they are given. Box edges are compressed onto a grid of at most
+    2N x 2N cells, coverage is rasterized on that grid and every run of covered cells becomes one window,
+    so the cost depends on the number of labels and not on their area
+    '''
+    windows = clip_boxes(boxes, im_height, im_width)
+    excluded = clip_boxes(exclude if exclude is not None else np.empty((0, 4)), im_height, im_width)
+    if len(windows) == 0:
+        return np.empty((0, 4), dtype=np.int64)
+
+    bounds = np.concatenate((windows, excluded))
+    xs = np.unique(np.concatenate((bounds[:, 0], bounds[:, 2])))
+    ys = np.unique(np.concatenate((bounds[:, 1], bounds[:, 3])))
+
+    def grid_coverage(windows: np.ndarray) -> np.ndarray:
+        cells = np.stack((np.searchsorted(xs, windows[:, 0]),
+                          np.searchsorted(ys, windows[:, 1]),
+                          np.searchsorted(xs, windows[:, 2]),
+                          np.searchsorted(ys, windows[:, 3])), axis=-1)
+        return label_coverage(cells - [0, 0, 1, 1], len(ys) - 1, len(xs) - 1) > 0
+
+    covered = grid_coverage(windows)
+    if len(excluded):
+        covered &= ~grid_coverage(excluded)
+
+    # horizontal runs of covered cells are merged so each band of rows gives as few windows as possible
+    edges = np.diff(np.pad(covered, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    rows, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+    return np.stack((xs[run_starts], ys[rows], xs[run_ends], ys[rows + 1]), axis=-1)
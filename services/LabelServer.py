@@ -1,18 +1,122 @@
-from LabelDatabaseConnector import LabelDatabaseConnector, MYSQLLabelDatabaseConnector
-from ReportGenerator import ReportGenerator
-from DataTypes import Label
+import sys
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from services.LabelDatabaseConnector import LabelDatabaseConnector, MYSQLLabelDatabaseConnector
+from services.ReportGenerator import ReportGenerator
+from services.DataTypes import Label
+from services.EngineRegistry import pool_stats
+from services.LabelIngestionQueue import LabelIngestionQueue, QueueFullError, build_ingestion_queue
 from flask import Flask, Response, request
 from flask_cors import CORS, cross_origin
 import json
+from datetime import datetime, timezone
+
+# Config
+# ------------------------------------------------------------
+MAX_LABELS_PER_REQUEST = 10000
+LABEL_CHUNK_SIZE = 1000 # rows per multi-row insert
+# ------------------------------------------------------------
+
+LABEL_FIELDS = ['LabellerID', 'ImageID', 'Class', 'top_left_x', 'top_left_y', 'bot_right_x', 'bot_right_y',
+                'offset_x', 'offset_y', 'creation_time', 'OrigImageID']
+COORDINATE_FIELDS = ['top_left_x', 'top_left_y', 'bot_right_x', 'bot_right_y', 'offset_x', 'offset_y']
+
+
+def parse_creation_time(value) -> str:
+    '''
+    Normalizes an ISO 8601 timestamp to the 'YYYY-MM-DD HH:MM:SS[.ffffff]' MySQL DATETIME accepts, times
+    with an offset are converted to UTC. Raises ValueError for anything else
+    '''
+    if not isinstance(value, str):
+        raise ValueError("'creation_time' must be an ISO 8601 timestamp")
+    try:
+        parsed = datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise ValueError("'creation_time' must be an ISO 8601 timestamp")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    if parsed.year < 1000:
+        raise ValueError("'creation_time' is before the year 1000")
+    return parsed.isoformat(sep=' ')
+
+
+def parse_label(req: dict) -> Label:
+    # builds a Label from one request item, raises ValueError describing everything wrong with it
+    if not isinstance(req, dict):
+        raise ValueError('label must be an object')
+    problems = [f"missing '{field}'" for field in LABEL_FIELDS if req.get(field) is None]
+
+    coordinates = {}
+    for field in COORDINATE_FIELDS:
+        if req.get(field) is None:
+            continue
+        value = req[field]
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            problems.append(f"'{field}' must be an integer")
+            continue
+        # JSON Infinity and 1e999 parse to inf, int() of it and float() of a huge int overflow
+        try:
+            coordinates[field] = int(value)
+            integral = coordinates[field] == float(value)
+        except (ValueError, OverflowError):
+            coordinates.pop(field, None)
+            integral = False
+        if not integral:
+            problems.append(f"'{field}' must be an integer")
+
+    creation_time = None
+    if req.get('creation_time') is not None:
+        try:
+            creation_time = parse_creation_time(req['creation_time'])
+        except ValueError as e:
+            problems.append(str(e))
+
+    if {'top_left_x', 'bot_right_x'} <= coordinates.keys() and coordinates['top_left_x'] > coordinates['bot_right_x']:
+        problems.append("'top_left_x' is right of 'bot_right_x'")
+    if {'top_left_y', 'bot_right_y'} <= coordinates.keys() and coordinates['top_left_y'] > coordinates['bot_right_y']:
+        problems.append("'top_left_y' is below 'bot_right_y'")
+    if problems:
+        raise ValueError(', '.join(problems))
+
+    # LabelIDs are generated here, a client chosen one could overwrite another labeller's box through the upsert
+    return Label(LabelID=None,
+                 LabellerID=req['LabellerID'],
+                 ImageID=req['ImageID'],
+                 Class=req['Class'],
+                 bot_right_x=coordinates['bot_right_x'],
+                 bot_right_y=coordinates['bot_right_y'],
+                 top_left_x=coordinates['top_left_x'],
+                 top_left_y=coordinates['top_left_y'],
+                 offset_x=coordinates['offset_x'],
+                 offset_y=coordinates['offset_y'],
+                 creation_time=creation_time,
+                 origImageID=req['OrigImageID']
+                 )
+
+
+def parse_labels(items) -> tuple[list[Label], list[dict]]:
+    # validates a whole payload, returning the labels and one {'index', 'error'} entry per bad item
+    labels = []
+    errors = []
+    for i, req in enumerate(items):
+        try:
+            labels.append(parse_label(req))
+        except ValueError as e:
+            errors.append({'index': i, 'error': str(e)})
+    return labels, errors
 
 
 class LabelServer():
 
-    def __init__(self, db: LabelDatabaseConnector, report_generator: ReportGenerator):
+    def __init__(self, db: LabelDatabaseConnector, report_generator: ReportGenerator, ingestion_queue: LabelIngestionQueue=None):
+        # with an ingestion_queue labels are acknowledged once journaled and written in group commits
         self.version = '1.0'
 
         self.db = db
         self.report_generator = report_generator
+        self.ingestion_queue = ingestion_queue
 
         self.app = Flask(__name__)
         CORS(self.app)
@@ -29,50 +133,60 @@ class LabelServer():
             ,view_func=self.get_report
             ,methods=['GET']
         )
-        self.app.run()
+        self.app.add_url_rule(
+            rule=f'/{self.version}/pool_stats'
+            ,endpoint=f'/{self.version}/pool_stats'
+            ,view_func=self.get_pool_stats
+            ,methods=['GET']
+        )
+        self.app.add_url_rule(
+            rule=f'/{self.version}/ingestion_stats'
+            ,endpoint=f'/{self.version}/ingestion_stats'
+            ,view_func=self.get_ingestion_stats
+            ,methods=['GET']
+        )
+
+    def run(self, **kwargs):
+        self.app.run(**kwargs)
 
-       
 
     def push_label(self) -> Response:
         '''
-        save map modifications to table in database
+        save map modifications to table in database. The whole payload is validated first, if any label
+        is invalid nothing is written and every problem is reported by index, otherwise all labels are
+        upserted in one transaction
         '''
         try:
             request_data = request.get_json(force=True)
-            
+            items = request_data['labels']
+            if not isinstance(items, list):
+                raise ValueError("'labels' must be a list")
         except Exception as e:
             print(e)
             return Response(status=400, response='couldn\'t extract json')
-        
-        request_headers = request.headers
 
-        
-        try:
-            for req in request_data['labels']:
-                label = Label(LabelID=None,
-                        LabellerID=req['LabellerID'], 
-                        ImageID=req['ImageID'],
-                        Class=req['Class'],
-                        bot_right_x=req['bot_right_x'],
-                        bot_right_y=req['bot_right_y'],
-                        top_left_x=req['top_left_x'],
-                        top_left_y=req['top_left_y'],
-                        offset_x=req['offset_x'],
-                        offset_y=req['offset_y'],
-                        creation_time=req['creation_time'],
-                        origImageID=req['OrigImageID']
-                        )
-                self.db.push_label(label=label)
+        if len(items) > MAX_LABELS_PER_REQUEST:
+            return Response(status=413, response=f'at most {MAX_LABELS_PER_REQUEST} labels per request')
 
-        except ValueError as e:
-            return Response(status=400, response=str(e))
-        except KeyError as e:
-            return Response(status=400, response=str(e))
+        labels, errors = parse_labels(items)
+        if errors:
+            return Response(status=400, response=json.dumps({'saved': 0, 'errors': errors}), mimetype='application/json')
+
+        if self.ingestion_queue:
+            try:
+                depth = self.ingestion_queue.submit(labels)
+            except QueueFullError as e:
+                return Response(status=503, response=json.dumps({'saved': 0, 'errors': [{'index': None, 'error': str(e)}]}),
+                                mimetype='application/json', headers={'Retry-After': '1'})
+            return Response(status=202, response=json.dumps({'queued': len(labels), 'depth': depth, 'errors': []}), mimetype='application/json')
+
+        try:
+            self.db.push_labels_batch(labels, chunk_size=LABEL_CHUNK_SIZE)
         except Exception as e:
             print(f"other Error: {e}")
-            return Response(status=400, response=str(e))
-        
-        return Response(status=200, response='all labels saved')
+            return Response(status=500, response=json.dumps({'saved': 0, 'errors': [{'index': None, 'error': str(e)}]}), mimetype='application/json')
+
+        return Response(status=200, response=json.dumps({'saved': len(labels), 'errors': []}), mimetype='application/json')
     
 
     def get_report(self) -> Response:
@@ -96,6 +210,26 @@ class LabelServer():
         
         return Response(status=200, response=resp)
 
-db = MYSQLLabelDatabaseConnector()
-rp = ReportGenerator()
-server = LabelServer(db, rp)
+    def get_pool_stats(self) -> Response:
+        # connection pool checkouts and wait times for every database engine in this process
+        return Response(status=200, response=json.dumps(pool_stats()), mimetype='application/json')
+
+    def get_ingestion_stats(self) -> Response:
+        # queue depth and group commit latency, empty when labels are written synchronously
+        stats = self.ingestion_queue.stats() if self.ingestion_queue else {}
+        return Response(status=200, response=json.dumps(stats), mimetype='application/json')
+
+def main():
+    db = MYSQLLabelDatabaseConnector()
+    rp = ReportGenerator()
+    queue = build_ingestion_queue(db)
+    server = LabelServer(db, rp, queue)
+    try:
+        server.run()
+    finally:
+        if queue:
+            queue.stop()
+
+
+if __name__ == '__main__':
+    main()
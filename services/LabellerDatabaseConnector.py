@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import uuid
 import time
 import datetime
@@ -11,6 +11,7 @@ from pathlib import Path
 
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
+from services.EngineRegistry import get_engine
 from services.DataTypes import Labeller
 import urllib.parse
 import pymysql
@@ -27,6 +28,10 @@ class LabellerDatabaseConnector(ABC):
     def push_labeller(self, labeller:Labeller):
         pass
 
+    @abstractmethod
+    def add_labeller_accuracy(self, labeller:Labeller, alpha_increment:float, beta_increment:float):
+        pass
+
     @abstractmethod
     def get_labellers(self, query:str) -> list[Labeller]:
         pass
@@ -46,6 +51,10 @@ class NoneDB(LabellerDatabaseConnector):
         pass
 
 
+    def add_labeller_accuracy(self, labeller:Labeller, alpha_increment:float, beta_increment:float):
+        pass
+
+
     def get_labellers(self, query:str) -> list[Labeller]:
         pass
 
@@ -55,34 +64,14 @@ class NoneDB(LabellerDatabaseConnector):
 class MYSQLLabellerDatabaseConnector(LabellerDatabaseConnector):
 
     def __init__(self, table:str='Labeller_skills'):
+        # the shared engine is looked up on first use, building a connector never touches the database
         self.cnx = None
-        self.make_db_connection()
         self.table=table
 
     def make_db_connection(self):
-        load_dotenv()
-        MYSQLUSER=os.getenv('_LABELDATABASE_MYSQLUSER')
-        MYSQLPASSWORD=os.getenv('_LABELDATABASE_MYSQLPASSWORD')
-        MYSQLHOST=os.getenv('_LABELDATABASE_MYSQLHOST')
-        MYSQLDATABASE=os.getenv('_LABELDATABASE_MYSQLDATABASE')
-
-        try:
-            self.cnx = create_engine(
-    url=f"mysql+pymysql://{str(MYSQLUSER)}:{urllib.parse.quote_plus(str(MYSQLPASSWORD))}"
-        f"@{urllib.parse.quote_plus(str(MYSQLHOST))}/{MYSQLDATABASE}"
-)
-                                            
-        except Exception as e:
-            print("Error {e}")
-            raise ConnectionError(e)
-        
-        if self.cnx:
-            try:
-                self.cnx.connect()
-                print('connection successful')
-            except Exception as e:
-                print("Error {e}")
-                raise ConnectionError(e)
+        # one engine per DSN is shared by every connector in the process, see services/EngineRegistry.py
+        if self.cnx is None:
+            self.cnx = get_engine()
 
 
     def push_labeller(self, labeller:Labeller):
@@ -112,6 +101,35 @@ class MYSQLLabellerDatabaseConnector(LabellerDatabaseConnector):
                 print("Error {e}")
                 raise Exception(e)
 
+    def add_labeller_accuracy(self, labeller:Labeller, alpha_increment:float, beta_increment:float):
+        # atomic increment, labeller holds the values to insert when the row doesn't exist yet
+        self.make_db_connection()
+        query = text("""
+            INSERT INTO Labeller_skills (Labeller_id, skill, alpha, beta) 
+            VALUES (:labeller_id, :skill, :alpha, :beta)
+            ON DUPLICATE KEY UPDATE 
+            alpha = alpha + :alpha_increment, 
+            beta = beta + :beta_increment;
+        """)
+
+        with self.cnx.connect() as connection:
+            try:
+                data = {
+                    "labeller_id": labeller.LabellerID,
+                    "skill": labeller.skill,
+                    "alpha": labeller.alpha,
+                    "beta": labeller.beta,
+                    "alpha_increment": alpha_increment,
+                    "beta_increment": beta_increment,
+                }
+                connection.execute(query, data)
+
+                connection.commit()
+                print(f"Query sucessful")
+            except Exception as e:
+                print("Error {e}")
+                raise Exception(e)
+
     def get_labellers(self, query:str) -> list[Labeller]:
         self.make_db_connection()
         # query should be something like 'where id = x' or 'where skill = 'x''
@@ -1,6 +1,10 @@
 
 import sys
+import os
+import time
+import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 
 project_root = str(Path(__file__).parent.parent)
@@ -9,9 +13,11 @@ from services.ProjectDatabaseConnector import ProjectDatabaseConnector, MYSQLPro
 from services.LabelDatabaseConnector import LabelDatabaseConnector, MYSQLLabelDatabaseConnector
 from services.LabellerDatabaseConnector import LabellerDatabaseConnector, MYSQLLabellerDatabaseConnector
 from services.ImageObjectDatabaseConnector import ImageObjectDatabaseConnector, MYSQLImageObjectDatabaseConnector
+from services.ImageObjectDatabaseConnector_bb import ImageObjectDatabaseConnector_bb, MYSQLImageObjectDatabaseConnector_bb
 from services.ObjectExtractionService import ObjectExtractionService
 from services.ImageClassMeasureDatabaseConnector import MYSQLImageClassMeasureDatabaseConnector
-from services.DataTypes import Labeller
+from services.ProjectStatsDatabaseConnector import MYSQLProjectStatsDatabaseConnector
+from services.DataTypes import Labeller, Label, LabelWatermark, Image, ImageObject_bb
 
 
 class ObjectExtractionManager():
@@ -73,41 +79,128 @@ class ObjectExtractionManager():
         return bbox
 
 
-    def get_objects(self, project_id, Class, demo=False):
+    def get_objects(self, project_id, Class, demo=False, parallel=False, max_workers=None, max_in_flight=None, manager_factory=None):
+        '''
+        Runs extraction for every (image, class) unit of a project, Class can be one class or a list of them.
+        With parallel=True images fan out to a process pool, each worker building its own connectors through
+        manager_factory (defaults to build_manager). A worker runs every class of its image in order, so no two
+        units of one image run at once and write its tiles' confidence concurrently. At most max_in_flight
+        images are queued at once and objects are written as each image finishes
+        '''
         t = time.time()
 
         query_projects = f"SELECT * FROM my_image_db.Projects WHERE projectId = {project_id};"
 
         project = self.project_db.get_projects(query_projects)[0]
-        objects = []
-        for image in project.images:
-            query_labels = f"SELECT * FROM my_image_db.Labels WHERE (OrigImageID = {image.ImageID}) and (Class = '{Class}');"
-            labels = self.label_db.get_labels(query_labels)
-            print(f"found {len(labels)} labels")
-            labeller_ids = set()
-            for label in labels:
-                labeller_ids.add(label.LabellerID)
+        classes = [Class] if isinstance(Class, str) else list(Class)
+
+        if not parallel or demo:
+            for image in project.images:
+                for c in classes:
+                    self.__push_objects(image.ImageID, c, self.extract_image(image, c, demo=demo))
+                # images are fetched on first use, drop the pixels once every class of the image ran
+                image.release()
+        else:
+            self.__get_objects_parallel(project.images, classes, max_workers, max_in_flight, manager_factory if manager_factory else build_manager)
+
+        print(f"completed {len(project.images) * len(classes)} units in {time.time()-t} seconds")
+
+    def extract_image(self, image: Image, Class, demo=False) -> list[ImageObject_bb]:
+        # one unit of work, applies the labels that arrived or changed since the last run for one image and class
+        labels = self.label_db.get_labels_with_data(
+            "SELECT * FROM my_image_db.Labels WHERE (OrigImageID = :image_id) and (Class = :Class);",
+            {'image_id': image.ImageID, 'Class': Class})
+        # only the watermark is read to decide, the ICM planes are loaded by the service once there is work
+        watermark = self.object_service.icm_db.get_watermark(image.ImageID, Class)
+        if not watermark:
+            watermark = LabelWatermark()
+        new_labels = watermark.new_labels(labels)
+        print(f"found {len(new_labels)} new labels")
+        if not new_labels and watermark.is_current(labels):
+            # nothing arrived or moved since the last run, the stored ICM and objects are already current
+            return None
+        # the service applies only the new labels to the likelihoods but judges each labeller on all of theirs
+        labeller_ids = set()
+        for label in labels:
+            labeller_ids.add(label.LabellerID)
+
+        query_labellers = f"SELECT * FROM my_image_db.Labeller_skills WHERE Labeller_id IN :ids"
+
+        labellers = self.labeller_db.get_labellers_with_data(query_labellers, {'ids': tuple(labeller_ids)})
+
+        found_labeller_ids = [labeller.LabellerID for labeller in labellers]
+        for labeller_id in labeller_ids:
+            if labeller_id not in found_labeller_ids:
+                labellers.append(Labeller(labeller_id, Class))
+
+        print(labellers)
+        print(labels[0].__dict__)
+
+        return self.object_service.get_objects(image, Class, labellers, labels, demo=demo)
+
+    def __get_objects_parallel(self, images, classes, max_workers, max_in_flight, manager_factory):
+        max_workers = max_workers if max_workers else os.cpu_count()
+        max_in_flight = max_in_flight if max_in_flight else 2 * max_workers
+        pending = iter(images)
+        in_flight = set()
+
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(manager_factory,)) as pool:
+            while True:
+                # keep the queue topped up without materialising every future at once
+                for image in pending:
+                    in_flight.add(pool.submit(_extract_image_units, image.ImageID, classes))
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for result in future.result():
+                        self.__push_objects(*result)
+
+    def __push_objects(self, imageID, Class, objects: list[ImageObject_bb]):
+        # objects is the full result set of the unit and replaces the previous run's, None means nothing changed
+        if objects is None:
+            return
+        self.imageobject_db.replace_imageobjects(imageID, Class, objects)
+
+
+def build_manager() -> ObjectExtractionManager:
+    return ObjectExtractionManager(MYSQLProjectDatabaseConnector(),
+                                   MYSQLLabelDatabaseConnector(),
+                                   MYSQLLabellerDatabaseConnector(),
+                                   MYSQLImageObjectDatabaseConnector_bb(),
+                                   ObjectExtractionService(MYSQLImageClassMeasureDatabaseConnector(), MYSQLLabellerDatabaseConnector(),
+                                                           stats_db=MYSQLProjectStatsDatabaseConnector()))
+
 
-            query_labellers = f"SELECT * FROM my_image_db.Labeller_skills WHERE Labeller_id IN :ids"
+_worker_manager: ObjectExtractionManager = None
 
-            labellers = self.labeller_db.get_labellers_with_data(query_labellers, {'ids': tuple(labeller_ids)})
+def _init_worker(manager_factory):
+    # runs once per worker process, connections are never shared with the parent
+    global _worker_manager
+    _worker_manager = manager_factory()
 
-            found_labeller_ids = [labeller.LabellerID for labeller in labellers]
-            for labeller_id in labeller_ids:
-                if labeller_id not in found_labeller_ids:
-                    labellers.append(Labeller(labeller_id, Class))
+def _extract_image_units(imageID, classes) -> list[tuple[str, str, list[ImageObject_bb]]]:
+    # every class of one image, one after the other like the serial path
+    image = _worker_manager.project_db.get_image(imageID)
+    return [(imageID, c, _worker_manager.extract_image(image, c)) for c in classes]
 
-            print(labellers)
-            print(labels[0].__dict__)
 
-            objects.append(self.object_service.get_objects(image, Class, labellers, labels, demo=demo))
+def main():
+    parser = argparse.ArgumentParser(description='extract objects from the labels of a project')
+    parser.add_argument('project_id', nargs='?', default='66')
+    parser.add_argument('classes', nargs='*', default=['plane'])
+    parser.add_argument('--demo', action='store_true')
+    parser.add_argument('--parallel', action='store_true')
+    parser.add_argument('--max-workers', type=int, default=None)
+    args = parser.parse_args()
 
-        for object_list in objects:
-            for ob in object_list:
-                self.imageobject_db.push_imageobject(ob)
-        print(f"completed in {time.time()-t} seconds")
+    t = build_manager()
+    t.get_objects(args.project_id, args.classes, demo=args.demo, parallel=args.parallel, max_workers=args.max_workers)
 
 
-t = ObjectExtractionManager(MYSQLProjectDatabaseConnector(),MYSQLLabelDatabaseConnector(), MYSQLLabellerDatabaseConnector(), MYSQLImageObjectDatabaseConnector_bb(), ObjectExtractionService(MYSQLImageClassMeasureDatabaseConnector(), MYSQLLabellerDatabaseConnector()))
-t.get_objects('66', 'plane', demo=False)
+if __name__ == '__main__':
+    main()
 
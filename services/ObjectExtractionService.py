@@ -1,42 +1,54 @@
 
 import sys
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
-from services.DataTypes import ImageObject_bb, Labeller, Label, Image, ImageClassMeasure
+from services.DataTypes import ImageObject_bb, Labeller, Label, Image, ImageClassMeasure, LabelWatermark
 
 import numpy as np
-import pandas as pd
 from services.ImageClassMeasureDatabaseConnector import ImageClassMeasureDatabaseConnector, MYSQLImageClassMeasureDatabaseConnector
-from scipy.special import beta
-from collections import deque
+from services.ConsensusBackend import ConsensusBackend, get_consensus_backend
+from services.LabelRasterizer import label_boxes
+from services.SummedAreaTable import SummedAreaTable
 
 from services.LabellerDatabaseConnector import LabellerDatabaseConnector
+from services.ProjectStatsDatabaseConnector import ProjectStatsDatabaseConnector
 
-import pycuda.driver as cuda
-import pycuda.autoinit
-from pycuda.compiler import SourceModule
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 import copy
 
+# pandas, scipy and matplotlib are imported where they are used so importing the service stays cheap
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 class ObjectExtractionService:
 
     # generates a list of ImageObjects which have likelihoods over a certain amount
 
-    def __init__(self, icm_db: ImageClassMeasureDatabaseConnector, labeller_db: LabellerDatabaseConnector, threshold: float=.7):
+    def __init__(self, icm_db: ImageClassMeasureDatabaseConnector, labeller_db: LabellerDatabaseConnector, threshold: float=.7, backend: ConsensusBackend=None, icm_mode: str='helper', stats_db: ProjectStatsDatabaseConnector=None):
+        # icm_mode 'log_odds' keeps one additive plane per ICM instead of the helper value pair
+        # with a stats_db the confidence of every tile cut from the image is refreshed after each run
         self.threshold = threshold
+        self.icm_mode = icm_mode
         self.icm_db = icm_db
         self.labeller_db = labeller_db
+        self.backend = backend if backend else get_consensus_backend()
+        self.stats_db = stats_db
 
 
     def get_objects(self, image: Image, Class: str, labellers: list[Labeller], labels: list[Label], demo = False) -> list[ImageObject_bb]:
         # get objects for a given image and class
-        image_data = np.asarray(image.image_data)
+        import pandas as pd
+        # PIL reads the size from the header, the pixels are only decoded for the demo plots
+        im_width, im_height = image.image_data.size
 
         if demo:
+            import matplotlib.pyplot as plt
+            import matplotlib.patches as patches
+            image_data = np.asarray(image.image_data)
+
             # Init plotting ----------
             fig = plt.figure(figsize=(18,9))
             # color_bar_ax = plt.subplot2grid((2, 18), (0, 0), colspan=1, rowspan=2)
@@ -70,8 +82,24 @@ class ObjectExtractionService:
             input('press enter to get Labels: ')
             # -------
 
+        icm = self.__get_icm(image.ImageID, Class)
+        # labels already folded into a stored ICM are never applied twice, a labeller the ICM already has only
+        # adds the pixels its new boxes newly cover. Accuracy is judged on all of a labeller's labels
+        watermark = icm.watermark if icm else LabelWatermark()
+        if icm and not watermark.is_current(labels):
+            # an applied box was moved or removed, its old contribution cannot be taken out of the planes
+            print('applied labels changed, rebuilding ICM')
+            icm = None
+            watermark = watermark.reset()
+        applied_labellers = watermark.applied_labellers()
+        label_objects = watermark.new_labels(labels)
+        applied = np.array([watermark.is_applied(label) for label in labels], dtype=bool)
+
         labellers = pd.DataFrame([l.__dict__ for l in labellers])
-        labels = pd.DataFrame([l.__dict__ for l in labels])
+        labels = pd.DataFrame([l.__dict__ for l in labels],
+                              columns=['LabelID', 'LabellerID', 'ImageID', 'Class', 'top_left_x', 'top_left_y', 'bot_right_x', 'bot_right_y',
+                                       'offset_x', 'offset_y', 'creation_time', 'origImageID'])
+        labels['applied'] = applied
 
 
         # plot labels -------------
@@ -103,18 +131,20 @@ class ObjectExtractionService:
 
         print(labels)
         print(labellers)
-        icm = self.__get_icm(image.ImageID, Class)
 
         if not icm:
             print('creating new ICM')
-            icm = ImageClassMeasure(image.ImageID, None, None, None, Class, len(image_data[0]), len(image_data[1]))
+            icm = ImageClassMeasure(image.ImageID, None, None, None, Class, im_width, im_height, mode=self.icm_mode, watermark=watermark)
         else:
             print('ICM loaded')
+            if self.icm_mode == 'log_odds':
+                icm.to_log_odds()
 
         for i, labeller in labellers.iterrows(): 
             print(f'applying label group {i}')
             tmp_labels = labels[labels['LabellerID'] == labeller['LabellerID']]
-            self.__cuda_update_label_likelihood(icm, tmp_labels, Labeller(labeller['LabellerID'],
+            applied_labels = tmp_labels[tmp_labels['applied']] if str(labeller['LabellerID']) in applied_labellers else None
+            self.__update_label_likelihood(icm, tmp_labels[~tmp_labels['applied']], applied_labels, Labeller(labeller['LabellerID'],
                                                                      labeller['skill'],
                                                                      labeller['alpha'],
                                                                      labeller['beta']
@@ -130,11 +160,7 @@ class ObjectExtractionService:
             ax1.set_title("Prediction of Regions Containing a Plane")
             ax1.imshow(image_data)
             cb.remove()
-            prediction = [[0] * icm.im_width for _ in range(icm.im_height)]
-
-            for row in range(len(icm.likelihoods)):
-                    for col in range(len(icm.likelihoods[0])):
-                        prediction[row][col] = 1 if icm.likelihoods[row][col] > self.threshold else 0
+            prediction = self.backend.predict(icm, self.threshold)
 
             im = ax1.imshow(prediction, alpha=0.4, cmap='magma')
             cb = fig.colorbar(im, ax=ax1, orientation='vertical', shrink=0.7)
@@ -164,6 +190,9 @@ class ObjectExtractionService:
             ax1.imshow(image_data)
         # -----------------
 
+        agreement_tables = self.__agreement_tables(icm)
+        if self.stats_db:
+            self.__update_tile_confidence(image, agreement_tables[0])
         for i, labeller in labellers.iterrows():
             id = labeller['LabellerID']
             print(f'updating labeller {id}') 
@@ -173,16 +202,22 @@ class ObjectExtractionService:
                                                                      labeller['alpha'],
                                                                      labeller['beta']
                                                                      )
-            self.__cuda_update_labeller_accuracy(icm, tmp_labels, l)
-            self.labeller_db.push_labeller(l)
+            alpha, beta = self.__labeller_accuracy(icm, agreement_tables, tmp_labels)
+            # push the increment rather than the total so concurrent extraction units don't overwrite each other,
+            # a labeller judged by an earlier run on this ICM only gets the change since then
+            last_alpha, last_beta = icm.watermark.accuracy(id)
+            l.alpha += alpha - last_alpha
+            l.beta += beta - last_beta
+            print(l.alpha, l.beta)
+            self.labeller_db.add_labeller_accuracy(l, alpha - last_alpha, beta - last_beta)
+            icm.watermark.set_accuracy(id, alpha, beta)
         print(icm.likelihoods)
-        groups = self.__find_connected_groups(icm.likelihoods)
-        print(f'found {len(groups)} groups')
+        boxes, pixel_counts, mean_likelihoods = find_components(icm.likelihoods, self.threshold)
+        print(f'found {len(boxes)} groups')
         output = []
-        for group in groups:
-            tly, tlx, bry, brx = extract_bounding_box(group)
+        for (tlx, tly, brx, bry), mean_likelihood in zip(boxes.tolist(), mean_likelihoods.tolist()):
             print(tlx, tly, brx, bry)
-            output.append(ImageObject_bb(None, image.ImageID, Class, 0,  tlx, tly, brx, bry))
+            output.append(ImageObject_bb(None, image.ImageID, Class, mean_likelihood,  tlx, tly, brx, bry))
             if demo:
                 rect = patches.Rectangle((tlx, tly), brx-tlx , bry-tly, linewidth=2, color='g', fill=False)
                 ax1.add_patch(rect)
@@ -191,6 +226,7 @@ class ObjectExtractionService:
             plt.savefig('demo.jpeg')
 
         print("updating icm")
+        icm.watermark.advance(label_objects)
         self.icm_db.push_imageclassmeasure_images(icm)
         print("icm updated")
         return output
@@ -202,332 +238,71 @@ class ObjectExtractionService:
         return self.icm_db.get_imageclassmeasures_images(query)
 
 
-    def __update_label_likelihood(self, icm: ImageClassMeasure, labels:pd.DataFrame, labeller: Labeller):
-    # modifies the probabilities of each pixel being in the class based on a new set of labels made by the same labeler
-    # can be ported to GPU if performance requires
-
-        a = labeller.alpha
-        b = labeller.beta
-
-        for row in range(icm.im_height):
-            for col in range(icm.im_width):
-                class_prediction = 0
-                for i, label in labels.iterrows():
-                    if (col >= label['top_left_x'] + label['offset_x'] and col <= label['bot_right_x'] + label['offset_x'] and row >= label['top_left_y'] + label['offset_y'] and row <= label['bot_right_y'] + label['offset_y']):
-                        class_prediction = 1
-                icm.helper_values[row][col][0] *= beta(1-class_prediction + a, class_prediction + b)
-                icm.helper_values[row][col][1] *= beta(class_prediction + a, 1-class_prediction + b)
-                icm.likelihoods[row][col] = icm.helper_values[row][col][1] / (icm.helper_values[row][col][1] + icm.helper_values[row][col][0])
-
-    def __cuda_update_label_likelihood(self, icm: ImageClassMeasure, labels:pd.DataFrame, labeller: Labeller):
-        mod = SourceModule("""
-                           #define CUDA_PRINTF
-            struct Small_Label {
-                int top_left_x;
-                int top_left_y;
-                int bot_right_x;
-                int bot_right_y;
-            };
-            __global__ void update_likelihoods(double* likelihoods, double* helper_value_1, 
-                                   double* helper_value_2, bool* predictions, 
-                                   double alpha, double beta, int im_x, int im_y)
-                {
-                    int index = blockIdx.x * blockDim.x + threadIdx.x;
-                    if (index >= im_x * im_y) return;  // Ensure valid index
-
-                    float prediction = predictions[index] ? 1.0f : 0.0f;
-
-                    double log_gamma_3 = lgamma(fmax(1 + alpha + beta, 1e-9));
-
-                    
-
-                    helper_value_1[index] *= exp(lgamma(fmax(1 - prediction + alpha, 1e-9)) + lgamma(fmax(prediction + beta, 1e-9)) - log_gamma_3);
-                    helper_value_2[index] *= exp(lgamma(fmax(prediction + alpha, 1e-9)) + lgamma(fmax(1 - prediction + beta, 1e-9)) - log_gamma_3);
-
-                    double denominator = helper_value_1[index] + helper_value_2[index] + 1e-9;  
-                    likelihoods[index] = helper_value_2[index] / denominator;
-
-                    // Debugging: Print some values
-                    //if (index % 1000 == 0) {
-                    //    printf("Index %d: helper_1=%f, helper_2=%f, likelihood=%f\\n", 
-                    //        index, helper_value_1[index], helper_value_2[index], likelihoods[index]);
-                    //}
-                }
-
-                           
-            __global__ void mark_predictions(bool* d_predictions, Small_Label* d_labels, int num_labels, int im_x, int im_y) {
-                int idx = blockIdx.x * blockDim.x + threadIdx.x;
-                if (idx >= num_labels) return;
-
-                Small_Label l = d_labels[idx];
-
-                for (int row = l.top_left_y; row <= l.bot_right_y; row++) {
-                    for (int col = l.top_left_x; col <= l.bot_right_x; col++) {
-                        d_predictions[row * im_x + col] = true;
-                    }
-                }
-            }
-        """)
-        update_likelihoods = mod.get_function("update_likelihoods")
-        mark_predictions = mod.get_function("mark_predictions")
-        print(labels, len(labels))
-        Small_Label_dtype = np.dtype([('top_left_x', np.int32),
-                              ('top_left_y', np.int32),
-                              ('bot_right_x', np.int32),
-                              ('bot_right_y', np.int32)])
-        small_labels = np.empty(len(labels), dtype=Small_Label_dtype)
-
-        
-        for i, label in labels.reset_index().iterrows():
-            small_labels[i-1] = (label['top_left_x']+label['offset_x'],
-                                label['top_left_y']+label['offset_y'],
-                                label['bot_right_x']+label['offset_x'],
-                                label['bot_right_y']+label['offset_y'])
-            
-        helper_values_1 = [[pixel[0] for pixel in row] for row in icm.helper_values]
-        helper_values_2 = [[pixel[1] for pixel in row] for row in icm.helper_values]
-
-        d_labels = cuda.mem_alloc(small_labels.nbytes)
-        size = icm.im_width*icm.im_height
-        d_predictions = cuda.mem_alloc(size * np.bool8().itemsize)  # Boolean predictions array
-        d_likelihoods = cuda.mem_alloc(size * np.float64().itemsize)  # Likelihoods array
-        d_helper_value_1 = cuda.mem_alloc(size * np.float64().itemsize)  # Helper value 1
-        d_helper_value_2 = cuda.mem_alloc(size * np.float64().itemsize)  # Helper value 2
-
-        cuda.memcpy_htod(d_likelihoods, np.ascontiguousarray(icm.likelihoods, dtype=np.float64).ravel())
-        cuda.memcpy_htod(d_helper_value_1, np.ascontiguousarray(helper_values_1, dtype=np.float64).ravel())
-        cuda.memcpy_htod(d_helper_value_2, np.ascontiguousarray(helper_values_2, dtype=np.float64).ravel())
-        cuda.memcpy_htod(d_labels, small_labels)
-        cuda.memset_d8(d_predictions, 0, size * np.bool8().itemsize)
-
-        block_size = 256
-        num_blocks = (len(labels) + block_size - 1) // block_size
-
-        mark_predictions(d_predictions, d_labels, np.int32(len(labels)), np.int32(icm.im_width), np.int32(icm.im_height),
-                     block=(block_size, 1, 1), grid=(num_blocks, 1))
-        cuda.Context.synchronize()
-
-
-        alpha = labeller.alpha
-        beta = labeller.beta
-
-
-        num_blocks = (icm.im_height*icm.im_width + block_size - 1) // block_size
-        update_likelihoods(d_likelihoods, d_helper_value_1, d_helper_value_2, d_predictions, 
-                       np.float64(alpha), np.float64(beta), np.int32(icm.im_width), np.int32(icm.im_height),
-                       block=(block_size, 1, 1), grid=(num_blocks, 1))
-        cuda.Context.synchronize()
-
-        likelihoods = np.empty(size, dtype=np.float64)
-        helper_value_1 = np.empty(size, dtype=np.float64)
-        helper_value_2 = np.empty(size, dtype=np.float64)
-        preds = np.empty(size, dtype=np.bool8)
-
-        cuda.memcpy_dtoh(likelihoods, d_likelihoods)
-        cuda.memcpy_dtoh(helper_value_1, d_helper_value_1)
-        cuda.memcpy_dtoh(helper_value_2, d_helper_value_2)
-        cuda.memcpy_dtoh(preds, d_predictions)
-
-        print("First 10 likelihood values after CUDA execution:", likelihoods[:10])
-        icm.likelihoods = likelihoods.reshape(icm.im_width, icm.im_height)
-        icm.helper_values = np.stack((helper_value_1.reshape(icm.im_width, icm.im_height), helper_value_2.reshape(icm.im_width, icm.im_height)), axis=-1)
+    def __update_label_likelihood(self, icm: ImageClassMeasure, labels: 'pd.DataFrame', applied_labels: 'pd.DataFrame', labeller: Labeller):
+        # modifies the probabilities of each pixel being in the class based on a new set of labels made by the same labeler,
+        # applied_labels are the labeller's labels already in the ICM, None when the labeller is not in it yet
+        applied_boxes = label_boxes(applied_labels) if applied_labels is not None else None
+        self.backend.update_likelihoods_in_boxes(icm, label_boxes(labels), labeller.alpha, labeller.beta, applied_boxes)
 
+    def __update_label_confidence(self, icm: ImageClassMeasure):
+        self.backend.update_confidence(icm, self.threshold)
+
+    def __agreement_tables(self, icm: ImageClassMeasure) -> tuple[SummedAreaTable, SummedAreaTable]:
+        # integral images of confidence and confidence * prediction, built once and shared by every labeller
+        class_predictions = self.backend.predict(icm, self.threshold)
+        return SummedAreaTable(icm.confidence), SummedAreaTable(icm.confidence * class_predictions)
+
+    def __update_tile_confidence(self, image: Image, confidence: SummedAreaTable):
+        # mean pixel confidence over each tile's window, Images has one confidence column so the last class extracted wins.
+        # ObjectExtractionManager runs the classes of an image one after the other, never two at once
+        tile_ids, windows = self.stats_db.get_tile_windows(image.ImageID)
+        if not tile_ids:
+            return
+        windows = np.clip(windows, 0, [confidence.im_width, confidence.im_height, confidence.im_width, confidence.im_height])
+        areas = (windows[:, 2] - windows[:, 0]) * (windows[:, 3] - windows[:, 1])
+        means = confidence.window_sums(windows) / np.maximum(areas, 1)
+        self.stats_db.set_tile_confidences(list(zip(tile_ids, means.tolist())))
+
+    def __labeller_accuracy(self, icm: ImageClassMeasure, agreement_tables: tuple[SummedAreaTable, SummedAreaTable], labels: 'pd.DataFrame') -> tuple[float, float]:
+        # (alpha, beta) increment of a labeller's accuracy based on proportion of pixels correctly labeled
+        # agreement = predicted positive confidence inside the labeller's boxes + predicted negative confidence outside
+        image_size = icm.im_height * icm.im_width
+        confidence, positive_confidence = agreement_tables
+        boxes = label_boxes(labels)
 
-        d_predictions.free()
-        d_likelihoods.free()
-        d_helper_value_1.free()
-        d_helper_value_2.free()
-        d_labels.free()
+        confidence_inside = confidence.union_sum(boxes)
+        positive_inside = positive_confidence.union_sum(boxes)
 
+        a = positive_inside + (confidence.total - confidence_inside) - (positive_confidence.total - positive_inside)
+        b = confidence.total - a
 
+        return float(a/image_size), float(b/image_size)
 
-    def __update_label_confidence(self, icm: ImageClassMeasure):
-        for row in range(icm.im_height):
-            for col in range(icm.im_width):
-                prediction = 1 if icm.likelihoods[row][col] > self.threshold else 0
-                icm.confidence[row][col] = abs(icm.likelihoods[row][col] - 1 + prediction)
-
-    def __cuda_update_label_confidence(self, icm: ImageClassMeasure):
-        mod = SourceModule("""
-            __global__ void update_confidence(double* likelihoods, double* confidence, 
-                                                double threshold, int im_x, int im_y)
-            {
-                int index = blockIdx.x * blockDim.x + threadIdx.x;
-                if (index < im_x * im_y) {
-                    confidence[index] = abs(likelihoods[index]-1 + (likelihoods[index] > threshold));
-                }
-            }
-                           
-        """)
-
-    def __update_labeler_accuracy(self, icm: ImageClassMeasure, labels:pd.DataFrame, labeller: Labeller):
-        # update agent accuracy based on proportion of pixels correctly labeled
-        image_size = icm.im_height * icm.im_width
-        a:float = 0
-        b:float = 0
-
-        for row in range(icm.im_height):
-            for col in range(icm.im_width):
-                class_prediction = 1 if icm.likelihoods[row][col] > self.threshold else 0
-                label_prediction = 0
-                for i, label in labels.iterrows():
-                    if (col >= label['top_left_x'] + label['offset_x'] and col <= label['bot_right_x'] + label['offset_x'] and row >= label['top_left_y'] + label['offset_y'] and row <= label['bot_right_y'] + label['offset_y']):
-                        label_prediction = 1
-                        break
-                if class_prediction == label_prediction:
-                    a += icm.confidence[row][col]
-                else:
-                    b += icm.confidence[row][col]
-        
-        labeller.alpha += a/image_size
-        labeller.beta += b/image_size
-
-    def __cuda_update_labeller_accuracy(self, icm: ImageClassMeasure, labels:pd.DataFrame, labeller: Labeller):
-        mod = SourceModule("""
-                           #define CUDA_PRINTF
-            struct Small_Label {
-                int top_left_x;
-                int top_left_y;
-                int bot_right_x;
-                int bot_right_y;
-            };
-                           
-            __global__ void mark_predictions(bool* d_predictions, Small_Label* d_labels, int num_labels, int im_x, int im_y) {
-                int idx = blockIdx.x * blockDim.x + threadIdx.x;
-                if (idx >= num_labels) return;
-
-                Small_Label l = d_labels[idx];
-
-                for (int row = l.top_left_y; row <= l.bot_right_y; row++) {
-                    for (int col = l.top_left_x; col <= l.bot_right_x; col++) {
-                        d_predictions[row * im_x + col] = true;
-                    }
-                }
-            }
-        """)
-        mark_predictions = mod.get_function("mark_predictions")
-
-        Small_Label_dtype = np.dtype([('top_left_x', np.int32),
-                              ('top_left_y', np.int32),
-                              ('bot_right_x', np.int32),
-                              ('bot_right_y', np.int32)])
-        small_labels = np.empty(len(labels), dtype=Small_Label_dtype)
-        for i, label in labels.reset_index().iterrows():
-            small_labels[i] = (label['top_left_x']+label['offset_x'],
-                                label['top_left_y']+label['offset_y'],
-                                label['bot_right_x']+label['offset_x'],
-                                label['bot_right_y']+label['offset_y'])
-
-        d_labels = cuda.mem_alloc(small_labels.nbytes)
-        
-        size = icm.im_width*icm.im_height
-        d_predictions = cuda.mem_alloc(size * np.bool8().itemsize)  # Boolean predictions array
-        cuda.memcpy_htod(d_labels, small_labels)
-        cuda.memset_d8(d_predictions, 0, size * np.bool8().itemsize)
-
-        block_size = 256
-        num_blocks = (len(labels) + block_size - 1) // block_size
-
-        mark_predictions(d_predictions, d_labels, np.int32(len(labels)), np.int32(icm.im_width), np.int32(icm.im_height),
-                     block=(block_size, 1, 1), grid=(num_blocks, 1))
-        cuda.Context.synchronize()
-        
-
-
-
-        preds = np.empty(size, dtype=np.bool8)
-        cuda.memcpy_dtoh(preds, d_predictions)
-        preds = preds.reshape(icm.im_width, icm.im_height)
-
-        d_predictions.free()
-        d_labels.free()
-
-
-        a:float = 0
-        b:float = 0
-        image_size = icm.im_height * icm.im_width
-        miss_count = 0
-        for row in range(icm.im_height):
-            for col in range(icm.im_width):
-                class_prediction = 1 if icm.likelihoods[row][col] > self.threshold else 0
-                if class_prediction == preds[row][col]:
-                    a += icm.confidence[row][col]
-                else:
-                    miss_count += 1
-                    b += icm.confidence[row][col]
-        
-        labeller.alpha += a/image_size
-        labeller.beta += b/image_size
 
-        print(miss_count)
-        print(labeller.alpha, labeller.beta)
+def find_components(likelihoods: np.ndarray, threshold: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Labels the 8-connected groups of pixels with a likelihood above threshold.
 
+    :param likelihoods: 2D array of per pixel likelihoods
+    :param threshold: a pixel is part of a group when its likelihood is strictly above this
+    :return: (boxes, pixel_counts, mean_likelihoods) with one row per group, boxes laid out as
+             inclusive (top_left_x, top_left_y, bot_right_x, bot_right_y)
+    """
+    from scipy import ndimage
 
+    likelihoods = np.asarray(likelihoods, dtype=np.float64)
+    component_ids, num_components = ndimage.label(likelihoods > threshold, structure=np.ones((3, 3), dtype=bool))
+    if num_components == 0:
+        return np.empty((0, 4), dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
 
+    flat_ids = component_ids.ravel()
+    pixel_counts = np.bincount(flat_ids, minlength=num_components + 1)[1:]
+    likelihood_sums = np.bincount(flat_ids, weights=likelihoods.ravel(), minlength=num_components + 1)[1:]
 
-    def __find_connected_groups(self, grid):
-        """
-        Identifies all groups of connected pixels above a given threshold.
+    boxes = np.array([(cols.start, rows.start, cols.stop - 1, rows.stop - 1)
+                      for rows, cols in ndimage.find_objects(component_ids)], dtype=np.int64)
+    return boxes, pixel_counts, likelihood_sums / pixel_counts
 
-        :param grid: 2D list of numerical values
-        :param threshold: Minimum value for a pixel to be included in a group
-        :return: List of groups, where each group is a list of (x, y) coordinates
-        """
-        print(grid)
-        # if not grid or not grid[0]:  # Handle empty input
-        #     return []
-
-        rows, cols = len(grid), len(grid[0])
-        visited = set()  # Keep track of visited pixels
-        groups = []  # List to store all groups
-
-        # 8 possible directions (up, down, left, right, diagonals)
-        directions = [(-1, -1), (-1, 0), (-1, 1),
-                    (0, -1),         (0, 1),
-                    (1, -1), (1, 0), (1, 1)]
-
-        def __bfs(start_x, start_y):
-            """Performs BFS to find all connected pixels in a group."""
-            queue = deque([(start_x, start_y)])
-            group = []  # Store (x, y) positions of the current group
-            visited.add((start_x, start_y))
-
-            while queue:
-                x, y = queue.popleft()
-                group.append((x, y))
-
-                for dx, dy in directions:
-                    nx, ny = x + dx, y + dy
-                    if 0 <= nx < rows and 0 <= ny < cols and (nx, ny) not in visited:
-                        if grid[nx][ny] > self.threshold:
-                            queue.append((nx, ny))
-                            visited.add((nx, ny))
-
-            return group
-
-        # Iterate through the grid
-        for i in range(rows):
-            for j in range(cols):
-                if grid[i][j] > self.threshold and (i, j) not in visited:
-                    groups.append(__bfs(i, j))
-
-        return groups
-
-def extract_bounding_box(pixels):
-    # Convert list of pixels to a numpy array for efficient computation
-    pixels_np = np.array(pixels)
-    
-    # Extract x and y coordinates
-    x_coords = pixels_np[:, 0]
-    y_coords = pixels_np[:, 1]
-    
-    # Calculate the bounding box
-    top_left_x = np.min(x_coords)
-    top_left_y = np.min(y_coords)
-    bot_right_x = np.max(x_coords)
-    bot_right_y = np.max(y_coords)
-    
-    return top_left_x, top_left_y, bot_right_x, bot_right_y
 # o = ObjectExtractionService()
 # i = Image('1','2','1')
 # ls = [Labeller('t', 'boat','1.1','1.2'),
@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
 import os
 import io
+from functools import partial
+from typing import Iterator
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 import uuid
 import time
 import datetime
@@ -12,6 +14,7 @@ from pathlib import Path
 
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
+from services.EngineRegistry import get_engine
 
 from services.DataTypes import Project, Image
 import urllib.parse
@@ -30,6 +33,22 @@ class ProjectDatabaseConnector(ABC):
     def get_projects(self, query:str) -> list[Project]:
         pass
 
+    @abstractmethod
+    def get_image(self, imageID) -> Image:
+        pass
+
+    @abstractmethod
+    def get_image_data(self, imageID) -> pilImage:
+        pass
+
+    @abstractmethod
+    def iter_images(self, project_id) -> Iterator[Image]:
+        pass
+
+    @abstractmethod
+    def get_project_summary(self, project_id) -> dict:
+        pass
+
 class NoneDB(ProjectDatabaseConnector):
 
 
@@ -40,38 +59,33 @@ class NoneDB(ProjectDatabaseConnector):
     def get_projects(self, query:str) -> list[Project]:
         pass
 
+
+    def get_image(self, imageID) -> Image:
+        pass
+
+
+    def get_image_data(self, imageID) -> pilImage:
+        pass
+
+
+    def iter_images(self, project_id) -> Iterator[Image]:
+        return iter([])
+
+
+    def get_project_summary(self, project_id) -> dict:
+        pass
+
 class MYSQLProjectDatabaseConnector(ProjectDatabaseConnector):
 
     def __init__(self, table:str='Projects'):
+        # the shared engine is looked up on first use, building a connector never touches the database
         self.cnx = None
-        self.make_db_connection()
         self.table=table
 
     def make_db_connection(self):
-        
-        load_dotenv()
-        MYSQLUSER=os.getenv('_LABELDATABASE_MYSQLUSER')
-        MYSQLPASSWORD=os.getenv('_LABELDATABASE_MYSQLPASSWORD')
-        MYSQLHOST=os.getenv('_LABELDATABASE_MYSQLHOST')
-        MYSQLDATABASE=os.getenv('_LABELDATABASE_MYSQLDATABASE')
-
-        try:
-            self.cnx = create_engine(
-    url=f"mysql+pymysql://{str(MYSQLUSER)}:{urllib.parse.quote_plus(str(MYSQLPASSWORD))}"
-        f"@{urllib.parse.quote_plus(str(MYSQLHOST))}/{MYSQLDATABASE}"
-)
-                                                
-        except Exception as e:
-            print("Error {e}")
-            raise ConnectionError(e)
-        
-        if self.cnx:
-            try:
-                self.cnx.connect()
-                print('connection successful')
-            except Exception as e:
-                print("Error {e}")
-                raise ConnectionError(e)
+        # one engine per DSN is shared by every connector in the process, see services/EngineRegistry.py
+        if self.cnx is None:
+            self.cnx = get_engine()
 
 
     def get_projects(self, query:str) -> list[Project]:
@@ -98,8 +112,9 @@ class MYSQLProjectDatabaseConnector(ProjectDatabaseConnector):
             print(categories)
 
 
+            # only ids are listed, each Image fetches and decodes its blob the first time its pixels are read
             query = text("""
-            SELECT * FROM OriginalImages WHERE projectId = :project_id;
+            SELECT id, projectId FROM OriginalImages WHERE projectId = :project_id;
         """)
 
 
@@ -113,12 +128,84 @@ class MYSQLProjectDatabaseConnector(ProjectDatabaseConnector):
                     print(f"Query returned {result.rowcount} results") 
 
                     for res in result:
-                        images.append(Image(res[0], res[1], pilImage.open(io.BytesIO(res[2]))))
+                        images.append(Image(res[0], res[1], loader=partial(self.get_image_data, res[0])))
                     projects.append(Project(id, categories[i], images.copy(), end_dates[i]))
             except Exception as e:
                 print("Error {e}")
                 raise Exception(e)
         return projects
+
+    def get_image(self, imageID) -> Image:
+        # a single original image, lets worker processes load their own pixels instead of receiving them pickled
+        self.make_db_connection()
+        query = text("""
+            SELECT * FROM OriginalImages WHERE id = :image_id;
+        """)
+
+        with self.cnx.connect() as connection:
+            try:
+                res = connection.execute(query, {"image_id": imageID}).first()
+            except Exception as e:
+                print("Error {e}")
+                raise Exception(e)
+        if not res:
+            return None
+        return Image(res[0], res[1], pilImage.open(io.BytesIO(res[2])))
+
+    def get_image_data(self, imageID) -> pilImage:
+        # pixels of one original image, the loader behind the lazy Images of get_projects
+        self.make_db_connection()
+        query = text("""
+            SELECT image FROM OriginalImages WHERE id = :image_id;
+        """)
+
+        with self.cnx.connect() as connection:
+            try:
+                res = connection.execute(query, {"image_id": imageID}).first()
+            except Exception as e:
+                print("Error {e}")
+                raise Exception(e)
+        if not res:
+            return None
+        return pilImage.open(io.BytesIO(res[0]))
+
+    def iter_images(self, project_id) -> Iterator[Image]:
+        '''
+        Streams the original images of a project one at a time over a server side cursor, so only the
+        image being consumed is held in memory. The connection stays checked out until the generator ends
+        '''
+        self.make_db_connection()
+        query = text("""
+            SELECT id, projectId, image FROM OriginalImages WHERE projectId = :project_id;
+        """)
+
+        with self.cnx.connect() as connection:
+            try:
+                result = connection.execution_options(stream_results=True).execute(query, {"project_id": project_id})
+                for res in result:
+                    yield Image(res[0], res[1], pilImage.open(io.BytesIO(res[2])))
+            except Exception as e:
+                print("Error {e}")
+                raise Exception(e)
+
+    def get_project_summary(self, project_id) -> dict:
+        # end date and image count of a project without loading or decoding its images, None if it doesn't exist
+        self.make_db_connection()
+        query = text("""
+            SELECT p.endDate,
+                   (SELECT COUNT(*) FROM OriginalImages o WHERE o.projectId = p.projectId) AS num_images
+            FROM Projects p WHERE p.projectId = :project_id;
+        """)
+
+        with self.cnx.connect() as connection:
+            try:
+                res = connection.execute(query, {"project_id": project_id}).first()
+            except Exception as e:
+                print("Error {e}")
+                raise Exception(e)
+        if not res:
+            return None
+        return {'end_date': res[0], 'num_images': int(res[1])}
     
             
 
@@ -0,0 +1,445 @@
+import os
+import time
+import uuid
+import hashlib
+import tempfile
+import argparse
+import threading
+import traceback
+import sys
+import pymysql.cursors
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from services.core_img_db_connector import get_db_connection
+
+# Config
+# ------------------------------------------------------------
+JOB_WORKERS = 2 # PROJECT_JOB_WORKERS - projects tiled at once, each also runs its own PNG encoder threads
+UPLOAD_DIR = os.path.join(project_root, 'uploads') # PROJECT_UPLOAD_DIR - spooled uploads and decoded caches
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # bytes read from the upload stream at a time
+PACKET_OVERHEAD = 1024 # bytes of an INSERT besides the hex encoded image, counted against max_allowed_packet
+POLL_INTERVAL = 2.0 # PROJECT_JOB_POLL_INTERVAL - seconds between looks for queued jobs, also the heartbeat
+LEASE_SECONDS = 120 # PROJECT_JOB_LEASE - a running job without a heartbeat for this long is taken over
+MAX_ATTEMPTS = 3 # PROJECT_JOB_MAX_ATTEMPTS - runs of a job before it fails for good
+RETRY_DELAY = 30 # seconds before a failed job runs again, times the attempts so far
+# ------------------------------------------------------------
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def upload_dir() -> str:
+    directory = os.getenv('PROJECT_UPLOAD_DIR', UPLOAD_DIR)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def spool_upload(stream) -> tuple[str, str, int]:
+    '''
+    Copies an upload stream to a file in the upload directory UPLOAD_CHUNK_SIZE bytes at a time, hashing it
+    on the way. Returns (path, sha256, size)
+    '''
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=upload_dir(), suffix='.upload', delete=False) as f:
+        try:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return f.name, digest.hexdigest(), size
+
+
+class OriginalTooLargeError(Exception):
+    '''
+    Raised by store_original when the image does not fit in one statement under the server's max_allowed_packet
+    '''
+
+
+def store_original(cursor, project_id: int, path: str) -> int:
+    '''
+    Inserts the image file at path into OriginalImages with one INSERT and returns the id of the new row.
+    The statement has to fit in the server's max_allowed_packet, a larger file raises OriginalTooLargeError
+    before anything is read. The file is held in memory for the one statement, pymysql sends it hex encoded
+    '''
+    cursor.execute("SELECT @@max_allowed_packet")
+    limit = (cursor.fetchone()[0] - PACKET_OVERHEAD) // 2
+    size = os.path.getsize(path)
+    if size > limit:
+        raise OriginalTooLargeError(f"image of {size} bytes is larger than the database accepts ({limit} bytes)")
+    with open(path, 'rb') as f:
+        image = f.read()
+    cursor.execute("INSERT INTO OriginalImages (projectId, image) VALUES (%s, %s)", (project_id, image))
+    return cursor.lastrowid
+
+
+def fetch_original(cursor, original_image_id: int, path: str) -> bool:
+    # writes a stored original image to path, False if there is no such image. One unbuffered read on the
+    # cursor's connection, the blob is held in memory once until it is written
+    stream = cursor.connection.cursor(pymysql.cursors.SSCursor)
+    try:
+        stream.execute("SELECT image FROM OriginalImages WHERE id = %s", (original_image_id,))
+        row = stream.fetchone()
+        if not row:
+            return False
+        with open(path, 'wb') as f:
+            f.write(row[0])
+        del row
+        return True
+    finally:
+        stream.close()
+
+
+def create_job(cursor, project_id: int, original_image_id: int, upload_path: str=None, sha256: str=None) -> str:
+    '''
+    Adds a tiling job for an original image that is already stored. Run it on the cursor that inserted the
+    image so the job is committed together with it, the runner process picks it up once it is committed.
+    The job decodes the spooled upload at upload_path when it is given, otherwise the stored blob
+    '''
+    job_id = str(uuid.uuid4())
+    cursor.execute("""
+        INSERT INTO ProjectJobs (job_id, project_id, original_image_id, status, upload_path, sha256)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, (job_id, project_id, original_image_id, QUEUED, upload_path, sha256))
+    return job_id
+
+
+def get_job(job_id: str) -> dict:
+    # job row with a progress fraction, None if there is no such job
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT job_id, project_id, original_image_id, status, tiles_done, tiles_total, attempts, error,
+                   sha256, created_at, started_at, finished_at, heartbeat_at, retry_at
+            FROM ProjectJobs WHERE job_id = %s
+        """, (job_id,))
+        job = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+    if not job:
+        return None
+    job['progress'] = job['tiles_done'] / job['tiles_total'] if job['tiles_total'] else 0.0
+    return job
+
+
+class ProjectJobRunner():
+    '''
+    Tiles uploaded images in the background. Jobs live in the ProjectJobs table (sql/project_jobs.sql), the
+    API only inserts them. The runner polls for queued jobs every poll_interval seconds, a worker claims
+    one, cuts and stores its tiles and records progress as batches are written.
+    Every poll also renews the heartbeat of the jobs this runner is working on. A running job whose
+    heartbeat is older than lease_seconds belonged to a runner that died and is taken over. A job that
+    fails runs again after RETRY_DELAY seconds, after max_attempts runs it is marked failed and its files
+    are removed. A job that ran before starts over after its partial tiles are removed. Run it as its own
+    process, python services/ProjectJobRunner.py, once per deployment
+    '''
+
+    def __init__(self, workers: int=None, poll_interval: float=None, lease_seconds: int=None, max_attempts: int=None):
+        self.workers = workers if workers else int(os.getenv('PROJECT_JOB_WORKERS', JOB_WORKERS))
+        self.poll_interval = poll_interval if poll_interval else float(os.getenv('PROJECT_JOB_POLL_INTERVAL', POLL_INTERVAL))
+        self.lease_seconds = lease_seconds if lease_seconds else int(os.getenv('PROJECT_JOB_LEASE', LEASE_SECONDS))
+        self.max_attempts = max_attempts if max_attempts else int(os.getenv('PROJECT_JOB_MAX_ATTEMPTS', MAX_ATTEMPTS))
+        self.pool = None
+        self.poller = None
+        self.stopping = threading.Event()
+        self.active = {} # job_id -> attempt this runner claimed, None until it is claimed
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.pool is not None:
+                return self
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='project-job')
+            self.stopping.clear()
+        self.poller = threading.Thread(target=self.__poll, name='project-job-poller', daemon=True)
+        self.poller.start()
+        return self
+
+    def stop(self, wait: bool=True):
+        self.stopping.set()
+        if self.poller and wait:
+            self.poller.join()
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=wait)
+
+    def submit(self, job_id: str):
+        # runs a job on this runner's workers, the poller does this for every queued job it finds
+        with self.lock:
+            if self.pool is None or job_id in self.active:
+                return
+            self.active[job_id] = None
+            self.pool.submit(self.__run_active, job_id)
+
+    def __run_active(self, job_id: str):
+        try:
+            self.run_job(job_id)
+        finally:
+            with self.lock:
+                self.active.pop(job_id, None)
+
+    def __poll(self):
+        while not self.stopping.is_set():
+            try:
+                self.__heartbeat()
+                self.__reclaim_expired()
+                with self.lock:
+                    free = self.workers - len(self.active)
+                if free > 0:
+                    for job_id in self.__queued_jobs(free):
+                        self.submit(job_id)
+            except Exception as e:
+                print(f"Error polling project jobs: {e}")
+            self.stopping.wait(self.poll_interval)
+
+    def run_job(self, job_id: str):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            job = self.__claim(conn, cursor, job_id)
+            if not job:
+                return
+            project_id, original_image_id, upload_path, sha256, attempt = job
+            with self.lock:
+                self.active[job_id] = attempt
+            try:
+                self.__tile(conn, cursor, job_id, attempt, project_id, original_image_id, upload_path, sha256)
+            except Exception as e:
+                traceback.print_exc()
+                conn.rollback()
+                self.__fail(job_id, attempt, original_image_id, upload_path, str(e))
+        finally:
+            cursor.close()
+            conn.close()
+
+    def __heartbeat(self):
+        with self.lock:
+            claimed = [(job_id, attempt) for job_id, attempt in self.active.items() if attempt is not None]
+        if not claimed:
+            return
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            for job_id, attempt in claimed:
+                cursor.execute("""
+                    UPDATE ProjectJobs SET heartbeat_at = NOW() WHERE job_id = %s AND status = %s AND attempts = %s
+                """, (job_id, RUNNING, attempt))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def __reclaim_expired(self):
+        # running jobs whose runner stopped renewing the lease, they are retried or failed like any failed run
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT job_id, attempts, original_image_id, upload_path FROM ProjectJobs
+                WHERE status = %s AND COALESCE(heartbeat_at, started_at) < NOW() - INTERVAL %s SECOND
+            """, (RUNNING, self.lease_seconds))
+            expired = cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+        for job_id, attempt, original_image_id, upload_path in expired:
+            print(f"project job {job_id} has no heartbeat for {self.lease_seconds}s, taking it over")
+            self.__fail(job_id, attempt, original_image_id, upload_path, f"lease expired after {self.lease_seconds}s")
+
+    def __queued_jobs(self, limit: int) -> list[str]:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                SELECT job_id FROM ProjectJobs WHERE status = %s AND (retry_at IS NULL OR retry_at <= NOW())
+                ORDER BY created_at LIMIT %s
+            """, (QUEUED, limit))
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            conn.close()
+
+    def __claim(self, conn, cursor, job_id: str):
+        # only one worker gets a queued job, returns (project_id, original_image_id, upload_path, sha256, attempt) or None
+        cursor.execute("""
+            UPDATE ProjectJobs SET status = %s, attempts = attempts + 1, tiles_done = 0,
+                   started_at = NOW(), heartbeat_at = NOW(), finished_at = NULL
+            WHERE job_id = %s AND status = %s AND (retry_at IS NULL OR retry_at <= NOW())
+        """, (RUNNING, job_id, QUEUED))
+        claimed = cursor.rowcount == 1
+        conn.commit()
+        if not claimed:
+            return None
+        cursor.execute("SELECT project_id, original_image_id, upload_path, sha256, attempts FROM ProjectJobs WHERE job_id = %s", (job_id,))
+        return cursor.fetchone()
+
+    def __fail(self, job_id: str, attempt: int, original_image_id: int, upload_path: str, error: str):
+        # requeues the run that failed, or fails the job for good after max_attempts runs and removes its files.
+        # Only the run that holds the job, status running with the same attempt, can change it
+        final = attempt >= self.max_attempts
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            if final:
+                cursor.execute("""
+                    UPDATE ProjectJobs SET status = %s, error = %s, finished_at = NOW()
+                    WHERE job_id = %s AND status = %s AND attempts = %s
+                """, (FAILED, error, job_id, RUNNING, attempt))
+            else:
+                cursor.execute("""
+                    UPDATE ProjectJobs SET status = %s, error = %s, retry_at = NOW() + INTERVAL %s SECOND
+                    WHERE job_id = %s AND status = %s AND attempts = %s
+                """, (QUEUED, error, RETRY_DELAY * attempt, job_id, RUNNING, attempt))
+            changed = cursor.rowcount == 1
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+        if not changed:
+            return
+        if final:
+            print(f"project job {job_id} failed after {attempt} attempts: {error}")
+            self.__remove_files(job_id, original_image_id, upload_path)
+        else:
+            print(f"project job {job_id} failed on attempt {attempt} of {self.max_attempts}, retrying: {error}")
+
+    def __remove_files(self, job_id: str, original_image_id: int, upload_path: str):
+        # the spooled upload, the blob written out in its place and their decoded caches
+        from services.TileRenderer import source_path as tile_source_path
+
+        sources = [os.path.join(upload_dir(), f"{job_id}.upload")]
+        if upload_path:
+            sources.append(upload_path)
+        # a job that failed for good committed no tiles, so no virtual tile renders from this cache
+        caches = [path + '.npy' for path in sources] + [tile_source_path(original_image_id)]
+        for path in sources + caches + [path + '.part' for path in caches]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __source_file(self, cursor, job_id: str, original_image_id: int, upload_path: str, sha256: str) -> str:
+        # the spooled upload if it is still intact, otherwise the stored original written out to a file
+        if upload_path and os.path.exists(upload_path):
+            if not sha256 or file_sha256(upload_path) == sha256:
+                return upload_path
+            print(f"upload {upload_path} does not match its checksum, using the stored original")
+
+        path = os.path.join(upload_dir(), f"{job_id}.upload")
+        if not fetch_original(cursor, original_image_id, path):
+            raise ValueError(f"original image {original_image_id} not found")
+        return path
+
+    def __tile(self, conn, cursor, job_id: str, attempt: int, project_id: int, original_image_id: int, upload_path: str=None, sha256: str=None):
+        from utils.ImagePreprocess import iter_tiles, store_tiles, store_tile_geometry, tile_windows, decode_to_cache
+        from services.TileRenderer import virtual_tiles, source_path as tile_source_path, trim_source_dir
+
+        virtual = virtual_tiles()
+        source_path = self.__source_file(cursor, job_id, original_image_id, upload_path, sha256)
+        # virtual tiles are rendered from the decoded original later, so its cache is kept where the renderer looks
+        cache_path = tile_source_path(original_image_id) if virtual else source_path + '.npy'
+        # tiles are cut from a memory mapped decode, only the windows being encoded are resident
+        image_np = decode_to_cache(source_path, cache_path)
+        tiles_total = len(tile_windows(*image_np.shape[:2]))
+        self.__set_progress(job_id, attempt, tiles_total=tiles_total)
+
+        # tiles of an earlier attempt were never committed with the counters, drop them and start over
+        cursor.execute("DELETE FROM Images WHERE orig_image_id = %s", (original_image_id,))
+        progress = lambda done: self.__set_progress(job_id, attempt, tiles_done=done)
+        if virtual:
+            tile_stats = store_tile_geometry(tile_windows(*image_np.shape[:2]), project_id, original_image_id, cursor, progress=progress)
+        else:
+            tile_stats = store_tiles(iter_tiles(image_np), project_id, original_image_id, cursor, progress=progress)
+
+        # tile count behind the progress bars, see sql/project_stats.sql. A new project's counters see all its labels
+        cursor.execute("""
+            INSERT INTO ProjectStats (project_id, num_tiles, complete) VALUES (%s, %s, 1)
+            ON DUPLICATE KEY UPDATE num_tiles = num_tiles + VALUES(num_tiles)
+        """, (project_id, tile_stats['tiles']))
+        # the tiles, the counters and the finished job are committed together, unless the lease was lost
+        # and another run took the job over
+        cursor.execute("""
+            UPDATE ProjectJobs SET status = %s, tiles_done = %s, tiles_total = %s, error = NULL, finished_at = NOW()
+            WHERE job_id = %s AND status = %s AND attempts = %s
+        """, (DONE, tile_stats['tiles'], tile_stats['tiles'], job_id, RUNNING, attempt))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            print(f"project job {job_id} was taken over by another run, dropping attempt {attempt}")
+            return
+        conn.commit()
+
+        del image_np
+        for path in (source_path,) if virtual else (source_path, cache_path):
+            if os.path.exists(path):
+                os.remove(path)
+        if virtual:
+            trim_source_dir(keep=[cache_path])
+
+    def __set_progress(self, job_id: str, attempt: int, tiles_done: int=None, tiles_total: int=None):
+        # progress is written on its own connection so it is visible before the tiles are committed
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                UPDATE ProjectJobs SET tiles_done = COALESCE(%s, tiles_done),
+                       tiles_total = COALESCE(%s, tiles_total),
+                       heartbeat_at = NOW()
+                WHERE job_id = %s AND status = %s AND attempts = %s
+            """, (tiles_done, tiles_total, job_id, RUNNING, attempt))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+
+_runner: ProjectJobRunner = None
+_runner_lock = threading.Lock()
+
+def get_job_runner() -> ProjectJobRunner:
+    # one runner per process, started by main
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = ProjectJobRunner()
+    return _runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tiles the images of new projects, run one per deployment')
+    parser.add_argument('--workers', type=int, default=None, help='projects tiled at once (PROJECT_JOB_WORKERS)')
+    args = parser.parse_args()
+
+    runner = get_job_runner()
+    if args.workers:
+        runner.workers = args.workers
+    runner.start()
+    print(f"project job runner started with {runner.workers} workers")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.stop()
+
+
+if __name__ == '__main__':
+    main()
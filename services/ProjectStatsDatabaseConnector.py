@@ -0,0 +1,312 @@
+from abc import ABC, abstractmethod
+import argparse
+import sys
+from pathlib import Path
+from sqlalchemy import text
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from services.EngineRegistry import get_engine
+from services.DataTypes import Label
+import numpy as np
+
+# Config
+# ------------------------------------------------------------
+HIGH_CONFIDENCE = 0.8 # tiles above this count towards a client's progress
+IN_CHUNK_SIZE = 1000 # ids per IN (...) lookup
+# ------------------------------------------------------------
+
+
+class ProjectStatsDatabaseConnector(ABC):
+    # counters behind the dashboards and reports, see sql/project_stats.sql
+
+    @abstractmethod
+    def make_db_connection(self):
+        pass
+
+    @abstractmethod
+    def record_labels(self, labels: list[Label], connection=None):
+        pass
+
+    @abstractmethod
+    def get_tile_windows(self, orig_image_id) -> tuple[list, np.ndarray]:
+        pass
+
+    @abstractmethod
+    def set_tile_confidences(self, updates: list[tuple], connection=None):
+        pass
+
+    @abstractmethod
+    def get_project_stats(self, project_id, top_n: int=3) -> dict:
+        pass
+
+    @abstractmethod
+    def rebuild(self, project_id=None):
+        pass
+
+class NoneDB(ProjectStatsDatabaseConnector):
+
+
+    def make_db_connection(self):
+        pass
+
+
+    def record_labels(self, labels: list[Label], connection=None):
+        pass
+
+
+    def get_tile_windows(self, orig_image_id) -> tuple[list, np.ndarray]:
+        return [], np.empty((0, 4), dtype=np.int64)
+
+
+    def set_tile_confidences(self, updates: list[tuple], connection=None):
+        pass
+
+
+    def get_project_stats(self, project_id, top_n: int=3) -> dict:
+        pass
+
+
+    def rebuild(self, project_id=None):
+        pass
+
+class MYSQLProjectStatsDatabaseConnector(ProjectStatsDatabaseConnector):
+
+    def __init__(self):
+        # the shared engine is looked up on first use, building a connector never touches the database
+        self.cnx = None
+
+    def make_db_connection(self):
+        # one engine per DSN is shared by every connector in the process, see services/EngineRegistry.py
+        if self.cnx is None:
+            self.cnx = get_engine()
+
+    def __in_transaction(self, work, connection=None):
+        # runs work in the caller's transaction when given one, otherwise in a transaction of its own
+        if connection is not None:
+            return work(connection)
+        self.make_db_connection()
+        with self.cnx.connect() as connection:
+            try:
+                with connection.begin():
+                    return work(connection)
+            except Exception as e:
+                print(f"Error {e}")
+                raise Exception(e)
+
+    def __select_in(self, connection, query: str, ids: list) -> list:
+        # query has an ':ids' IN parameter, large id lists are looked up in chunks
+        rows = []
+        ids = list(ids)
+        for start in range(0, len(ids), IN_CHUNK_SIZE):
+            rows.extend(connection.execute(text(query), {'ids': tuple(ids[start:start + IN_CHUNK_SIZE])}).fetchall())
+        return rows
+
+    def record_labels(self, labels: list[Label], connection=None):
+        '''
+        Adds a batch of labels to the counters. Call it in the transaction that inserts the labels and
+        before the insert: labels whose LabelID is already stored are resubmissions and are not counted
+        '''
+        if not labels:
+            return
+        self.__in_transaction(lambda connection: self.__record_labels(connection, labels), connection)
+
+    def __record_labels(self, connection, labels: list[Label]):
+        existing = {row[0] for row in self.__select_in(connection, "SELECT LabelID FROM Labels WHERE LabelID IN :ids",
+                                                       {label.LabelID for label in labels})}
+        labels = [label for label in labels if label.LabelID not in existing]
+        # ImageID arrives as a str from the API, compare ids as strings
+        tile_projects = {str(tile_id): project_id for tile_id, project_id in
+                         self.__select_in(connection, "SELECT id, project_id FROM Images WHERE id IN :ids",
+                                          {label.ImageID for label in labels})}
+
+        projects = {}
+        labellers = {}
+        classes = {}
+        tiles = set()
+        for label in labels:
+            project_id = tile_projects.get(str(label.ImageID))
+            if project_id is None:
+                continue
+            creation_time = str(label.creation_time)
+            for counts, key in ((projects, project_id), (labellers, (project_id, label.LabellerID))):
+                count, last = counts.get(key, (0, creation_time))
+                counts[key] = (count + 1, max(last, creation_time))
+            classes[(project_id, label.Class)] = classes.get((project_id, label.Class), 0) + 1
+            tiles.add((label.LabellerID, label.ImageID, project_id))
+
+        if not projects:
+            return
+
+        connection.execute(text("""
+            INSERT INTO ProjectStats (project_id, num_labels, last_label_time)
+            VALUES (:project_id, :num_labels, :last_label_time)
+            ON DUPLICATE KEY UPDATE
+                num_labels = num_labels + VALUES(num_labels),
+                last_label_time = GREATEST(COALESCE(last_label_time, VALUES(last_label_time)), VALUES(last_label_time));
+        """), [{'project_id': p, 'num_labels': n, 'last_label_time': t} for p, (n, t) in projects.items()])
+
+        connection.execute(text("""
+            INSERT INTO LabellerProjectStats (project_id, LabellerID, num_labels, last_label_time)
+            VALUES (:project_id, :labeller_id, :num_labels, :last_label_time)
+            ON DUPLICATE KEY UPDATE
+                num_labels = num_labels + VALUES(num_labels),
+                last_label_time = GREATEST(COALESCE(last_label_time, VALUES(last_label_time)), VALUES(last_label_time));
+        """), [{'project_id': p, 'labeller_id': l, 'num_labels': n, 'last_label_time': t} for (p, l), (n, t) in labellers.items()])
+
+        connection.execute(text("""
+            INSERT INTO ProjectClassStats (project_id, Class, num_labels)
+            VALUES (:project_id, :Class, :num_labels)
+            ON DUPLICATE KEY UPDATE num_labels = num_labels + VALUES(num_labels);
+        """), [{'project_id': p, 'Class': c, 'num_labels': n} for (p, c), n in classes.items()])
+
+        connection.execute(text("""
+            INSERT IGNORE INTO LabellerTiles (LabellerID, ImageID, project_id)
+            VALUES (:labeller_id, :image_id, :project_id);
+        """), [{'labeller_id': l, 'image_id': i, 'project_id': p} for l, i, p in tiles])
+
+        # distinct tile counts only change for the labellers in this batch, each recount reads one index range
+        connection.execute(text("""
+            UPDATE LabellerProjectStats s
+            SET labeled_tiles = (SELECT COUNT(*) FROM LabellerTiles t WHERE t.LabellerID = s.LabellerID AND t.project_id = s.project_id)
+            WHERE s.project_id = :project_id AND s.LabellerID = :labeller_id;
+        """), [{'project_id': p, 'labeller_id': l} for p, l in labellers])
+
+    def get_tile_windows(self, orig_image_id) -> tuple[list, np.ndarray]:
+        # ids of the tiles cut from an original image and their half open (x_start, y_start, x_end, y_end) windows
+        self.make_db_connection()
+        query = text("""
+            SELECT id, x_offset, y_offset, image_width, image_height FROM Images WHERE orig_image_id = :orig_image_id;
+        """)
+        with self.cnx.connect() as connection:
+            try:
+                rows = connection.execute(query, {'orig_image_id': orig_image_id}).fetchall()
+            except Exception as e:
+                print(f"Error {e}")
+                raise Exception(e)
+        if not rows:
+            return [], np.empty((0, 4), dtype=np.int64)
+        geometry = np.array([row[1:] for row in rows], dtype=np.int64)
+        windows = np.stack((geometry[:, 0], geometry[:, 1], geometry[:, 0] + geometry[:, 2], geometry[:, 1] + geometry[:, 3]), axis=-1)
+        return [row[0] for row in rows], windows
+
+    def set_tile_confidences(self, updates: list[tuple], connection=None):
+        # writes (tile_id, confidence) pairs and moves the project's high confidence count by the tiles that crossed HIGH_CONFIDENCE
+        if not updates:
+            return
+        self.__in_transaction(lambda connection: self.__set_tile_confidences(connection, updates), connection)
+
+    def __set_tile_confidences(self, connection, updates: list[tuple]):
+        confidences = {tile_id: float(confidence) for tile_id, confidence in updates}
+        current = self.__select_in(connection, "SELECT id, project_id, confidence FROM Images WHERE id IN :ids FOR UPDATE", confidences.keys())
+
+        deltas = {}
+        for tile_id, project_id, old in current:
+            delta = int(confidences[tile_id] > HIGH_CONFIDENCE) - int(old is not None and old > HIGH_CONFIDENCE)
+            deltas[project_id] = deltas.get(project_id, 0) + delta
+
+        connection.execute(text("UPDATE Images SET confidence = :confidence WHERE id = :id;"),
+                           [{'id': tile_id, 'confidence': confidence} for tile_id, confidence in confidences.items()])
+        deltas = [{'project_id': p, 'delta': d} for p, d in deltas.items() if d]
+        if deltas:
+            connection.execute(text("""
+                INSERT INTO ProjectStats (project_id, high_conf_tiles) VALUES (:project_id, :delta)
+                ON DUPLICATE KEY UPDATE high_conf_tiles = high_conf_tiles + VALUES(high_conf_tiles);
+            """), deltas)
+
+    def get_project_stats(self, project_id, top_n: int=3) -> dict:
+        # label totals, per class counts and top_n labellers plus the tile counters, read from a handful of rows.
+        # complete is False while the counters may be missing labels from before the stats tables, see
+        # sql/project_stats_backfill.sql
+        self.make_db_connection()
+        data = {'project_id': project_id, 'top_n': top_n}
+        with self.cnx.connect() as connection:
+            try:
+                totals = connection.execute(text("""
+                    SELECT num_tiles, high_conf_tiles, num_labels, last_label_time,
+                           (SELECT COUNT(*) FROM LabellerProjectStats l WHERE l.project_id = p.project_id), complete
+                    FROM ProjectStats p WHERE p.project_id = :project_id;
+                """), data).first()
+                by_class = {res[0]: int(res[1]) for res in connection.execute(text("""
+                    SELECT Class, num_labels FROM ProjectClassStats WHERE project_id = :project_id;
+                """), data)}
+                top_labellers = [(res[0], int(res[1])) for res in connection.execute(text("""
+                    SELECT LabellerID, num_labels FROM LabellerProjectStats
+                    WHERE project_id = :project_id ORDER BY num_labels DESC LIMIT :top_n;
+                """), data)]
+            except Exception as e:
+                print(f"Error {e}")
+                raise Exception(e)
+
+        num_tiles, high_conf_tiles, num_labels, last_label_time, num_labellers, complete = totals if totals else (0, 0, 0, None, 0, 0)
+        return {
+            'complete': bool(complete),
+            'num_tiles': int(num_tiles),
+            'high_conf_tiles': int(high_conf_tiles),
+            'num_labels': int(num_labels),
+            'num_labellers': int(num_labellers),
+            'last_label_time': last_label_time,
+            'label_count_by_class': by_class,
+            'top_labellers': top_labellers,
+        }
+
+    def rebuild(self, project_id=None):
+        '''
+        Recomputes the counters of one project (or every project) from Labels and Images in a single
+        transaction. Labels ingested while it runs may be missed, run it again if ingestion was live
+        '''
+        scope = "WHERE project_id = :project_id" if project_id is not None else ""
+        label_scope = "WHERE i.project_id = :project_id" if project_id is not None else ""
+        data = {'project_id': project_id}
+
+        def work(connection):
+            for table in ('ProjectStats', 'LabellerProjectStats', 'ProjectClassStats', 'LabellerTiles'):
+                connection.execute(text(f"DELETE FROM {table} {scope};"), data)
+            connection.execute(text(f"""
+                INSERT INTO ProjectStats (project_id, num_tiles, high_conf_tiles, complete)
+                SELECT project_id, COUNT(*), COUNT(CASE WHEN confidence > {HIGH_CONFIDENCE} THEN 1 END), 1
+                FROM Images {scope} GROUP BY project_id;
+            """), data)
+            connection.execute(text(f"""
+                INSERT INTO ProjectStats (project_id, num_labels, last_label_time, complete)
+                SELECT i.project_id, COUNT(*), MAX(l.creation_time), 1
+                FROM Labels l JOIN Images i ON l.ImageID = i.id {label_scope} GROUP BY i.project_id
+                ON DUPLICATE KEY UPDATE num_labels = VALUES(num_labels), last_label_time = VALUES(last_label_time);
+            """), data)
+            # projects without tiles still get a row
+            project_scope = "WHERE projectId = :project_id" if project_id is not None else ""
+            connection.execute(text(f"""
+                INSERT IGNORE INTO ProjectStats (project_id, complete) SELECT projectId, 1 FROM Projects {project_scope};
+            """), data)
+            connection.execute(text(f"""
+                INSERT INTO LabellerProjectStats (project_id, LabellerID, num_labels, labeled_tiles, last_label_time)
+                SELECT i.project_id, l.LabellerID, COUNT(*), COUNT(DISTINCT l.ImageID), MAX(l.creation_time)
+                FROM Labels l JOIN Images i ON l.ImageID = i.id {label_scope} GROUP BY i.project_id, l.LabellerID;
+            """), data)
+            connection.execute(text(f"""
+                INSERT INTO ProjectClassStats (project_id, Class, num_labels)
+                SELECT i.project_id, l.Class, COUNT(*)
+                FROM Labels l JOIN Images i ON l.ImageID = i.id {label_scope} GROUP BY i.project_id, l.Class;
+            """), data)
+            connection.execute(text(f"""
+                INSERT INTO LabellerTiles (LabellerID, ImageID, project_id)
+                SELECT DISTINCT l.LabellerID, l.ImageID, i.project_id
+                FROM Labels l JOIN Images i ON l.ImageID = i.id {label_scope};
+            """), data)
+
+        self.__in_transaction(work)
+        print(f"rebuilt stats for {'project ' + str(project_id) if project_id is not None else 'every project'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='maintenance of the project statistics tables')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the counters from Labels and Images')
+    parser.add_argument('project_id', nargs='?', default=None)
+    args = parser.parse_args()
+
+    if args.rebuild:
+        MYSQLProjectStatsDatabaseConnector().rebuild(args.project_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import sys
+import struct
+import zlib
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+import numpy as np
+
+# Blob layout: a little endian header (magic, flags, x_min, y_min, width, height, num_pixels) followed by
+# the object's mask over its bounding box, one bit per pixel in row major order (np.packbits), zlib
+# compressed when that is smaller. A 10k pixel object is one blob of at most ~1.3kB instead of 10k rows
+MAGIC = b'RM'
+HEADER = struct.Struct('<2sBiiIII')
+FLAG_ZLIB = 1
+ZLIB_LEVEL = 1 # masks are mostly long runs, a fast level already gets most of the gain
+
+
+def encode_mask(mask: np.ndarray, x_min: int=0, y_min: int=0) -> bytes:
+    '''
+    Encodes a 2D boolean mask whose top left pixel sits at (x_min, y_min). The mask is cropped to the
+    bounding box of its set pixels first, so callers can pass a mask over a whole image
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return HEADER.pack(MAGIC, 0, x_min, y_min, 0, 0, 0)
+    cols = np.flatnonzero(mask.any(axis=0))
+    mask = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    height, width = mask.shape
+
+    body = np.packbits(mask, axis=None).tobytes()
+    flags = 0
+    compressed = zlib.compress(body, ZLIB_LEVEL)
+    if len(compressed) < len(body):
+        body, flags = compressed, FLAG_ZLIB
+    return HEADER.pack(MAGIC, flags, x_min + int(cols[0]), y_min + int(rows[0]), width, height,
+                       int(np.count_nonzero(mask))) + body
+
+
+def decode_mask(blob: bytes) -> tuple[np.ndarray, int, int]:
+    # returns (mask over the bounding box, x_min, y_min)
+    magic, flags, x_min, y_min, width, height, _ = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError('not a region mask blob')
+    body = blob[HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    bits = np.unpackbits(np.frombuffer(body, dtype=np.uint8), count=width * height)
+    return bits.reshape(height, width).astype(bool), x_min, y_min
+
+
+def mask_header(blob: bytes) -> dict:
+    # bounding box and pixel count without decoding the mask
+    _, _, x_min, y_min, width, height, num_pixels = HEADER.unpack_from(blob)
+    return {'x_min': x_min, 'y_min': y_min, 'width': width, 'height': height, 'num_pixels': num_pixels}
+
+
+def encode_pixels(pixels) -> bytes:
+    # encodes an (N, 2) array or list of [x, y] pixels
+    pixels = np.asarray(pixels, dtype=np.int64).reshape(-1, 2)
+    if len(pixels) == 0:
+        return encode_mask(np.zeros((0, 0), dtype=bool))
+    x_min, y_min = pixels.min(axis=0)
+    x_max, y_max = pixels.max(axis=0)
+    mask = np.zeros((y_max - y_min + 1, x_max - x_min + 1), dtype=bool)
+    mask[pixels[:, 1] - y_min, pixels[:, 0] - x_min] = True
+    return encode_mask(mask, int(x_min), int(y_min))
+
+
+def decode_pixels(blob: bytes) -> np.ndarray:
+    # (N, 2) int array of the [x, y] pixels in the blob, row by row
+    mask, x_min, y_min = decode_mask(blob)
+    ys, xs = np.nonzero(mask)
+    return np.stack((xs + x_min, ys + y_min), axis=-1)
@@ -1,9 +1,14 @@
-from ProjectDatabaseConnector import ProjectDatabaseConnector, MYSQLProjectDatabaseConnector
-from LabelDatabaseConnector import LabelDatabaseConnector, MYSQLLabelDatabaseConnector
-from LabellerDatabaseConnector import LabellerDatabaseConnector, MYSQLLabellerDatabaseConnector
-from ImageObjectDatabaseConnector import ImageObjectDatabaseConnector, MYSQLImageObjectDatabaseConnector
-from ObjectExtractionService import ObjectExtractionService
-from ImageClassMeasureDatabaseConnector import MYSQLImageClassMeasureDatabaseConnector
+import sys
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from services.ProjectDatabaseConnector import ProjectDatabaseConnector, MYSQLProjectDatabaseConnector
+from services.LabelDatabaseConnector import LabelDatabaseConnector, MYSQLLabelDatabaseConnector
+from services.LabellerDatabaseConnector import LabellerDatabaseConnector, MYSQLLabellerDatabaseConnector
+from services.ImageObjectDatabaseConnector import ImageObjectDatabaseConnector, MYSQLImageObjectDatabaseConnector
+from services.ImageClassMeasureDatabaseConnector import MYSQLImageClassMeasureDatabaseConnector
+from services.ProjectStatsDatabaseConnector import ProjectStatsDatabaseConnector, MYSQLProjectStatsDatabaseConnector
 import json
 
 class ReportGenerator():
@@ -14,63 +19,34 @@ class ReportGenerator():
         self.ImageObjectDatabaseConnector = MYSQLImageObjectDatabaseConnector()
         self.LabellerDatabaseConnector = MYSQLLabellerDatabaseConnector()
         self.ICMDB = MYSQLImageClassMeasureDatabaseConnector()
+        self.ProjectStatsDatabaseConnector = MYSQLProjectStatsDatabaseConnector()
 
     def get_report_info(self, project_id) -> dict:
-        num_labels = 0
-        num_images = 0
-        num_labellers = 0
-        avg_num_labels = 0 
-        label_count_by_labeller = dict()
-        label_count_by_class = dict()
-        labeller_ids = set()
-        end_time = "0"
-        last_label_time = "0"
-
-        query_projects = f"SELECT * FROM my_image_db.Projects WHERE projectId = {project_id};"
-        project = self.ProjectDatabaseConnector.get_projects(query_projects)[0]
-
-        end_time = str(project.end_date)
-
-        for image in project.images:
-            query_labels = f"SELECT * FROM my_image_db.Labels WHERE (OrigImageID = {image.ImageID}) Order BY creation_time DESC;"
-            labels = self.LabelDatabaseConnector.get_labels(query_labels)
-            
-            print(f"found {len(labels)} labels")
-            try:
-                last_label_time = str(labels[0].creation_time)
-            except:
-                pass
-
-            for label in labels:
-                labeller_ids.add(label.LabellerID)
-
-                if label.Class in label_count_by_class:
-                    label_count_by_class[label.Class] += 1
-                else:
-                    label_count_by_class[label.Class] = 1
-
-                if label.LabellerID in label_count_by_labeller:
-                    label_count_by_labeller[label.LabellerID] += 1
-                else:
-                    label_count_by_labeller[label.LabellerID] = 1
-
-            print(label_count_by_labeller)
-
-            
-
-            
-            
-            num_labels += len(labels)
-            num_labellers += len(labeller_ids)
-            
-           
-
-        top_3_labellers = sorted(label_count_by_labeller, key=label_count_by_labeller.get, reverse=True)[:3]
-
+        # label counts come from the maintained project stats
+        project = self.ProjectDatabaseConnector.get_project_summary(project_id)
+        if not project:
+            raise ValueError(f'project {project_id} not found')
+        summary = self.ProjectStatsDatabaseConnector.get_project_stats(project_id, top_n=3)
+        if not summary['complete']:
+            # reports only read, older projects are counted by sql/project_stats_backfill.sql
+            print(f"stats of project {project_id} are not complete, run sql/project_stats_backfill.sql")
+
+        end_time = str(project['end_date'])
+        num_images = project['num_images']
+        num_labels = summary['num_labels']
+        num_labellers = summary['num_labellers']
+        last_label_time = str(summary['last_label_time']) if summary['last_label_time'] is not None else "0"
+        label_count_by_class = summary['label_count_by_class']
+        label_count_by_labeller = dict(summary['top_labellers'])
+        top_3_labellers = [labeller_id for labeller_id, _ in summary['top_labellers']]
+        print(label_count_by_labeller)
+
+        avg_num_labels = 0
         if top_3_labellers:
-            query_labellers = f"SELECT * FROM my_image_db.Labellers WHERE id IN :ids"
-            labellers = self.LabellerDatabaseConnector.get_labeller_info_with_data(query_labellers, {'ids': tuple(top_3_labellers)})
-        num_images = len(project.images)
+            # FIELD keeps the rows in the same order as top_3_labellers
+            ids = {f'id_{i}': labeller_id for i, labeller_id in enumerate(top_3_labellers)}
+            query_labellers = f"SELECT * FROM my_image_db.Labellers WHERE id IN :ids ORDER BY FIELD(id, {', '.join(':' + k for k in ids)})"
+            labellers = self.LabellerDatabaseConnector.get_labeller_info_with_data(query_labellers, {'ids': tuple(top_3_labellers), **ids})
         if num_labels > 0:
             avg_num_labels = (num_labels / num_images) / num_labellers
 
@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from services.LabelRasterizer import disjoint_windows
+import numpy as np
+
+
+class SummedAreaTable:
+    # integral image of a 2D plane, any axis aligned window sums in four lookups
+    table: np.ndarray
+    im_height: int
+    im_width: int
+
+    def __init__(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        self.im_height, self.im_width = values.shape
+        self.table = np.zeros((self.im_height + 1, self.im_width + 1), dtype=np.float64)
+        np.cumsum(values, axis=0, out=self.table[1:, 1:])
+        np.cumsum(self.table[1:, 1:], axis=1, out=self.table[1:, 1:])
+
+    @property
+    def total(self) -> float:
+        return float(self.table[-1, -1])
+
+    def window_sums(self, windows: np.ndarray) -> np.ndarray:
+        # sums over half open (x_start, y_start, x_end, y_end) windows
+        windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+        x_start, y_start, x_end, y_end = windows.T
+        return (self.table[y_end, x_end] - self.table[y_start, x_end]
+                - self.table[y_end, x_start] + self.table[y_start, x_start])
+
+    def union_sum(self, boxes: np.ndarray) -> float:
+        # sum over the union of inclusive boxes, pixels covered by several boxes count once
+        windows = disjoint_windows(boxes, self.im_height, self.im_width)
+        return float(self.window_sums(windows).sum())
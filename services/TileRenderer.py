@@ -0,0 +1,199 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Iterable
+import sys
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+import numpy as np
+from services.core_img_db_connector import get_db_connection
+from services.ProjectJobRunner import fetch_original
+from utils.ImagePreprocess import decode_to_cache, render_tile, encode_png, PNG_COMPRESS_LEVEL
+
+# Config
+# ------------------------------------------------------------
+VIRTUAL_TILES = False # VIRTUAL_TILES - new projects store tile geometry only, tiles are rendered on request
+CACHE_BYTES = 256 * 1024 * 1024 # TILE_CACHE_BYTES - rendered PNGs kept in memory
+SOURCE_DIR = os.path.join(project_root, 'tile_sources') # TILE_SOURCE_DIR - decoded originals, memory mapped
+SOURCE_BYTES = 8 * 1024 * 1024 * 1024 # TILE_SOURCE_BYTES - decoded originals kept on disk, least recently used go first
+MAX_OPEN_SOURCES = 8 # decoded originals kept mapped at once
+# ------------------------------------------------------------
+
+
+def virtual_tiles() -> bool:
+    value = os.getenv('VIRTUAL_TILES')
+    if value is None:
+        return VIRTUAL_TILES
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def source_dir() -> str:
+    directory = os.getenv('TILE_SOURCE_DIR', SOURCE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def source_path(original_image_id) -> str:
+    # decoded cache of an original image, written by the tiling job or on the first render
+    return os.path.join(source_dir(), f"{original_image_id}.npy")
+
+
+def trim_source_dir(max_bytes: int=None, keep: Iterable[str]=()) -> int:
+    '''
+    Removes the least recently used decoded originals from TILE_SOURCE_DIR until it holds at most max_bytes
+    (TILE_SOURCE_BYTES), the paths in keep stay. A removed original is decoded again on its next render,
+    a process that has it mapped keeps reading it. Returns the number of bytes removed
+    '''
+    max_bytes = max_bytes if max_bytes else int(os.getenv('TILE_SOURCE_BYTES', SOURCE_BYTES))
+    keep = set(keep)
+    files = []
+    for entry in os.scandir(source_dir()):
+        if entry.name.endswith('.npy') and entry.is_file():
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # removed by another process
+        total -= size
+        removed += size
+    return removed
+
+
+class TileRenderer():
+    '''
+    Renders virtual tiles (Images rows without an image, see sql/virtual_tiles.sql) from their original
+    image. Originals are decoded once into a .npy file under TILE_SOURCE_DIR and memory mapped, so a render
+    only reads its window. Each original is decoded under its own lock, renders of other originals go on
+    meanwhile. The directory is trimmed to TILE_SOURCE_BYTES after every decode. Rendered PNGs are kept in
+    an LRU cache of at most max_bytes
+    '''
+
+    def __init__(self, max_bytes: int=None, compress_level: int=None):
+        self.max_bytes = max_bytes if max_bytes else int(os.getenv('TILE_CACHE_BYTES', CACHE_BYTES))
+        self.compress_level = compress_level if compress_level is not None else int(os.getenv('TILE_PNG_COMPRESS_LEVEL', PNG_COMPRESS_LEVEL))
+        self.lock = threading.Lock()
+        self.source_lock = threading.Lock() # guards sources and decode_locks only, never held while decoding
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.sources = OrderedDict()
+        self.decode_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.total_render_time = 0.0
+
+    def render(self, tile: dict) -> bytes:
+        '''
+        PNG of an Images row, given as a dict with id, orig_image_id, x_offset, y_offset, image_width,
+        image_height, core_x_offset and core_y_offset
+        '''
+        with self.lock:
+            png = self.cache.get(tile['id'])
+            if png is not None:
+                self.cache.move_to_end(tile['id'])
+                self.hits += 1
+                return png
+
+        start = time.perf_counter()
+        image_np = self.__source(tile['orig_image_id'])
+        png = encode_png(render_tile(image_np, tile['x_offset'], tile['y_offset'], tile['image_width'],
+                                     tile['image_height'], tile['core_x_offset'], tile['core_y_offset']),
+                         self.compress_level)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.misses += 1
+            self.total_render_time += elapsed
+            if tile['id'] not in self.cache and len(png) <= self.max_bytes:
+                self.cache[tile['id']] = png
+                self.cache_bytes += len(png)
+                while self.cache_bytes > self.max_bytes:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cache_bytes -= len(evicted)
+        return png
+
+    def stats(self) -> dict:
+        with self.lock:
+            renders = self.misses
+            return {
+                'tiles': len(self.cache),
+                'bytes': self.cache_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+                'avg_render_ms': 1000 * self.total_render_time / renders if renders else 0.0,
+            }
+
+    def __source(self, original_image_id):
+        # one decode per original, concurrent first renders of the same original wait for it instead of decoding again
+        with self.source_lock:
+            image_np = self.sources.get(original_image_id)
+            if image_np is not None:
+                self.sources.move_to_end(original_image_id)
+                return image_np
+            decode_lock = self.decode_locks.setdefault(original_image_id, threading.Lock())
+
+        with decode_lock:
+            with self.source_lock:
+                image_np = self.sources.get(original_image_id)
+            if image_np is not None:
+                return image_np
+
+            path = source_path(original_image_id)
+            decoded = not os.path.exists(path)
+            if decoded:
+                self.__decode_original(original_image_id, path)
+            else:
+                os.utime(path) # the modification time is the recency trim_source_dir goes by
+            image_np = np.load(path, mmap_mode='r')
+
+            with self.source_lock:
+                self.sources[original_image_id] = image_np
+                while len(self.sources) > MAX_OPEN_SOURCES:
+                    self.sources.popitem(last=False)
+                self.decode_locks.pop(original_image_id, None)
+                open_paths = [source_path(id) for id in self.sources]
+        if decoded:
+            trim_source_dir(keep=open_paths)
+        return image_np
+
+    def __decode_original(self, original_image_id, path: str):
+        encoded_path = path + '.original'
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            found = fetch_original(cursor, original_image_id, encoded_path)
+        finally:
+            cursor.close()
+            conn.close()
+        try:
+            if not found:
+                raise ValueError(f"original image {original_image_id} not found")
+            decode_to_cache(encoded_path, path)
+        finally:
+            if os.path.exists(encoded_path):
+                os.remove(encoded_path)
+
+
+_renderer: TileRenderer = None
+_renderer_lock = threading.Lock()
+
+def get_tile_renderer() -> TileRenderer:
+    # one renderer and cache per process
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = TileRenderer()
+    return _renderer
@@ -1,23 +1,61 @@
-import mysql.connector
-from mysql.connector import pooling
-from dotenv import load_dotenv
+import sys
 import os
+from pathlib import Path
+import pymysql
+import pymysql.cursors
+from dotenv import load_dotenv
+from sqlalchemy import exc
+
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
+from services.EngineRegistry import get_engine, database_url
+
+# driver errors raised through get_db_connection connections, the routes catch this
+Error = pymysql.MySQLError
+
+# Config
+# ------------------------------------------------------------
+SERVER_THREADS = 8 # SERVER_THREADS - waitress worker threads, each can hold one connection
+POOL_TIMEOUT = 10 # DB_POOL_TIMEOUT - seconds a request waits for a free connection before failing
+# ------------------------------------------------------------
+
+
+def server_threads() -> int:
+    # shared by app.py (serve(threads=)) and the pool so every request thread can get a connection
+    load_dotenv()
+    return int(os.getenv('SERVER_THREADS', SERVER_THREADS))
+
+
+class PooledConnection:
+    '''
+    DBAPI connection checked out of the shared SQLAlchemy pool. close() hands it back to the pool,
+    cursor(dictionary=True) returns rows as dicts
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self, dictionary: bool = False):
+        if dictionary:
+            return self.connection.cursor(pymysql.cursors.DictCursor)
+        return self.connection.cursor()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
 
-load_dotenv()
+def get_engine_for_api():
+    # the API's DB_* variables name the same kind of DSN as the services, the API gets a pool of its own sized to
+    # its threads even when the DSN is the services' one
+    load_dotenv()
+    return get_engine(database_url('DB_', host='HOSTNAME', database='NAME'),
+                      pool_size=server_threads(),
+                      pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', POOL_TIMEOUT)))
 
-connection_pool = pooling.MySQLConnectionPool(
-    pool_name="my_pool",
-    pool_size=3,
-    pool_reset_session=True,
-    host=os.getenv("DB_HOSTNAME"),
-    user=os.getenv("DB_USER"),
-    password=os.getenv("DB_PASSWORD"),
-    port=os.getenv("DB_PORT"),
-    database=os.getenv("DB_NAME")
-)
 
-def get_db_connection():
+def get_db_connection() -> PooledConnection:
+    # blocks for up to DB_POOL_TIMEOUT seconds when every connection is in use instead of failing at once
     try:
-        return connection_pool.get_connection()
-    except mysql.connector.errors.PoolError as e:
-        raise RuntimeError("Database connection pool exhausted") from e
\ No newline at end of file
+        return PooledConnection(get_engine_for_api().raw_connection())
+    except exc.TimeoutError as e:
+        raise RuntimeError("Database connection pool exhausted") from e
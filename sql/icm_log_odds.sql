@@ -0,0 +1,8 @@
+USE my_image_db;
+
+-- single additive log odds plane per image/class, replaces the helpervalue_1/helpervalue_2 pair
+-- existing rows are converted with MYSQLImageClassMeasureDatabaseConnector.migrate_imageclassmeasures_images_to_log_odds()
+ALTER TABLE ImageClassMeasure_images
+    ADD COLUMN log_odds LONGBLOB NULL,
+    MODIFY helpervalue_1 LONGBLOB NULL,
+    MODIFY helpervalue_2 LONGBLOB NULL;
@@ -0,0 +1,7 @@
+USE my_image_db;
+
+-- per labeller digest of the box of every label already applied to an ICM, by LabelID, and the accuracy
+-- increment last pushed for each labeller, stored as JSON (services/DataTypes.py LabelWatermark).
+-- Rows without one are treated as having applied nothing, a moved box rebuilds the ICM
+ALTER TABLE ImageClassMeasure_images
+    ADD COLUMN watermark TEXT NULL;
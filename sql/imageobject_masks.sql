@@ -0,0 +1,17 @@
+USE my_image_db;
+
+-- Pixels of an ImageObject stored as one packed bitmask over its bounding box (services/RegionEncoding.py)
+-- instead of one Pixels_in_ImageObject row per pixel. The box and pixel count are copied out of the blob
+-- header so they can be queried without decoding. Convert the existing rows with
+--     python services/ImageObjectDatabaseConnector.py --migrate-pixels
+-- objects that are not converted yet are still read from Pixels_in_ImageObject
+CREATE TABLE IF NOT EXISTS ImageObject_masks (
+    ImageObjectID VARCHAR(255) NOT NULL,
+    x_min INT NOT NULL,
+    y_min INT NOT NULL,
+    width INT NOT NULL,
+    height INT NOT NULL,
+    num_pixels INT NOT NULL,
+    mask MEDIUMBLOB NOT NULL,
+    PRIMARY KEY (ImageObjectID)
+);
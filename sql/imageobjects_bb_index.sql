@@ -0,0 +1,5 @@
+USE my_image_db;
+
+-- ImageObjectDatabaseConnector_bb.replace_imageobjects deletes and rewrites the objects of one
+-- (image, class) per extraction unit, this index keeps that delete from scanning the table
+CREATE INDEX idx_imageobjects_bb_image_class ON ImageObjects_bb (ImageID, Class);
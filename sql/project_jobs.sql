@@ -0,0 +1,21 @@
+USE my_image_db;
+
+-- Background tiling jobs of /api/create_project, run by services/ProjectJobRunner.py. The request stores
+-- the original image and a queued job, a worker tiles it and records progress. Jobs left queued or running
+-- when the runner stops are picked up again when it starts
+CREATE TABLE IF NOT EXISTS ProjectJobs (
+    job_id VARCHAR(36) NOT NULL,
+    project_id INT NOT NULL,
+    original_image_id INT NOT NULL,
+    status ENUM('queued', 'running', 'done', 'failed') NOT NULL DEFAULT 'queued',
+    tiles_done INT NOT NULL DEFAULT 0,
+    tiles_total INT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    error TEXT NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at DATETIME NULL,
+    finished_at DATETIME NULL,
+    PRIMARY KEY (job_id),
+    INDEX idx_projectjobs_status (status, created_at),
+    INDEX idx_projectjobs_project (project_id)
+);
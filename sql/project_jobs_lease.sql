@@ -0,0 +1,9 @@
+USE my_image_db;
+
+-- lease and retry of the tiling jobs in services/ProjectJobRunner.py. The runner renews heartbeat_at of the
+-- jobs it is running, a running job with an old heartbeat is taken over. A failed run is queued again
+-- with retry_at set, it is not claimed before then
+ALTER TABLE ProjectJobs
+    ADD COLUMN heartbeat_at DATETIME NULL,
+    ADD COLUMN retry_at DATETIME NULL,
+    ADD INDEX idx_projectjobs_heartbeat (status, heartbeat_at);
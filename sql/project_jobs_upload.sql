@@ -0,0 +1,6 @@
+USE my_image_db;
+
+-- spooled upload of a tiling job and its sha256, the job decodes the file instead of the stored blob
+ALTER TABLE ProjectJobs
+    ADD COLUMN upload_path VARCHAR(1024) NULL,
+    ADD COLUMN sha256 CHAR(64) NULL;
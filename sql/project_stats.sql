@@ -0,0 +1,49 @@
+USE my_image_db;
+
+-- Incrementally maintained counters read by /api/projects, /api/client_projects and the label server
+-- report instead of scanning Labels and Images. Kept up to date by ProjectStatsDatabaseConnector
+-- (label ingestion, tile confidence updates, project creation). Fill them for existing projects with
+-- sql/project_stats_backfill.sql right after creating them, repair them with
+--     python services/ProjectStatsDatabaseConnector.py --rebuild [project_id]
+
+-- one row per project
+CREATE TABLE IF NOT EXISTS ProjectStats (
+    project_id INT NOT NULL,
+    num_tiles INT NOT NULL DEFAULT 0,
+    high_conf_tiles INT NOT NULL DEFAULT 0, -- tiles with Images.confidence above 0.8
+    num_labels INT NOT NULL DEFAULT 0,
+    last_label_time DATETIME NULL,
+    -- 1 once the counters cover every label of the project: set by the backfill, --rebuild and for projects
+    -- created after these tables. Rows started by label ingestion on an older project stay 0 until a backfill
+    complete TINYINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (project_id)
+);
+
+-- one row per labeller that labelled in a project
+CREATE TABLE IF NOT EXISTS LabellerProjectStats (
+    project_id INT NOT NULL,
+    LabellerID VARCHAR(255) NOT NULL,
+    num_labels INT NOT NULL DEFAULT 0,
+    labeled_tiles INT NOT NULL DEFAULT 0, -- distinct tiles with at least one label by this labeller
+    last_label_time DATETIME NULL,
+    PRIMARY KEY (project_id, LabellerID),
+    INDEX idx_labellerprojectstats_labeller (LabellerID),
+    INDEX idx_labellerprojectstats_count (project_id, num_labels)
+);
+
+-- one row per label class in a project
+CREATE TABLE IF NOT EXISTS ProjectClassStats (
+    project_id INT NOT NULL,
+    Class VARCHAR(255) NOT NULL,
+    num_labels INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (project_id, Class)
+);
+
+-- the tiles each labeller has labelled, lets labeled_tiles count distinct tiles incrementally
+CREATE TABLE IF NOT EXISTS LabellerTiles (
+    LabellerID VARCHAR(255) NOT NULL,
+    ImageID INT NOT NULL,
+    project_id INT NOT NULL,
+    PRIMARY KEY (LabellerID, ImageID),
+    INDEX idx_labellertiles_project (LabellerID, project_id)
+);
@@ -0,0 +1,41 @@
+USE my_image_db;
+
+-- Fills the counters of sql/project_stats.sql for every project that exists when it runs, run it once right
+-- after creating the tables and before starting label ingestion: the counters are recomputed from Labels and
+-- Images in one transaction, labels ingested while it runs may be missed. Projects created afterwards are
+-- counted by the tiling job and label ingestion. Same statements as
+--     python services/ProjectStatsDatabaseConnector.py --rebuild
+
+START TRANSACTION;
+
+DELETE FROM ProjectStats;
+DELETE FROM LabellerProjectStats;
+DELETE FROM ProjectClassStats;
+DELETE FROM LabellerTiles;
+
+INSERT INTO ProjectStats (project_id, num_tiles, high_conf_tiles, complete)
+SELECT project_id, COUNT(*), COUNT(CASE WHEN confidence > 0.8 THEN 1 END), 1
+FROM Images GROUP BY project_id;
+
+INSERT INTO ProjectStats (project_id, num_labels, last_label_time, complete)
+SELECT i.project_id, COUNT(*), MAX(l.creation_time), 1
+FROM Labels l JOIN Images i ON l.ImageID = i.id GROUP BY i.project_id
+ON DUPLICATE KEY UPDATE num_labels = VALUES(num_labels), last_label_time = VALUES(last_label_time);
+
+-- projects without tiles still get a row
+INSERT IGNORE INTO ProjectStats (project_id, complete)
+SELECT projectId, 1 FROM Projects;
+
+INSERT INTO LabellerProjectStats (project_id, LabellerID, num_labels, labeled_tiles, last_label_time)
+SELECT i.project_id, l.LabellerID, COUNT(*), COUNT(DISTINCT l.ImageID), MAX(l.creation_time)
+FROM Labels l JOIN Images i ON l.ImageID = i.id GROUP BY i.project_id, l.LabellerID;
+
+INSERT INTO ProjectClassStats (project_id, Class, num_labels)
+SELECT i.project_id, l.Class, COUNT(*)
+FROM Labels l JOIN Images i ON l.ImageID = i.id GROUP BY i.project_id, l.Class;
+
+INSERT INTO LabellerTiles (LabellerID, ImageID, project_id)
+SELECT DISTINCT l.LabellerID, l.ImageID, i.project_id
+FROM Labels l JOIN Images i ON l.ImageID = i.id;
+
+COMMIT;
@@ -0,0 +1,7 @@
+USE my_image_db;
+
+-- Indexes behind the report queries (ProjectDatabaseConnector.get_project_summary and the one time
+-- ProjectStatsDatabaseConnector.rebuild of a project from before the stats tables). The Labels index
+-- covers every column the rebuild aggregates read, so it is answered from the index without touching rows.
+CREATE INDEX idx_originalimages_project ON OriginalImages (projectId, id);
+CREATE INDEX idx_labels_image_report ON Labels (ImageID, LabellerID, Class, creation_time);
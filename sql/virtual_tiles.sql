@@ -0,0 +1,10 @@
+USE my_image_db;
+
+-- Virtual tiles (VIRTUAL_TILES=true): Images rows keep only the tile geometry and no image, the API renders
+-- them from the original on request (services/TileRenderer.py). x_offset/y_offset/image_width/image_height
+-- are the buffered window as for stored tiles, core_x_offset/core_y_offset the corner of its untinted core.
+-- Stored and virtual tiles can live side by side
+ALTER TABLE Images
+    MODIFY COLUMN image LONGBLOB NULL,
+    ADD COLUMN core_x_offset INT NULL,
+    ADD COLUMN core_y_offset INT NULL;
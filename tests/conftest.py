@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# the services import each other as services.X, like their own sys.path.append(project_root)
+project_root = str(Path(__file__).parent.parent)
+sys.path.append(project_root)
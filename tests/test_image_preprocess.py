@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils.ImagePreprocess import (FRAMEPIXELSIZE, PIXELSIZE, ImageTooLargeError, decode_to_cache, iter_tiles,
+                                   tint_border, tile_windows)
+
+
+def old_preprocess_image(image_np):
+  # preprocess_image before tiles were cut lazily, kept to check iter_tiles against
+  tiles = []
+  img_height, img_width = image_np.shape[:2]
+
+  def get_positions(total_size, frame_size):
+    positions = list(range(0, total_size - frame_size + 1, frame_size))
+    if total_size - positions[-1] > 0:
+      positions.append(total_size - frame_size)
+    return positions
+
+  for y_offset in get_positions(img_height, FRAMEPIXELSIZE):
+    for x_offset in get_positions(img_width, FRAMEPIXELSIZE):
+      x_end = x_offset + FRAMEPIXELSIZE
+      y_end = y_offset + FRAMEPIXELSIZE
+      x_buff_start = max(0, x_offset - PIXELSIZE)
+      y_buff_start = max(0, y_offset - PIXELSIZE)
+      x_buff_end = min(img_width, x_end + PIXELSIZE)
+      y_buff_end = min(img_height, y_end + PIXELSIZE)
+
+      full_tile = image_np[y_buff_start:y_buff_end, x_buff_start:x_buff_end].copy()
+      core_start_y = y_offset - y_buff_start
+      core_start_x = x_offset - x_buff_start
+
+      overlay = np.ones_like(full_tile) * [255, 100, 100]
+      mask = np.ones_like(full_tile, dtype=bool)
+      mask[core_start_y:core_start_y + FRAMEPIXELSIZE, core_start_x:core_start_x + FRAMEPIXELSIZE] = False
+      full_tile[mask] = full_tile[mask] * 0.5 + overlay[mask] * 0.5
+
+      tiles.append({'tile': full_tile, 'x_offset': x_buff_start, 'y_offset': y_buff_start,
+                    'core_start': (core_start_x, core_start_y), 'width': x_buff_end - x_buff_start,
+                    'height': y_buff_end - y_buff_start})
+  return tiles
+
+
+@pytest.mark.parametrize('shape', [(700, 900), (2 * FRAMEPIXELSIZE, 3 * FRAMEPIXELSIZE), (FRAMEPIXELSIZE + 1, 1000)])
+def test_iter_tiles_matches_old_preprocess_image(shape):
+  image_np = np.random.default_rng(5).integers(0, 256, size=shape + (3,), dtype=np.uint8)
+
+  # the old code cut the last tile twice when the image was a multiple of the frame size
+  expected = {}
+  for tile in old_preprocess_image(image_np):
+    expected.setdefault((tile['x_offset'], tile['y_offset'], tile['core_start']), tile)
+  tiles = list(iter_tiles(image_np))
+
+  assert [(t['x_offset'], t['y_offset'], t['core_start']) for t in tiles] == list(expected.keys())
+  for tile in tiles:
+    old = expected[(tile['x_offset'], tile['y_offset'], tile['core_start'])]
+    assert tile['tile'].dtype == np.uint8
+    np.testing.assert_array_equal(tile['tile'], old['tile'])
+    assert (tile['width'], tile['height']) == (old['width'], old['height'])
+
+
+def test_iter_tiles_handles_images_smaller_than_a_frame():
+  image_np = np.zeros((50, 70, 3), dtype=np.uint8)
+  tiles = list(iter_tiles(image_np))
+  assert len(tiles) == 1
+  assert tiles[0]['tile'].shape == (50, 70, 3)
+  assert len(tile_windows(50, 70)) == 1
+
+
+def test_tint_border_blends_only_outside_the_core():
+  rng = np.random.default_rng(6)
+  for _ in range(20):
+    height, width = rng.integers(1, 60, size=2)
+    core_size = int(rng.integers(1, 40))
+    core_x, core_y = rng.integers(0, 50, size=2)
+    tile = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+    mask = np.ones((height, width), dtype=bool)
+    mask[core_y:core_y + core_size, core_x:core_x + core_size] = False
+    expected = tile.copy()
+    expected[mask] = (tile[mask].astype(np.float64) * 0.5 + np.array([255, 100, 100]) * 0.5).astype(np.uint8)
+
+    tint_border(tile, int(core_x), int(core_y), core_size)
+    np.testing.assert_array_equal(tile, expected)
+
+
+def test_decode_to_cache_refuses_images_over_the_pixel_budget(tmp_path, monkeypatch):
+  image_path = str(tmp_path / 'image.png')
+  Image.fromarray(np.zeros((40, 50, 3), dtype=np.uint8)).save(image_path)
+  cache_path = str(tmp_path / 'image.npy')
+
+  monkeypatch.setenv('TILE_MAX_DECODE_PIXELS', str(40 * 50 - 1))
+  with pytest.raises(ImageTooLargeError):
+    decode_to_cache(image_path, cache_path)
+  assert not os.path.exists(cache_path)
+
+  monkeypatch.setenv('TILE_MAX_DECODE_PIXELS', str(40 * 50))
+  assert decode_to_cache(image_path, cache_path).shape == (40, 50, 3)
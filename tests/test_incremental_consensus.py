@@ -0,0 +1,131 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from services.DataTypes import ImageClassMeasure, Label, Labeller, LabelWatermark
+from services.ConsensusBackend import NumpyConsensusBackend
+from services.ObjectExtractionService import ObjectExtractionService
+
+IM_WIDTH = 40
+IM_HEIGHT = 30
+
+
+class MemoryICMDB:
+  # stores the pushed ICM the way the MySQL connector does, pending factors applied and the watermark as JSON
+  def __init__(self):
+    self.stored = None
+
+  def get_imageclassmeasures_images(self, query):
+    if self.stored is None:
+      return None
+    icm, watermark = self.stored
+    if icm.mode == 'log_odds':
+      return ImageClassMeasure(icm.imageID, None, icm.confidence.copy(), None, icm.label, icm.im_width, icm.im_height,
+                               log_odds=icm.log_odds.copy(), watermark=LabelWatermark.from_json(watermark))
+    return ImageClassMeasure(icm.imageID, None, icm.confidence.copy(), icm.helper_values.copy(), icm.label,
+                             icm.im_width, icm.im_height, watermark=LabelWatermark.from_json(watermark))
+
+  def push_imageclassmeasure_images(self, icm):
+    icm.apply_pending()
+    self.stored = (icm, icm.watermark.to_json())
+
+
+class MemoryLabellerDB:
+  def __init__(self):
+    self.increments = {}
+
+  def add_labeller_accuracy(self, labeller, alpha_increment, beta_increment):
+    alpha, beta = self.increments.get(labeller.LabellerID, (0.0, 0.0))
+    self.increments[labeller.LabellerID] = (alpha + alpha_increment, beta + beta_increment)
+
+
+def label(label_id, labeller_id, box, creation_time):
+  tlx, tly, brx, bry = box
+  return Label(LabelID=label_id, LabellerID=labeller_id, ImageID='tile', Class='plane', top_left_x=tlx, top_left_y=tly,
+               bot_right_x=brx, bot_right_y=bry, offset_x=2, offset_y=1, creation_time=creation_time, origImageID='img')
+
+
+FIRST = [label('1', 'a', (2, 2, 10, 9), '2024-01-01 10:00:00'),
+         label('2', 'b', (4, 3, 12, 12), '2024-01-01 10:00:00'),
+         label('3', 'b', (20, 15, 30, 25), '2024-01-01 10:05:00')]
+# 'a' adds a box overlapping its first one, 'b' adds nothing and 'c' is new
+SECOND = [label('4', 'a', (6, 5, 15, 14), '2024-01-01 11:00:00'),
+          label('5', 'a', (21, 16, 28, 24), '2024-01-01 11:00:00'),
+          label('6', 'c', (3, 2, 11, 10), '2024-01-01 11:30:00')]
+LABELLERS = [Labeller('a', 'plane', 3.0, 1.0), Labeller('b', 'plane', 2.0, 1.5), Labeller('c', 'plane', 1.5, 1.2)]
+
+
+def run(batches, mode):
+  # one get_objects call per batch, each seeing every label up to it like ObjectExtractionManager passes them
+  icm_db = MemoryICMDB()
+  labeller_db = MemoryLabellerDB()
+  service = ObjectExtractionService(icm_db, labeller_db, backend=NumpyConsensusBackend(), icm_mode=mode)
+  image = SimpleNamespace(ImageID='img', image_data=SimpleNamespace(size=(IM_WIDTH, IM_HEIGHT)))
+  labels = []
+  for batch in batches:
+    labels += batch
+    labeller_ids = {l.LabellerID for l in labels}
+    objects = service.get_objects(image, 'plane', [l for l in LABELLERS if l.LabellerID in labeller_ids], list(labels))
+  return icm_db.stored[0], labeller_db.increments, objects
+
+
+@pytest.mark.parametrize('mode', ['helper', 'log_odds'])
+def test_incremental_matches_full(mode):
+  full_icm, full_accuracy, full_objects = run([FIRST + SECOND], mode)
+  incremental_icm, incremental_accuracy, incremental_objects = run([FIRST, SECOND], mode)
+
+  np.testing.assert_allclose(incremental_icm.likelihoods, full_icm.likelihoods, rtol=1e-9, atol=1e-12)
+  assert incremental_accuracy.keys() == full_accuracy.keys()
+  for labeller_id, increments in full_accuracy.items():
+    np.testing.assert_allclose(incremental_accuracy[labeller_id], increments, rtol=1e-9)
+  assert [(o.top_left_x, o.top_left_y, o.bot_right_x, o.bot_right_y) for o in incremental_objects] == \
+         [(o.top_left_x, o.top_left_y, o.bot_right_x, o.bot_right_y) for o in full_objects]
+
+
+def test_rerun_without_new_labels_changes_nothing():
+  icm, accuracy, _ = run([FIRST + SECOND], 'helper')
+  again, again_accuracy, _ = run([FIRST + SECOND, []], 'helper')
+  np.testing.assert_allclose(again.likelihoods, icm.likelihoods, rtol=1e-9, atol=1e-12)
+  for labeller_id, increments in accuracy.items():
+    np.testing.assert_allclose(again_accuracy[labeller_id], increments, rtol=1e-9)
+
+
+@pytest.mark.parametrize('mode', ['helper', 'log_odds'])
+def test_moved_box_rebuilds_the_icm(mode):
+  # the upsert keeps LabelID and creation_time when a box is moved
+  moved = label('2', 'b', (5, 6, 14, 13), '2024-01-01 10:00:00')
+  labels = [FIRST[0], moved, FIRST[2]] + SECOND
+  full_icm, full_accuracy, full_objects = run([labels], mode)
+
+  # the second run sees the moved box in place of the original one
+  icm_db = MemoryICMDB()
+  labeller_db = MemoryLabellerDB()
+  service = ObjectExtractionService(icm_db, labeller_db, backend=NumpyConsensusBackend(), icm_mode=mode)
+  image = SimpleNamespace(ImageID='img', image_data=SimpleNamespace(size=(IM_WIDTH, IM_HEIGHT)))
+  service.get_objects(image, 'plane', LABELLERS, FIRST + SECOND)
+  assert not icm_db.stored[0].watermark.is_current(labels)
+  objects = service.get_objects(image, 'plane', LABELLERS, labels)
+
+  np.testing.assert_allclose(icm_db.stored[0].likelihoods, full_icm.likelihoods, rtol=1e-9, atol=1e-12)
+  for labeller_id, increments in full_accuracy.items():
+    np.testing.assert_allclose(labeller_db.increments[labeller_id], increments, rtol=1e-9)
+  assert [(o.top_left_x, o.top_left_y, o.bot_right_x, o.bot_right_y) for o in objects] == \
+         [(o.top_left_x, o.top_left_y, o.bot_right_x, o.bot_right_y) for o in full_objects]
+
+
+def test_labels_without_creation_time_are_applied():
+  first = [label('1', 'a', (2, 2, 10, 9), None)] + FIRST[1:]
+  second = [label('4', 'a', (6, 5, 15, 14), '2024-01-01 11:00:00')]
+  full_icm, _, _ = run([first + second], 'helper')
+  incremental_icm, _, _ = run([first, second], 'helper')
+  np.testing.assert_allclose(incremental_icm.likelihoods, full_icm.likelihoods, rtol=1e-9, atol=1e-12)
+  assert not incremental_icm.watermark.new_labels(first + second)
+
+
+def test_creation_time_marks_are_not_current():
+  # watermarks stored before boxes were tracked cannot tell a moved box apart, the ICM is rebuilt once
+  watermark = LabelWatermark.from_json('{"a": {"creation_time": "2024-01-01 10:00:00", "label_ids": ["1"], "accuracy": [0.5, 0.25]}}')
+  assert not watermark.is_current(FIRST)
+  assert watermark.new_labels(FIRST) == FIRST
+  assert watermark.reset().marks == {'a': {'boxes': {}, 'accuracy': [0.5, 0.25]}}
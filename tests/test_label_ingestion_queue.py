@@ -0,0 +1,126 @@
+import json
+import threading
+
+import pytest
+from sqlalchemy import exc
+
+from services.DataTypes import Label
+from services.LabelIngestionQueue import LabelIngestionQueue, MemoryJournal, SQLiteJournal, QueueFullError
+
+
+def make_label(i):
+  return Label(LabelID=str(i), LabellerID='a', ImageID='1', Class='plane', top_left_x=0, top_left_y=0, bot_right_x=1,
+               bot_right_y=1, offset_x=0, offset_y=0, creation_time='2024-01-01 10:00:00', origImageID='1')
+
+
+class FakeLabelDB:
+  # rejects batches holding a bad label, or every batch while it is down
+  def __init__(self, bad=()):
+    self.bad = set(bad)
+    self.down = False
+    self.written = []
+
+  def push_labels_batch(self, labels):
+    if self.down:
+      try:
+        raise exc.OperationalError('INSERT', {}, ConnectionError('gone'))
+      except Exception as e:
+        raise Exception(e) # the connectors wrap database errors like this
+    if any(label.LabelID in self.bad for label in labels):
+      raise Exception('Incorrect integer value')
+    self.written += [label.LabelID for label in labels]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def journal(request, tmp_path):
+  if request.param == 'memory':
+    return MemoryJournal(str(tmp_path / 'dead_letters.jsonl'))
+  return SQLiteJournal(str(tmp_path / 'journal.sqlite'))
+
+
+def drain(queue):
+  while queue.flush():
+    pass
+
+
+def test_flush_writes_in_order(journal):
+  db = FakeLabelDB()
+  queue = LabelIngestionQueue(db, journal, max_batch=4)
+  assert queue.submit([make_label(i) for i in range(10)]) == 10
+  drain(queue)
+  assert db.written == [str(i) for i in range(10)]
+  assert journal.depth() == 0
+
+
+def test_connection_errors_release_the_batch(journal):
+  db = FakeLabelDB()
+  db.down = True
+  queue = LabelIngestionQueue(db, journal, max_batch=4, max_attempts=2)
+  queue.submit([make_label(i) for i in range(6)])
+  for _ in range(3):
+    with pytest.raises(Exception):
+      queue.flush()
+  # retried whole, no label is blamed for the outage
+  assert journal.depth() == 6
+  assert journal.dead_letters() == 0
+
+  db.down = False
+  drain(queue)
+  assert db.written == [str(i) for i in range(6)]
+
+
+def test_rejected_labels_are_isolated_and_dead_lettered(journal):
+  db = FakeLabelDB(bad={'2', '5'})
+  queue = LabelIngestionQueue(db, journal, max_batch=8, max_attempts=3)
+  queue.submit([make_label(i) for i in range(8)])
+
+  queue.flush()
+  assert sorted(db.written, key=int) == ['0', '1', '3', '4', '6', '7']
+  assert journal.depth() == 2
+  assert journal.dead_letters() == 0
+
+  drain(queue)
+  assert journal.depth() == 0
+  assert journal.dead_letters() == 2
+  assert queue.stats()['rejected'] == 6
+
+
+def test_dead_letters_keep_the_label(tmp_path):
+  path = tmp_path / 'dead_letters.jsonl'
+  queue = LabelIngestionQueue(FakeLabelDB(bad={'0'}), MemoryJournal(str(path)), max_attempts=1)
+  queue.submit([make_label(0)])
+  queue.flush()
+  entry = json.loads(path.read_text())
+  assert entry['label']['LabelID'] == '0' and entry['attempts'] == 1 and 'Incorrect' in entry['error']
+
+
+def test_sqlite_journal_hands_out_an_expired_claim_again(tmp_path):
+  journal = SQLiteJournal(str(tmp_path / 'journal.sqlite'), lease=0)
+  journal.append([make_label(i) for i in range(3)])
+  token, labels = journal.claim(10)
+  assert len(labels) == 3
+  # the flusher that claimed them died, with no lease left the labels are claimed again
+  token, labels = journal.claim(10)
+  assert [label.LabelID for label in labels] == ['0', '1', '2']
+  journal.ack(token)
+  assert journal.depth() == 0
+
+
+def test_submit_never_exceeds_max_depth(journal):
+  queue = LabelIngestionQueue(FakeLabelDB(), journal, max_batch=1000, max_depth=50)
+  refused = []
+
+  def submit():
+    for i in range(10):
+      try:
+        queue.submit([make_label(i)])
+      except QueueFullError:
+        refused.append(i)
+
+  threads = [threading.Thread(target=submit) for _ in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert journal.depth() == 50
+  assert len(refused) == 30
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from services.LabelRasterizer import label_boxes, label_coverage, rasterize_labels, disjoint_windows
+
+
+def brute_force_coverage(boxes, im_height, im_width):
+  # boxes are inclusive corners, anything outside the image is dropped
+  coverage = np.zeros((im_height, im_width), dtype=np.int32)
+  for tlx, tly, brx, bry in boxes:
+    coverage[max(tly, 0):max(bry + 1, 0), max(tlx, 0):max(brx + 1, 0)] += 1
+  return coverage
+
+
+def random_boxes(rng, n, im_height, im_width):
+  # corners may fall outside the image and boxes may be empty after clipping
+  x = rng.integers(-5, im_width + 5, size=(n, 2))
+  y = rng.integers(-5, im_height + 5, size=(n, 2))
+  return np.stack((x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)), axis=-1)
+
+
+def test_label_coverage_matches_brute_force():
+  rng = np.random.default_rng(0)
+  for _ in range(50):
+    im_height, im_width = rng.integers(1, 40, size=2)
+    boxes = random_boxes(rng, rng.integers(0, 12), im_height, im_width)
+    expected = brute_force_coverage(boxes.tolist(), im_height, im_width)
+    np.testing.assert_array_equal(label_coverage(boxes, im_height, im_width), expected)
+    np.testing.assert_array_equal(rasterize_labels(boxes, im_height, im_width), expected > 0)
+
+
+def test_label_boxes_applies_offsets():
+  labels = pd.DataFrame({'top_left_x': [1, 5], 'top_left_y': [2, 6], 'bot_right_x': [3, 9], 'bot_right_y': [4, 8],
+                         'offset_x': [10, 0], 'offset_y': [0, 20]})
+  np.testing.assert_array_equal(label_boxes(labels), [[11, 2, 13, 4], [5, 26, 9, 28]])
+  assert label_boxes(labels.iloc[:0]).shape == (0, 4)
+
+
+def windows_mask(windows, im_height, im_width):
+  # how often each pixel is covered by the half open windows
+  mask = np.zeros((im_height, im_width), dtype=np.int32)
+  for x_start, y_start, x_end, y_end in windows:
+    mask[y_start:y_end, x_start:x_end] += 1
+  return mask
+
+
+def test_disjoint_windows_cover_the_union_once():
+  rng = np.random.default_rng(1)
+  for _ in range(50):
+    im_height, im_width = rng.integers(1, 40, size=2)
+    boxes = random_boxes(rng, rng.integers(0, 12), im_height, im_width)
+    windows = disjoint_windows(boxes, im_height, im_width)
+    assert np.all(windows[:, 2] > windows[:, 0]) and np.all(windows[:, 3] > windows[:, 1])
+    expected = brute_force_coverage(boxes.tolist(), im_height, im_width) > 0
+    np.testing.assert_array_equal(windows_mask(windows.tolist(), im_height, im_width), expected)
+
+
+def test_disjoint_windows_leave_out_excluded_boxes():
+  rng = np.random.default_rng(2)
+  for _ in range(50):
+    im_height, im_width = rng.integers(1, 40, size=2)
+    boxes = random_boxes(rng, rng.integers(0, 8), im_height, im_width)
+    exclude = random_boxes(rng, rng.integers(0, 8), im_height, im_width)
+    windows = disjoint_windows(boxes, im_height, im_width, exclude=exclude)
+    expected = (brute_force_coverage(boxes.tolist(), im_height, im_width) > 0) & \
+               (brute_force_coverage(exclude.tolist(), im_height, im_width) == 0)
+    np.testing.assert_array_equal(windows_mask(windows.tolist(), im_height, im_width), expected)
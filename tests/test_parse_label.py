@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from services.LabelServer import parse_label, parse_labels
+
+VALID = {'LabelID': 'l1', 'LabellerID': 'a', 'ImageID': '7', 'Class': 'plane', 'top_left_x': 1, 'top_left_y': 2,
+         'bot_right_x': 5, 'bot_right_y': 6, 'offset_x': 0, 'offset_y': 64, 'creation_time': '2024-01-01 10:00:00',
+         'OrigImageID': '3'}
+
+
+def test_valid_label():
+  label = parse_label(dict(VALID, top_left_x='1', bot_right_x=5.0))
+  assert (label.top_left_x, label.bot_right_x, label.offset_y) == (1, 5, 64)
+  assert label.origImageID == '3'
+  assert label.LabelID and label.LabelID != 'l1'
+
+
+@pytest.mark.parametrize('value', [1.5, 'abc', True, None, [1], float('nan'), float('inf'), '1e999', 'Infinity',
+                                   10 ** 400, json.loads('1e999'), json.loads('-Infinity')])
+def test_bad_coordinate(value):
+  with pytest.raises(ValueError):
+    parse_label(dict(VALID, bot_right_x=value))
+
+
+def test_reports_every_problem():
+  with pytest.raises(ValueError) as e:
+    parse_label(dict(VALID, Class=None, top_left_x=9, top_left_y=8))
+  assert "missing 'Class'" in str(e.value)
+  assert "'top_left_x' is right of 'bot_right_x'" in str(e.value)
+  assert "'top_left_y' is below 'bot_right_y'" in str(e.value)
+
+
+def test_parse_labels_keeps_the_good_ones():
+  labels, errors = parse_labels([VALID, 'not a label', dict(VALID, offset_x=float('inf'))])
+  assert len(labels) == 1
+  assert [error['index'] for error in errors] == [1, 2]
+
+
+@pytest.mark.parametrize('value, expected', [('2024-01-01 10:00:00', '2024-01-01 10:00:00'),
+                                             ('2024-01-01T10:00:00.250', '2024-01-01 10:00:00.250000'),
+                                             ('2024-01-01T12:00:00+02:00', '2024-01-01 10:00:00'),
+                                             ('2024-01-01T10:00:00Z', '2024-01-01 10:00:00')])
+def test_creation_time_is_normalized(value, expected):
+  assert parse_label(dict(VALID, creation_time=value)).creation_time == expected
+
+
+@pytest.mark.parametrize('value', ['yesterday', '2024-13-01 10:00:00', '', 1704103200, '0999-01-01 00:00:00'])
+def test_bad_creation_time(value):
+  labels, errors = parse_labels([VALID, dict(VALID, creation_time=value)])
+  assert len(labels) == 1
+  assert [error['index'] for error in errors] == [1]
+  assert 'creation_time' in errors[0]['error']
@@ -0,0 +1,30 @@
+import numpy as np
+
+from services.SummedAreaTable import SummedAreaTable
+
+
+def test_window_sums_match_slices():
+  rng = np.random.default_rng(3)
+  values = rng.random((23, 31))
+  table = SummedAreaTable(values)
+  assert np.isclose(table.total, values.sum())
+
+  x = np.sort(rng.integers(0, 32, size=(200, 2)), axis=1)
+  y = np.sort(rng.integers(0, 24, size=(200, 2)), axis=1)
+  windows = np.stack((x[:, 0], y[:, 0], x[:, 1], y[:, 1]), axis=-1)
+  expected = [values[y_start:y_end, x_start:x_end].sum() for x_start, y_start, x_end, y_end in windows.tolist()]
+  np.testing.assert_allclose(table.window_sums(windows), expected, rtol=1e-12, atol=1e-9)
+
+
+def test_union_sum_counts_overlaps_once():
+  rng = np.random.default_rng(4)
+  values = rng.random((20, 25))
+  table = SummedAreaTable(values)
+  for _ in range(50):
+    x = np.sort(rng.integers(-3, 28, size=(6, 2)), axis=1)
+    y = np.sort(rng.integers(-3, 23, size=(6, 2)), axis=1)
+    boxes = np.stack((x[:, 0], y[:, 0], x[:, 1], y[:, 1]), axis=-1)
+    mask = np.zeros(values.shape, dtype=bool)
+    for tlx, tly, brx, bry in boxes.tolist():
+      mask[max(tly, 0):max(bry + 1, 0), max(tlx, 0):max(brx + 1, 0)] = True
+    assert np.isclose(table.union_sum(boxes), values[mask].sum())
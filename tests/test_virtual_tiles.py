@@ -0,0 +1,37 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+import utils.ImagePreprocess as ImagePreprocess
+from utils.ImagePreprocess import iter_tiles, render_tile, store_tile_geometry, store_tiles, tile_windows
+
+
+class RecordingCursor:
+  # keeps the rows of every multi row INSERT
+  def __init__(self, columns):
+    self.columns = columns
+    self.rows = []
+
+  def execute(self, query, values):
+    assert query.count('(') - 1 == len(values) // self.columns
+    self.rows += [tuple(values[i:i + self.columns]) for i in range(0, len(values), self.columns)]
+
+
+def test_rendered_virtual_tiles_match_stored_tiles(monkeypatch):
+  monkeypatch.setattr(ImagePreprocess, 'GEOMETRY_BATCH_ROWS', 4)
+  image_np = np.random.default_rng(7).integers(0, 256, size=(700, 1000, 3), dtype=np.uint8)
+
+  geometry = RecordingCursor(8)
+  progress = []
+  stats = store_tile_geometry(tile_windows(*image_np.shape[:2]), 'p', 'o', geometry, progress=progress.append)
+  stored = RecordingCursor(7)
+  store_tiles(iter_tiles(image_np), 'p', 'o', stored, workers=2)
+
+  assert stats['tiles'] == len(geometry.rows) == len(stored.rows)
+  assert progress == list(range(4, len(geometry.rows), 4)) + [len(geometry.rows)]
+  for (_, _, width, height, x_offset, y_offset, core_x, core_y), tile, stored_row in zip(geometry.rows, iter_tiles(image_np), stored.rows):
+    rendered = render_tile(image_np, x_offset, y_offset, width, height, core_x, core_y)
+    np.testing.assert_array_equal(rendered, tile['tile'])
+    assert stored_row[2:6] == (width, height, x_offset, y_offset)
+    np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(stored_row[6]))), rendered)
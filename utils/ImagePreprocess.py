@@ -1,10 +1,13 @@
 import numpy as np
 
 import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
 from PIL import Image
 
-import mysql.connector
-
 # Config
 # ------------------------------------------------------------  
 OBJECTSIZE = 32 #m - Size of the object in meters (max dimension)
@@ -13,85 +16,243 @@ OBJECTSINFRAME = 5 #number of objects that fit in the frame
 
 PIXELSIZE = OBJECTSIZE * RESOLUTION #pixels the object takes up in image
 FRAMEPIXELSIZE = PIXELSIZE * OBJECTSINFRAME #pixels per meter
+
+ENCODE_WORKERS = os.cpu_count() or 1 # TILE_ENCODE_WORKERS - threads encoding tiles to PNG
+PNG_COMPRESS_LEVEL = 6 # TILE_PNG_COMPRESS_LEVEL - zlib level 0-9, lower is faster and larger
+INSERT_BATCH_ROWS = 100 # tiles per multi row INSERT
+INSERT_BATCH_BYTES = 16 * 1024 * 1024 # PNG bytes per INSERT, keep well below MySQL's max_allowed_packet
+DECODE_STRIP_ROWS = 512 # image rows copied from the decoded image into the cache at a time
+DECODE_MAX_PIXELS = 150_000_000 # TILE_MAX_DECODE_PIXELS - largest image decoded, PIL holds all of it in memory
+GEOMETRY_BATCH_ROWS = 1000 # virtual tile rows per INSERT
 # ------------------------------------------------------------  
 
-def preprocess_image(image_np: np.ndarray) -> list[dict]:
+OVERLAY = np.array([255, 100, 100], dtype=np.uint8) # buffer zone tint, blended 50/50 with the image
+
+
+def tile_positions(total_size: int, frame_size: int) -> list[int]:
+    # frame starts along one axis, the last frame is moved back to end on the border and overlaps its neighbour
+    if total_size <= frame_size:
+        return [0]
+    positions = list(range(0, total_size - frame_size + 1, frame_size))
+    if positions[-1] + frame_size < total_size:  # if there's remaining space
+        positions.append(total_size - frame_size)  # overlap with previous grid
+    return positions
+
+
+def tile_windows(img_height: int, img_width: int) -> np.ndarray:
+    '''
+    Geometry of every tile, one (x_offset, y_offset, x_buff_start, y_buff_start, x_buff_end, y_buff_end) row
+    per tile in row major order. (x_offset, y_offset) is the corner of the FRAMEPIXELSIZE core, the buffered
+    window adds up to PIXELSIZE on every side and is clipped to the image, ends exclusive
+    '''
+    xs = np.asarray(tile_positions(img_width, FRAMEPIXELSIZE))
+    ys = np.asarray(tile_positions(img_height, FRAMEPIXELSIZE))
+    y_offset, x_offset = (a.ravel() for a in np.meshgrid(ys, xs, indexing='ij'))
+    return np.stack((x_offset,
+                     y_offset,
+                     np.maximum(0, x_offset - PIXELSIZE),
+                     np.maximum(0, y_offset - PIXELSIZE),
+                     np.minimum(img_width, x_offset + FRAMEPIXELSIZE + PIXELSIZE),
+                     np.minimum(img_height, y_offset + FRAMEPIXELSIZE + PIXELSIZE)), axis=-1)
+
+
+def tint_border(tile: np.ndarray, core_start_x: int, core_start_y: int, core_size: int=FRAMEPIXELSIZE) -> None:
+    '''
+    Blends OVERLAY into everything outside the core in place. Only the four border strips are touched and
+    (x + c) >> 1 is computed as (x >> 1) + (c >> 1) + (x & c & 1) so it stays in uint8
+    '''
+    if tile.ndim != 3:
+        return
+    core_end_y = core_start_y + core_size
+    core_end_x = core_start_x + core_size
+    strips = (tile[:core_start_y, :, :3],
+              tile[core_end_y:, :, :3],
+              tile[core_start_y:core_end_y, :core_start_x, :3],
+              tile[core_start_y:core_end_y, core_end_x:, :3])
+    overlay = OVERLAY[:tile.shape[2]]
+    for strip in strips:
+        if strip.size:
+            strip[...] = (strip >> 1) + (overlay >> 1) + (strip & overlay & 1)
+
 
-    tiles = []
+def iter_tiles(image_np: np.ndarray) -> Iterator[dict]:
+    '''
+    Yields the tiles of an image one at a time. Each tile is the only copy made of its window, so memory
+    stays at one tile however large the image is
+    '''
     img_height, img_width = image_np.shape[:2] #width and height
 
-    def get_positions(total_size, frame_size):
-        positions = list(range(0, total_size - frame_size + 1, frame_size))
-        if total_size - positions[-1] > 0:  # if there's remaining space
-            positions.append(total_size - frame_size)  # overlap with previous grid
-        return positions
-
-    x_positions = get_positions(img_width, FRAMEPIXELSIZE)
-    y_positions = get_positions(img_height, FRAMEPIXELSIZE)
-
-    for y_offset in y_positions:
-        for x_offset in x_positions:
-            # Core frame coordinates
-            x_end = x_offset + FRAMEPIXELSIZE
-            y_end = y_offset + FRAMEPIXELSIZE
-            
-            # Buffer zone coordinates
-            x_buff_start = max(0, x_offset - PIXELSIZE)
-            y_buff_start = max(0, y_offset - PIXELSIZE)
-            x_buff_end = min(img_width, x_end + PIXELSIZE)
-            y_buff_end = min(img_height, y_end + PIXELSIZE)
-            
-            full_tile = image_np[y_buff_start:y_buff_end, x_buff_start:x_buff_end].copy()
-            
-            # relative positions for core area in the buffered tile
-            core_start_y = y_offset - y_buff_start
-            core_start_x = x_offset - x_buff_start
-            core_end_y = core_start_y + FRAMEPIXELSIZE
-            core_end_x = core_start_x + FRAMEPIXELSIZE
-            
-
-            overlay = np.ones_like(full_tile) * [255, 100, 100] 
-            mask = np.ones_like(full_tile, dtype=bool)
-            mask[core_start_y:core_end_y, core_start_x:core_end_x] = False
-            full_tile[mask] = full_tile[mask] * 0.5 + overlay[mask] * 0.5
-            
-            tiles.append({
-                'tile': full_tile,
-                'x_offset': x_buff_start,
-                'y_offset': y_buff_start,
-                'core_start': (core_start_x, core_start_y),
-                'core_size': FRAMEPIXELSIZE,
-                'width': x_buff_end - x_buff_start,
-                'height': y_buff_end - y_buff_start
-            })
-
-    return tiles
-
-def store_tiles(tiles: list[dict], project_id: str, original_image_id: str, cursor: mysql.connector.cursor.MySQLCursor) -> None:
-
-    for tile_data in tiles:
-        # Convert numpy array back to PIL Image
-        tile_img = Image.fromarray(tile_data['tile'].astype('uint8'))
-        
-        img_byte_arr = io.BytesIO()
-        tile_img.save(img_byte_arr, format='PNG')
-        img_blob = img_byte_arr.getvalue()
-
-        height, width = tile_data['tile'].shape[:2]
+    for x_offset, y_offset, x_buff_start, y_buff_start, x_buff_end, y_buff_end in tile_windows(img_height, img_width).tolist():
+        full_tile = np.array(image_np[y_buff_start:y_buff_end, x_buff_start:x_buff_end], dtype=np.uint8)
+
+        # relative positions for core area in the buffered tile
+        core_start_y = y_offset - y_buff_start
+        core_start_x = x_offset - x_buff_start
+        tint_border(full_tile, core_start_x, core_start_y)
+
+        yield {
+            'tile': full_tile,
+            'x_offset': x_buff_start,
+            'y_offset': y_buff_start,
+            'core_start': (core_start_x, core_start_y),
+            'core_size': FRAMEPIXELSIZE,
+            'width': x_buff_end - x_buff_start,
+            'height': y_buff_end - y_buff_start
+        }
+
+
+class ImageTooLargeError(ValueError):
+    '''
+    Raised for an image with more pixels than TILE_MAX_DECODE_PIXELS
+    '''
+
+
+def check_decode_size(image_path: str) -> tuple[int, int]:
+    '''
+    Reads the (width, height) of an image file from its header and raises ImageTooLargeError when decoding
+    it would take more than TILE_MAX_DECODE_PIXELS pixels. Nothing is decoded, so uploads can be checked
+    before they are stored
+    '''
+    max_pixels = int(os.getenv('TILE_MAX_DECODE_PIXELS', DECODE_MAX_PIXELS))
+    with Image.open(image_path) as img:
+        width, height = img.size
+    if width * height > max_pixels:
+        raise ImageTooLargeError(f"image of {width}x{height} pixels is larger than the {max_pixels} pixels that can be decoded")
+    return width, height
+
+
+def decode_to_cache(image_path: str, cache_path: str) -> np.ndarray:
+    '''
+    Decodes an image file into an uncompressed .npy file and returns it memory mapped read only, so
+    iter_tiles only pages in the windows it cuts. PIL cannot decode most formats (PNG, JPEG) a strip at a
+    time, so the whole image is decoded into memory once and peak memory grows with its pixel count, images
+    above TILE_MAX_DECODE_PIXELS raise ImageTooLargeError before decoding. Its pixels are copied into the
+    cache in strips of DECODE_STRIP_ROWS rows so no second full size copy is made as a numpy array. The
+    decoded image is freed once the cache is written, under a temporary name first. An existing cache is
+    reused as is
+    '''
+    if not os.path.exists(cache_path):
+        check_decode_size(image_path)
+        part_path = cache_path + '.part'
+        with Image.open(image_path) as img:
+            img.load()
+            width, height = img.size
+            first = np.asarray(img.crop((0, 0, width, 1)))
+            cache = np.lib.format.open_memmap(part_path, mode='w+', dtype=first.dtype, shape=(height,) + first.shape[1:])
+            for y in range(0, height, DECODE_STRIP_ROWS):
+                y_end = min(height, y + DECODE_STRIP_ROWS)
+                cache[y:y_end] = np.asarray(img.crop((0, y, width, y_end)))
+            cache.flush()
+            del cache
+        os.replace(part_path, cache_path)
+    return np.load(cache_path, mmap_mode='r')
+
 
+def preprocess_image(image_np: np.ndarray) -> list[dict]:
+    # every tile at once, prefer iter_tiles for large images
+    return list(iter_tiles(image_np))
+
+def encode_png(tile: np.ndarray, compress_level: int=PNG_COMPRESS_LEVEL) -> bytes:
+    # PIL's zlib releases the GIL, so tiles can be encoded on threads
+    tile_img = Image.fromarray(tile.astype('uint8', copy=False))
+
+    img_byte_arr = io.BytesIO()
+    tile_img.save(img_byte_arr, format='PNG', compress_level=compress_level)
+    return img_byte_arr.getvalue()
+
+
+def encode_tile(tile_data: dict, compress_level: int=PNG_COMPRESS_LEVEL) -> tuple:
+    # (width, height, x_offset, y_offset, png) of one tile
+    tile = tile_data['tile']
+    height, width = tile.shape[:2]
+    return width, height, tile_data['x_offset'], tile_data['y_offset'], encode_png(tile, compress_level)
+
+
+def render_tile(image_np: np.ndarray, x_offset: int, y_offset: int, width: int, height: int,
+                core_x_offset: int, core_y_offset: int) -> np.ndarray:
+    # the tile iter_tiles cuts for this geometry, offsets are absolute image coordinates
+    tile = np.array(image_np[y_offset:y_offset + height, x_offset:x_offset + width], dtype=np.uint8)
+    tint_border(tile, core_x_offset - x_offset, core_y_offset - y_offset)
+    return tile
+
+
+def store_tile_geometry(windows: np.ndarray, project_id: str, original_image_id: str, cursor, progress=None) -> dict:
+    '''
+    Inserts virtual tiles: Images rows with the geometry of each tile_windows row and no image, rendered
+    from the original on request by services/TileRenderer.py. Same return value as store_tiles
+    '''
+    start = time.perf_counter()
+    rows = [(project_id, original_image_id, x_buff_end - x_buff_start, y_buff_end - y_buff_start,
+             x_buff_start, y_buff_start, x_offset, y_offset)
+            for x_offset, y_offset, x_buff_start, y_buff_start, x_buff_end, y_buff_end in windows.tolist()]
+
+    for i in range(0, len(rows), GEOMETRY_BATCH_ROWS):
+        batch = rows[i:i + GEOMETRY_BATCH_ROWS]
+        insert_tile_query = """
+            INSERT INTO Images (project_id, orig_image_id, image_width, image_height, x_offset, y_offset, core_x_offset, core_y_offset, image)
+            VALUES """ + ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, NULL)"] * len(batch))
+        cursor.execute(insert_tile_query, [value for row in batch for value in row])
+        if progress:
+            progress(i + len(batch))
+
+    seconds = time.perf_counter() - start
+    tiles_per_second = len(rows) / seconds if seconds > 0 else 0.0
+    print(f"stored {len(rows)} virtual tiles in {seconds:.2f}s ({tiles_per_second:.1f} tiles/s)")
+    return {'tiles': len(rows), 'seconds': seconds, 'tiles_per_second': tiles_per_second}
+
+
+def store_tiles(tiles: Iterable[dict], project_id: str, original_image_id: str, cursor,
+                workers: int=None, compress_level: int=None, progress=None) -> dict:
+    '''
+    Encodes tiles to PNG on a thread pool and inserts them into Images with multi row INSERTs of up to
+    INSERT_BATCH_ROWS rows or INSERT_BATCH_BYTES of PNG data. tiles can be the iter_tiles generator: at most
+    2 * workers tiles are being encoded at once and one batch of PNGs is held, so memory stays bounded.
+    progress(tiles_written) is called after every INSERT. Returns {'tiles', 'seconds', 'tiles_per_second'}
+    '''
+    workers = workers if workers else int(os.getenv('TILE_ENCODE_WORKERS', ENCODE_WORKERS))
+    if compress_level is None:
+        compress_level = int(os.getenv('TILE_PNG_COMPRESS_LEVEL', PNG_COMPRESS_LEVEL))
+    max_in_flight = 2 * workers
+
+    start = time.perf_counter()
+    count = 0
+    batch = []
+    batch_bytes = 0
+
+    def flush():
+        nonlocal batch, batch_bytes
+        if not batch:
+            return
         insert_tile_query = """
             INSERT INTO Images (project_id, orig_image_id, image_width, image_height, x_offset, y_offset, image)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """
-        cursor.execute(
-            insert_tile_query, 
-            (
-                project_id,
-                original_image_id,
-                width,
-                height,
-                tile_data['x_offset'],
-                tile_data['y_offset'],
-                img_blob
-            )
-        )
\ No newline at end of file
+            VALUES """ + ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(batch))
+        cursor.execute(insert_tile_query, [value for row in batch for value in row])
+        batch = []
+        batch_bytes = 0
+        if progress:
+            progress(count)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tile-encoder') as pool:
+        in_flight = deque()
+        tiles = iter(tiles)
+        while True:
+            # keep the encoders busy without cutting more tiles than they can take, rows stay in tile order
+            for tile_data in tiles:
+                in_flight.append(pool.submit(encode_tile, tile_data, compress_level))
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+
+            width, height, x_offset, y_offset, img_blob = in_flight.popleft().result()
+            batch.append((project_id, original_image_id, width, height, x_offset, y_offset, img_blob))
+            batch_bytes += len(img_blob)
+            count += 1
+            if len(batch) >= INSERT_BATCH_ROWS or batch_bytes >= INSERT_BATCH_BYTES:
+                flush()
+        flush()
+
+    seconds = time.perf_counter() - start
+    tiles_per_second = count / seconds if seconds > 0 else 0.0
+    print(f"stored {count} tiles in {seconds:.2f}s ({tiles_per_second:.1f} tiles/s)")
+    return {'tiles': count, 'seconds': seconds, 'tiles_per_second': tiles_per_second}
@@ -0,0 +1,76 @@
+import sys
+import os
+import re
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+project_root = str(Path(__file__).parent.parent)
+
+# Config
+# ------------------------------------------------------------
+# modules a worker or the API imports on start up
+MODULES = [
+    'services.ObjectExtractionService',
+    'services.ObjectExtractionManager',
+    'services.LabelServer',
+    'services.ReportGenerator',
+    'app',
+]
+# pulled in only by the code paths that need them (demo plotting, GPU backend)
+FORBIDDEN = ['pycuda', 'matplotlib']
+BUDGET_MS = 1500 # cumulative import time allowed per module
+# ------------------------------------------------------------
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def measure(module: str) -> dict:
+    '''
+    Imports module in a fresh interpreter with -X importtime and returns its cumulative
+    import time in ms plus the names of every module it pulled in
+    '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=project_root, capture_output=True, text=True)
+    imported = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            imported[match.group(4)] = int(match.group(2))
+
+    return {
+        'module': module,
+        'ok': result.returncode == 0,
+        'error': result.stderr.strip().splitlines()[-1] if result.returncode != 0 and result.stderr.strip() else None,
+        'cumulative_ms': imported.get(module, 0) / 1000,
+        'forbidden': sorted({name.split('.')[0] for name in imported if name.split('.')[0] in FORBIDDEN}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the start up import cost of the services with python -X importtime')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('_IMPORT_BUDGET_MS', BUDGET_MS)))
+    parser.add_argument('--json', action='store_true', help='print one json line per module for tracking over time')
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        res = measure(module)
+        res['over_budget'] = res['cumulative_ms'] > args.budget_ms
+        failed |= (not res['ok']) or res['over_budget'] or bool(res['forbidden'])
+
+        if args.json:
+            print(json.dumps(res))
+        else:
+            status = 'ok' if res['ok'] else f"import failed: {res['error']}"
+            print(f"{module:<45} {res['cumulative_ms']:>9.1f} ms  {status}"
+                  + (f"  over budget ({args.budget_ms} ms)" if res['over_budget'] else '')
+                  + (f"  imports {', '.join(res['forbidden'])}" if res['forbidden'] else ''))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()